@@ -10,11 +10,55 @@
 ##
 __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
+import numpy as np
+
 import file_utils as fu
 import utils as u
+import interval_index as ii
+import snapshot as sn
+import profiling as pr
+import transcripts as tx
+import region_track as rt
+import records as rec
+import site_cache as sc
+import bloom as bl
 
 indicesKnownGenes = [12, 1, 3]  # 12 for gene
 
+# Engines for the point-in-interval stages:
+#   sql   - one indexed query per variant
+#   batch - one query per window of variants
+#   index - load the table once per job and answer in memory
+#   sweep - merge coordinate-sorted input with the table streamed in order
+#   snapshot - answer every stage from the memory-mapped reference snapshot
+#              (see snapshot.py) without a database connection
+#   join  - upload the job's variants into a temporary table and resolve
+#           each stage with one join per window of variants
+# Stages without a batched, in-memory or sweep form query per variant.
+ENGINES = ["sql", "batch", "index", "sweep", "snapshot", "join"]
+
+# Engines that also answer the exact-position and gene structure lookups
+# (bigRefGene, refGene, gwasCatalog, tfbsConsSites) without per-variant SQL
+LOOKUP_ENGINES = ["snapshot", "join"]
+
+# Job variants inserted per statement, and variants per join query
+JOB_VARIANTS_TABLE = "job_variants"
+JOB_VARIANTS_INSERT = 1000
+JOIN_WINDOW = 50000
+
+# Engines whose range lookups search a window of variants at a time with
+# NumPy (see BatchLookup), and the variants per window
+BATCH_SEARCH_ENGINES = ["index", "snapshot"]
+BATCH_SEARCH_WINDOW = 50000
+
+# Engines whose gene location stage classifies every variant with the
+# region track (see regionAt), which loads a chromosome's transcripts and
+# CpG islands whole; under the others a chromosome is loaded only once
+# REGION_TRACK_VARIANTS of its variants have come, and the variants
+# before query per variant
+REGION_TRACK_ENGINES = ["snapshot", "join"]
+REGION_TRACK_VARIANTS = 100
+
 
 def collapseGeneNames(row, indices, region, cnt):
     names = [
@@ -147,32 +191,839 @@ def getComplementary(nuc):
         return compNuc
 
 
+"""Per-variant SQL lookup of the rows overlapping a position
+"""
+
+
+class SqlRangeLookup(object):
+    def __init__(
+        self, cursor, table, chromCol="chrom", startCol="chromStart", endCol="chromEnd"
+    ):
+        self.cursor = cursor
+        self.table = table
+        self.chromCol = chromCol
+        self.startCol = startCol
+        self.endCol = endCol
+
+    def _execute(self, chrom, pos):
+        # Exact-position tables (see LOOKUP_EXACT) match one column
+        if self.startCol == self.endCol:
+            self.cursor.execute(
+                "select * from "
+                + self.table
+                + " where "
+                + self.chromCol
+                + '="'
+                + str(chrom)
+                + '" AND '
+                + self.endCol
+                + " = "
+                + str(pos)
+                + ";"
+            )
+            return
+        sql = (
+            "select * from "
+            + self.table
+            + " where "
+            + self.chromCol
+            + '="'
+            + str(chrom)
+            + '" AND ('
+            + self.startCol
+            + " <= "
+            + str(pos)
+            + " AND "
+            + str(pos)
+            + " <= "
+            + self.endCol
+            + ");"
+        )
+        self.cursor.execute(sql)
+
+    def fetchall(self, chrom, pos):
+        self._execute(chrom, pos)
+        return self.cursor.fetchall()
+
+    def fetchone(self, chrom, pos):
+        self._execute(chrom, pos)
+        return self.cursor.fetchone()
+
+    def close(self):
+        pass
+
+
+"""Chromosome (without "chr") and position of a variant, as the join
+   engine keys it
+"""
+
+
+def variantKey(chr, pos):
+    chr = str(chr)
+    if chr.startswith("chr"):
+        chr = chr[3:]
+    return (chr, int(pos))
+
+
+"""Keys of the variants of the job, by line number, once uploaded by
+   loadJobVariants for the join engine or read by readJobVariants; and
+   the upload's (infile, format, sep) and database session (u.db_session)
+"""
+
+jobVariants = None
+jobVariantsSource = None
+jobVariantsSession = None
+
+
+"""Uploads the variants of infile into the JOB_VARIANTS_TABLE temporary
+   table of the shared connection, so that every stage of the job can
+   join against it. Temporary tables belong to their connection: the
+   stages must use the same one (u.db_connect() hands it out).
+"""
+
+
+def loadJobVariants(infile, format="vcf", sep="\t"):
+    global jobVariants, jobVariantsSource, jobVariantsSession
+
+    inds = getFormatSpecificIndices(format=format)
+    conn = u.db_connect()
+    cursor = pr.profileCursor(conn.cursor())
+    cursor.execute("drop temporary table if exists " + JOB_VARIANTS_TABLE + ";")
+    cursor.execute(
+        "create temporary table "
+        + JOB_VARIANTS_TABLE
+        + " (line_no int not null primary key, chrom varchar(64) not null,"
+        + " pos int not null, ref text, alt text);"
+    )
+
+    keys = []
+    values = []
+    fh = fu.openText(infile)
+    for line in fh:
+        line = line.strip()
+        if line.startswith("#"):
+            continue
+        fields = line.split(sep)
+        chr, pos = variantKey(fields[inds[0]].strip(), fields[inds[1]].strip())
+        ref = clean_mysql_chars(fields[inds[2]]).strip()
+        alt = clean_mysql_chars(fields[inds[3]]).strip()
+        values.append(
+            "("
+            + str(len(keys))
+            + ',"'
+            + clean_mysql_chars(chr)
+            + '",'
+            + str(pos)
+            + ',"'
+            + ref
+            + '","'
+            + alt
+            + '")'
+        )
+        keys.append((chr, pos))
+        if len(values) >= JOB_VARIANTS_INSERT:
+            insertJobVariants(cursor, values)
+            values = []
+    fh.close()
+
+    if len(values) > 0:
+        insertJobVariants(cursor, values)
+    conn.commit()
+    cursor.close()
+    closeConnection(conn)
+
+    jobVariants = keys
+    jobVariantsSource = (infile, format, sep)
+    jobVariantsSession = u.db_session
+    return len(keys)
+
+
+"""Uploads the variants again if the shared connection has reconnected
+   since they were, which dropped the temporary table with its session
+"""
+
+
+def ensureJobVariants():
+    if jobVariantsSource is not None and jobVariantsSession != u.db_session:
+        print("Uploading the job's variants again in the new database session")
+        loadJobVariants(*jobVariantsSource)
+
+
+"""Reads the keys of the variants of infile into jobVariants, for the
+   BATCH_SEARCH_ENGINES, which need no upload
+"""
+
+
+def readJobVariants(infile, format="vcf", sep="\t"):
+    global jobVariants, jobVariantsSource
+
+    inds = getFormatSpecificIndices(format=format)
+    keys = []
+    fh = fu.openText(infile)
+    for line in fh:
+        line = line.strip()
+        if line.startswith("#"):
+            continue
+        fields = line.split(sep)
+        keys.append(variantKey(fields[inds[0]].strip(), fields[inds[1]].strip()))
+    fh.close()
+
+    jobVariants = keys
+    jobVariantsSource = None
+    return len(keys)
+
+
+def insertJobVariants(cursor, values):
+    cursor.execute(
+        "insert into "
+        + JOB_VARIANTS_TABLE
+        + " (line_no, chrom, pos, ref, alt) values "
+        + ",".join(values)
+        + ";"
+    )
+
+
+class WindowedLookup(object):
+    """
+    Rows of a table overlapping each variant of the job (jobVariants),
+    resolved for a window of variants at a time by resolve(first), which
+    fills found (line number -> rows) for the lines first..windowEnd - 1.
+
+    Lookups must follow input order, as they do in every stage; a variant
+    the stage skips is simply never asked for. Repeating the last lookup
+    returns the same rows. The chromosome naming of the table ("chr" or
+    not) is taken from the first lookup.
+    """
+
+    def __init__(self, table, window):
+        if jobVariants is None:
+            raise ValueError("Windowed lookups need the job's variants (see driver.prepareJob)")
+        self.keys = jobVariants
+        self.table = table
+        self.window = window
+        self.chrom = None
+        self.prefix = None
+        self.line = -1
+        self.rows = []
+        self.windowEnd = 0
+        self.found = {}
+
+    def fetchall(self, chrom, pos):
+        key = variantKey(chrom, pos)
+        if self.line >= 0 and self.keys[self.line] == key:
+            return self.rows
+
+        i = self.line + 1
+        while i < len(self.keys) and self.keys[i] != key:
+            i = i + 1
+        if i == len(self.keys):
+            raise ValueError(
+                f"{self.table}: {chrom}:{pos} is not a variant of the job after line {self.line}"
+            )
+
+        if self.prefix is None:
+            self.prefix = "chr" if str(chrom).startswith("chr") else ""
+            self.chrom = key[0]
+        if i >= self.windowEnd:
+            self.resolve(i)
+        self.line = i
+        self.rows = self.found.get(i, [])
+        return self.rows
+
+    def fetchone(self, chrom, pos):
+        rows = self.fetchall(chrom, pos)
+        if len(rows) == 0:
+            return None
+        return rows[0]
+
+    def close(self):
+        pass
+
+
+class JoinLookup(WindowedLookup):
+    """
+    Rows of table overlapping each variant of the job, resolved with one
+    set-based join per JOIN_WINDOW variants instead of one query per
+    variant. The join is driven from the variants (straight_join) so it
+    walks them in line order and probes the table's index for each one:
+    matches come back in the order a per-variant query returns them.
+
+    offset widens the intervals on both sides (refGene promoters); a
+    table without a chromosome column (chromCol None, e.g.
+    tfbsConsSites<n>) holds the chromosome of the first lookup.
+    """
+
+    def __init__(
+        self,
+        cursor,
+        table,
+        chromCol="chrom",
+        startCol="chromStart",
+        endCol="chromEnd",
+        offset=0,
+        window=JOIN_WINDOW,
+    ):
+        WindowedLookup.__init__(self, table, window)
+        self.cursor = cursor
+        self.chromCol = chromCol
+        self.startCol = startCol
+        self.endCol = endCol
+        self.offset = int(offset)
+        self.columns = None
+
+    def column(self, name):
+        return self.columns.index(name)
+
+    def resolve(self, first):
+        ensureJobVariants()
+        last = first + self.window
+        if self.chromCol is None:
+            chromMatch = 'v.chrom = "' + clean_mysql_chars(self.chrom) + '"'
+        elif self.prefix == "":
+            chromMatch = "r." + self.chromCol + " = v.chrom"
+        else:
+            chromMatch = "r." + self.chromCol + ' = concat("' + self.prefix + '", v.chrom)'
+
+        sql = (
+            "select v.line_no, r.* from "
+            + JOB_VARIANTS_TABLE
+            + " v straight_join "
+            + self.table
+            + " r on "
+            + chromMatch
+            + " AND r."
+            + self.startCol
+            + " <= v.pos + "
+            + str(self.offset)
+            + " AND v.pos - "
+            + str(self.offset)
+            + " <= r."
+            + self.endCol
+            + " where v.line_no >= "
+            + str(first)
+            + " AND v.line_no < "
+            + str(last)
+            + " order by v.line_no;"
+        )
+        self.cursor.execute(sql)
+        self.columns = [str(d[0]) for d in self.cursor.description[1:]]
+
+        self.found = {}
+        for row in self.cursor.fetchall():
+            self.found.setdefault(int(row[0]), []).append(tuple(row[1:]))
+        self.windowEnd = last
+
+
+class BatchLookup(WindowedLookup):
+    """
+    Lookups of an in-memory table (IntervalIndex or snapshot table)
+    answered BATCH_SEARCH_WINDOW variants at a time: the positions of a
+    window are searched per chromosome with one vectorized call (see
+    ii.findBatch) instead of one bisect walk per variant. Matches are in
+    the order index.fetchall returns them.
+    """
+
+    def __init__(self, index, table, window=BATCH_SEARCH_WINDOW):
+        WindowedLookup.__init__(self, table, window)
+        self.index = index
+        self.columns = index.columns
+        self.arrays = {}
+
+    def column(self, name):
+        return self.index.column(name)
+
+    def _chromosome(self, chrom):
+        if chrom not in self.arrays:
+            arrays = self.index.chromosome(chrom)
+            if arrays is not None:
+                starts, ends, bins, rows = arrays
+                arrays = (
+                    np.asarray(starts, dtype=np.int64),
+                    np.asarray(ends, dtype=np.int64),
+                    [
+                        (
+                            span,
+                            np.asarray(binStarts, dtype=np.int64),
+                            np.asarray(members, dtype=np.int64),
+                        )
+                        for span, binStarts, members in bins
+                    ],
+                    rows,
+                )
+            self.arrays[chrom] = arrays
+        return self.arrays[chrom]
+
+    def resolve(self, first):
+        last = min(first + self.window, len(self.keys))
+        lines = {}
+        for i in range(first, last):
+            lines.setdefault(self.keys[i][0], []).append(i)
+
+        self.found = {}
+        for chrom, numbers in lines.items():
+            arrays = self._chromosome(self.prefix + chrom)
+            if arrays is None:
+                continue
+            starts, ends, bins, rows = arrays
+            positions = np.array([self.keys[i][1] for i in numbers], dtype=np.int64)
+            offsets, hits = ii.findBatch(starts, ends, bins, positions)
+            for k in np.flatnonzero(offsets[1:] > offsets[:-1]):
+                self.found[numbers[k]] = [
+                    rows[j] for j in hits[offsets[k] : offsets[k + 1]].tolist()
+                ]
+        self.windowEnd = last
+
+    def close(self):
+        self.index.close()
+
+
+"""Site of a record: (CHROM without "chr", POS, REF, ALT)
+"""
+
+
+def siteKey(fields, inds):
+    chr = fields[inds[0]].strip()
+    if chr.startswith("chr"):
+        chr = chr[3:]
+    return (
+        chr,
+        fields[inds[1]].strip(),
+        fields[inds[2]].strip(),
+        fields[inds[3]].strip(),
+    )
+
+
+"""Sites occurring more than once in the job, with their number of
+   records, once counted by findRepeatedSites; keyed by hash(site)
+"""
+
+repeatedSites = None
+
+
+"""Pre-pass over infile counting the records of every site; keeps the
+   repeated ones in repeatedSites and returns how many records repeat an
+   earlier site
+"""
+
+
+def findRepeatedSites(infile, format="vcf", sep="\t"):
+    global repeatedSites
+
+    inds = getFormatSpecificIndices(format=format)
+    counts = {}
+    fh = fu.openText(infile)
+    for line in fh:
+        line = line.strip()
+        if line.startswith("#"):
+            continue
+        h = hash(siteKey(line.split(sep), inds))
+        counts[h] = counts.get(h, 0) + 1
+    fh.close()
+
+    repeatedSites = dict([(h, n) for h, n in counts.items() if n > 1])
+    return sum(repeatedSites.values()) - len(repeatedSites)
+
+
+class SiteMemo(object):
+    """
+    Per-stage memo of the lookups of repeated sites (see repeatedSites).
+
+    The stage calls visit() for every record; while the record's site is a
+    repeated one, queries through memo.cursor() and lookups through
+    memo.lookup() are answered from the results of its first record. A
+    site's results are dropped after its last record, and records of
+    unique sites go straight to the database. The stage still processes
+    every record, so its counts are unchanged.
+
+    With the host's site cache (see site_cache.py) and an engine that
+    queries per variant, the lookups of every site are also answered from
+    the sites earlier jobs looked up in tables (the tables the stage
+    reads through the memo), and added to it.
+    """
+
+    def __init__(self, engine="sql", tables=None):
+        self.engine = engine
+        self.remaining = {} if repeatedSites is None else dict(repeatedSites)
+        self.results = {}
+        self.site = None
+        self.done = None
+        self.cache = None
+        if sc.active is not None and tables is not None and engine in sc.CACHED_ENGINES:
+            self.cache = sc.active.stage(tables, engine)
+
+    def visit(self, fields, inds):
+        if self.done is not None:
+            self.results.pop(self.done, None)
+            self.done = None
+        self.site = None
+        if self.cache is not None:
+            self.cache.visit(siteKey(fields, inds))
+        if len(self.remaining) == 0:
+            return
+
+        site = siteKey(fields, inds)
+        h = hash(site)
+        if h not in self.remaining:
+            return
+        self.site = site
+        self.remaining[h] = self.remaining[h] - 1
+        if self.remaining[h] == 0:
+            del self.remaining[h]
+            self.done = site
+
+    def recall(self, query, fetch):
+        if self.cache is not None:
+            fetch = self.cached(query, fetch)
+        if self.site is None:
+            return fetch()
+        results = self.results.setdefault(self.site, {})
+        if query not in results:
+            results[query] = fetch()
+        return results[query]
+
+    def cached(self, query, fetch):
+        return lambda: self.cache.recall(query, fetch)
+
+    def cursor(self, cursor):
+        if cursor is None or (len(self.remaining) == 0 and self.cache is None):
+            return cursor
+        return MemoCursor(self, cursor)
+
+    def lookup(self, lookup):
+        # In-memory lookups are as cheap as the memo
+        if self.engine in ["index", "snapshot"] or (
+            len(self.remaining) == 0 and self.cache is None
+        ):
+            return lookup
+        return MemoLookup(self, lookup)
+
+
+class MemoCursor(object):
+    """
+    Cursor answering repeated queries of a site from its SiteMemo
+    """
+
+    def __init__(self, memo, cursor):
+        self.memo = memo
+        self.cursor = cursor
+        self.rows = []
+
+    def _fetch(self, sql):
+        self.cursor.execute(sql)
+        return self.cursor.fetchall()
+
+    def execute(self, sql):
+        self.rows = self.memo.recall(sql, lambda: self._fetch(sql))
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        if len(self.rows) == 0:
+            return None
+        return self.rows[0]
+
+    def close(self):
+        self.cursor.close()
+
+
+class MemoLookup(object):
+    """
+    Range lookup answering repeated lookups of a site from its SiteMemo
+    """
+
+    def __init__(self, memo, lookup):
+        self.memo = memo
+        self.lookup = lookup
+        # The same across jobs, for the site cache
+        self.name = getattr(lookup, "table", id(self))
+
+    def __getattr__(self, name):
+        return getattr(self.lookup, name)
+
+    def fetchall(self, chrom, pos):
+        return self.memo.recall(
+            (self.name, chrom, pos), lambda: self.lookup.fetchall(chrom, pos)
+        )
+
+    def fetchone(self, chrom, pos):
+        rows = self.fetchall(chrom, pos)
+        if len(rows) == 0:
+            return None
+        return rows[0]
+
+
+"""Interval indexes kept for the life of the process, when not None; set
+   in the workers of a parallel run, which annotate several shards each
+"""
+
+indexCache = None
+
+
+"""Returns a lookup answering "which rows of table contain chrom:pos"
+   engine must be one of ENGINES; the sweep engine needs the queries to
+   come in coordinate order (see fu.isCoordinateSorted)
+"""
+
+
+def getRangeLookup(
+    cursor,
+    table,
+    chromCol="chrom",
+    startCol="chromStart",
+    endCol="chromEnd",
+    engine="sql",
+):
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown annotation engine: {engine}")
+
+    if engine == "index":
+        key = (table, chromCol, startCol, endCol)
+        if indexCache is not None and key in indexCache:
+            index = indexCache[key]
+        # Tables matched on an exact position need no interval search
+        elif startCol == endCol:
+            index = ii.loadPositionIndex(cursor, table, chromCol, startCol)
+        else:
+            index = ii.loadIntervalIndex(cursor, table, chromCol, startCol, endCol)
+        if indexCache is not None:
+            indexCache[key] = index
+        return batchLookup(index, table)
+    elif engine == "snapshot":
+        return batchLookup(sn.currentSnapshot().table(table), table)
+    elif engine == "join":
+        return JoinLookup(cursor, table, chromCol, startCol, endCol)
+    elif engine == "sweep":
+        # Unbuffered reads need a connection of their own
+        conn = u.db_connect(shared=False)
+        return ii.SweepLookup(
+            lambda: pr.profileCursor(u.db_stream_cursor(conn)),
+            table,
+            chromCol,
+            startCol,
+            endCol,
+            conn,
+        )
+    return SqlRangeLookup(cursor, table, chromCol, startCol, endCol)
+
+
+"""BatchLookup over an in-memory table when the job's variants are
+   known (see readJobVariants); the table itself otherwise
+"""
+
+
+def batchLookup(index, table):
+    if jobVariants is None or not isinstance(index, ii.IntervalIndex):
+        return index
+    return BatchLookup(index, table)
+
+
+"""Database connection and cursor for a stage; (None, None) when the
+   engine does not need the database
+"""
+
+
+def stageConnection(engine="sql"):
+    if engine == "snapshot":
+        return None, None
+    conn = u.db_connect()
+    return conn, pr.profileCursor(conn.cursor())
+
+
+def closeConnection(conn):
+    if conn is not None:
+        conn.close()
+
+
+"""Selected columns of a snapshot row, like "select <columns> from ..."
+"""
+
+
+def projectRow(table, row, columns):
+    return tuple([row[table.column(c)] for c in columns])
+
+
+"""Every stage is a generator: stream<Stage>(lines, fh_log, ...) takes
+   VCF lines, yields the annotated lines (without newline) and appends its
+   counts to fh_log once its input is exhausted. Stages can therefore be
+   chained and the whole pipeline run in a single pass (see driver.py).
+
+   runStage runs one stage over vcf + tmpextin and writes vcf + tmpextout,
+   which is what the file-based functions below do.
+"""
+
+
+def runStage(stage, vcf, tmpextin, tmpextout, logmode="a", **kwargs):
+    fh = fu.openText(vcf + tmpextin)
+    fh_out = open(vcf + tmpextout, "w")
+    fh_log = open(vcf + ".count.log", logmode)
+
+    for line in stage(fh, fh_log, **kwargs):
+        fh_out.write(str(line) + "\n")
+
+    fh_log.close()
+    fh.close()
+    fh_out.close()
+
+
+"""Adds the dbSNP rows matching one variant to its record
+   Returns True if there was a match
+"""
+
+
+def addDbSnpRows(record, rows, varclass="SNV"):
+    fields = record.fields
+    fields[2] = "."
+    rsids = []
+    mafs = []
+    if len(rows) > 0:
+        for row in rows:
+            rsids.append(str(row[3]))
+            if str(row[7]) != ".":
+                mafs.append("GMAF=" + str(row[7]))
+
+        maf_str = ""
+        if len(mafs) > 0:
+            maf_str = ";" + ";".join([str(x) for x in mafs])
+
+        if str(record.info()) == ".":
+            record.setInfo("DB" + maf_str)
+        else:
+            record.addInfo(";DB;VC=" + varclass + maf_str)
+
+        fields[2] = str(";".join(rsids))
+        return True
+
+    ## reset rsid to "." - in case there was annotation from old release of dbSNP
+    return False
+
+
+"""Resolves a window of variants against dbSNP in one round trip
+   variants is a list of (chr, pos, ref, compRef); returns one list of
+   rows per variant, in input order and with the same REF filter as the
+   per-variant query
+"""
+
+
+def fetchDbSnpBatch(cursor, variants, varclass="SNV"):
+    keys = []
+    seen = set()
+    for chr, pos, ref, compRef in variants:
+        key = (str(chr).upper(), int(pos))
+        # Sites the dbSNP filter rules out are not asked for
+        if key not in seen and bl.mightContain(chr, pos):
+            seen.add(key)
+            keys.append('("' + clean_mysql_chars(str(chr)) + '",' + str(key[1]) + ")")
+    if len(keys) == 0:
+        return [[] for _ in variants]
+
+    sql = (
+        'select * from dbSNP where INFO = "'
+        + varclass
+        + '" AND (CHR, POS) IN ('
+        + ",".join(keys)
+        + ");"
+    )
+    cursor.execute(sql)
+    names = [str(d[0]).upper() for d in cursor.description]
+    chr_ind = names.index("CHR")
+    pos_ind = names.index("POS")
+    ref_ind = names.index("REF")
+
+    # Rows per (CHR, POS) in the order the server returned them
+    found = {}
+    for row in cursor.fetchall():
+        key = (str(row[chr_ind]).upper(), int(row[pos_ind]))
+        found.setdefault(key, []).append(row)
+
+    # MySQL string comparison is case-insensitive; so is this REF filter
+    results = []
+    for chr, pos, ref, compRef in variants:
+        refs = (str(ref).upper(), str(compRef).upper())
+        rows = found.get((str(chr).upper(), int(pos)), [])
+        results.append([r for r in rows if str(r[ref_ind]).upper() in refs])
+    return results
+
+
+"""Annotates a pending window of dbSNP records with one batched query
+   Records in pending are annotated in place; returns the number of
+   records found in dbSNP
+"""
+
+
+def annotateDbSnpWindow(cursor, pending, variants, varclass="SNV"):
+    results = fetchDbSnpBatch(cursor, variants, varclass)
+    found = 0
+    k = 0
+    for i in range(0, len(pending)):
+        if isinstance(pending[i], rec.VariantRecord):
+            if addDbSnpRows(pending[i], results[k], varclass):
+                found = found + 1
+            k = k + 1
+    return found
+
+
+"""dbSNP rows for one variant from the reference snapshot, filtered as
+   by the per-variant query
+"""
+
+
+def fetchDbSnpSnapshot(chr, pos, ref, compRef, varclass="SNV"):
+    table = sn.currentSnapshot().table("dbSNP")
+    ref_ind = table.column("REF")
+    info_ind = table.column("INFO")
+    refs = (str(ref).upper(), str(compRef).upper())
+    return [
+        row
+        for row in table.fetchall(str(chr), pos)
+        if str(row[info_ind]) == varclass and str(row[ref_ind]).upper() in refs
+    ]
+
+
 """"Format must be pileup or vcf
     Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+
+    With the sql engine every variant is a separate query and with the
+    snapshot engine a lookup in the snapshot. Otherwise variants are
+    resolved batch_size at a time with one query per window (dbSNP is too
+    large to load per job, so this is also what the index engine does).
+    With the dbSNP filter (see bloom.py), sites it rules out are not
+    queried.
 """
 
 
-def getSnpsFromDbSnp(
-    vcf, format="vcf", tmpextin="", tmpextout=".1", varclass="SNV", sep="\t"
+def streamSnpsFromDbSnp(
+    lines,
+    fh_log,
+    format="vcf",
+    varclass="SNV",
+    sep="\t",
+    engine="sql",
+    batch_size=5000,
 ):
 
-    outfile = vcf + tmpextout
-    fh_out = open(outfile, "w")
-    logcountfile = vcf + ".count.log"
-    fh_log = open(logcountfile, "w")
     var_count = 0
 
     inds = getFormatSpecificIndices(format=format)
 
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    conn, cursor = stageConnection(engine)
+    memo = SiteMemo(engine, ["dbSNP"])
+    if engine == "sql":
+        # Windowed lookups already resolve each site once per window
+        cursor = memo.cursor(cursor)
     linenum = 1
 
-    for line in fh:
+    # Pending window: header lines are kept as strings, records as
+    # VariantRecords, so output order is preserved
+    pending = []
+    variants = []
+
+    for line in lines:
         line = line.strip()
         if not line.startswith("#"):
-            fields = line.split(sep)
+            record = rec.parse(line, sep)
+            fields = record.fields
+            memo.visit(fields, inds)
             chr = fields[inds[0]].strip()
             if chr.startswith("chr"):
                 chr = chr.replace("chr", "")
@@ -184,6 +1035,28 @@ def getSnpsFromDbSnp(
             compRef = getComplementary(ref)
             compAlt = getComplementary(alt)
 
+            linenum = linenum + 1
+
+            if engine == "snapshot":
+                rows = fetchDbSnpSnapshot(chr, pos, ref, compRef, varclass)
+                if addDbSnpRows(record, rows, varclass):
+                    var_count = var_count + 1
+                yield record
+                continue
+
+            if engine != "sql":
+                pending.append(record)
+                variants.append((chr, pos, ref, compRef))
+                if len(variants) >= batch_size:
+                    var_count = var_count + annotateDbSnpWindow(
+                        cursor, pending, variants, varclass
+                    )
+                    for l in pending:
+                        yield l
+                    pending = []
+                    variants = []
+                continue
+
             sql = (
                 'select * from dbSNP where CHR="'
                 + str(chr)
@@ -197,51 +1070,164 @@ def getSnpsFromDbSnp(
                 + varclass
                 + '" ;'
             )
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-
-            fields[2] = "."
-            rsids = []
-            mafs = []
-            if len(rows) > 0:
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if str(row[7]) != ".":
-                        mafs.append("GMAF=" + str(row[7]))
-
-                maf_str = ""
-                if len(mafs) > 0:
-                    maf_str = ";" + ";".join([str(x) for x in mafs])
-
-                var_count = var_count + 1
-                if str(fields[7]) == ".":
-                    fields[7] = "DB" + maf_str
-                else:
-                    fields[7] = fields[7] + ";DB;VC=" + varclass + maf_str
-
-                fields[2] = str(";".join(rsids))
-                l = "\t".join([str(x) for x in fields])
-                fh_out.write(l + "\n")
-
+            if bl.mightContain(chr, pos):
+                cursor.execute(sql)
+                rows = cursor.fetchall()
             else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write("\t".join([str(x) for x in fields]) + "\n")
+                rows = []
 
-            linenum = linenum + 1
+            if addDbSnpRows(record, rows, varclass):
+                var_count = var_count + 1
+            yield record
 
+        elif len(pending) > 0:
+            pending.append(line)
         else:
-            fh_out.write(line + "\n")
+            yield line
+
+    if len(variants) > 0:
+        var_count = var_count + annotateDbSnpWindow(cursor, pending, variants, varclass)
+    for l in pending:
+        yield l
 
     ratioInDbSnp = (var_count / float(linenum)) * 100
     fh_log.write("## Please notice that all Isoforms were counted\n")
     fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
     fh_log.write(f"Total: {str(linenum)}\n")
     fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    if bl.active is not None:
+        checked, skipped = bl.active.takeCounts()
+        print(f"dbSNP filter: {skipped} of {checked} sites ruled out")
+    closeConnection(conn)
+
+
+"""File-based form of streamSnpsFromDbSnp
+"""
+
+
+def getSnpsFromDbSnp(
+    vcf,
+    format="vcf",
+    tmpextin="",
+    tmpextout=".1",
+    varclass="SNV",
+    sep="\t",
+    engine="sql",
+    batch_size=5000,
+):
+    runStage(
+        streamSnpsFromDbSnp,
+        vcf,
+        tmpextin,
+        tmpextout,
+        logmode="w",
+        format=format,
+        varclass=varclass,
+        sep=sep,
+        engine=engine,
+        batch_size=batch_size,
+    )
+
+
+"""bigRefGene rows at chr:pos from a lookup (see LOOKUP_ENGINES); for
+   chrom_pos_equal_base also matching the haplotypes like the query does
+"""
+
+
+def fetchBigRefGeneRows(
+    table, chr, pos, ref=None, alt=None, compRef=None, compAlt=None
+):
+    rows = table.fetchall(str(chr), pos)
+    if ref is None:
+        return rows
+
+    ref_ind = table.column("haplotypeReference")
+    alt_ind = table.column("haplotypeAlternate")
+    haplotypes = [
+        (str(ref).upper(), str(alt).upper()),
+        (str(compRef).upper(), str(compAlt).upper()),
+    ]
+    return [
+        row
+        for row in rows
+        if (str(row[ref_ind]).upper(), str(row[alt_ind]).upper()) in haplotypes
+    ]
+
+
+"""The bigRefGene tables in order of precedence: (table, end column)
+"""
+
+BIGREFGENE_TABLES = [
+    ("chrom_pos_equal_base", "start"),
+    ("chrom_pos_equal_nobase", "start"),
+    ("chrom_pos_unequal", "end"),
+]
+
+# Collapsed bigRefGene rows kept for reuse by later variants
+COLLAPSE_CACHE = 100000
+
+
+class BigRefGeneLookup(object):
+    """
+    Resolves a variant against the three bigRefGene tables in one probe,
+    with the precedence of the query cascade: chrom_pos_equal_base rows
+    with the variant's haplotypes, else chrom_pos_equal_nobase rows at its
+    position, else chrom_pos_unequal rows overlapping it. The exact-position
+    tables are hash lookups with the index engine (see getRangeLookup).
+    """
+
+    def __init__(self, equalBase, equalNobase, unequal):
+        self.equalBase = equalBase
+        self.equalNobase = equalNobase
+        self.unequal = unequal
+
+    def fetch(self, chr, pos, ref, alt, compRef, compAlt):
+        rows = fetchBigRefGeneRows(self.equalBase, chr, pos, ref, alt, compRef, compAlt)
+        if len(rows) == 0:
+            rows = self.equalNobase.fetchall(str(chr), pos)
+        if len(rows) == 0:
+            rows = self.unequal.fetchall(str(chr), pos)
+        return rows
+
+
+"""BigRefGeneLookup for the engines answering bigRefGene in process (index
+   and LOOKUP_ENGINES), or None to run the query cascade
+"""
+
+
+def getBigRefGeneLookup(cursor, engine, memo):
+    if engine != "index" and engine not in LOOKUP_ENGINES:
+        return None
+    tables = [
+        memo.lookup(getRangeLookup(cursor, table, "CHR", "start", endCol, engine))
+        for table, endCol in BIGREFGENE_TABLES
+    ]
+    return BigRefGeneLookup(*tables)
+
+
+"""Adds the collapsed bigRefGene rows of a variant to its INFO field
+   collapsed maps rows already collapsed to their INFO entries
+"""
+
+
+def addBigRefGeneRows(record, rows, collapsed):
+    if len(collapsed) > COLLAPSE_CACHE:
+        collapsed.clear()
+
+    m = set([])
+    for row in rows:
+        line = "\t".join([str(x) for x in row[1 : len(row)]])
+        if line not in collapsed:
+            collapsed[line] = collapseRefSeq(line)
+        m.add(collapsed[line])
+
+    record.addInfo(";" + ";".join(m))
+    info = str(record.info())
+    if info.startswith(".;"):
+        record.setInfo(info.replace(".;", "", 1))
+
+    return record
 
 
 """NOTE: all isoforms are collapsed in one record
@@ -251,22 +1237,28 @@ def getSnpsFromDbSnp(
 """
 
 
-def getBigRefGene(vcf, format="vcf", tmpextin=".1", tmpextout=".2", sep="\t"):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
+def streamBigRefGene(
+    lines,
+    fh_log,
+    format="vcf",
+    sep="\t",
+    engine="sql",
+):
     inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
 
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    conn, cursor = stageConnection(engine)
+    memo = SiteMemo(engine, [table for table, _ in BIGREFGENE_TABLES])
+    bigRefGene = getBigRefGeneLookup(cursor, engine, memo)
+    cursor = memo.cursor(cursor)
+    collapsed = {}
     vcf_linenum = 1
 
-    for line in fh:
+    for line in lines:
         line = line.strip()
         if not line.startswith("#"):
-            fields = line.split(sep)
+            record = rec.parse(line, sep)
+            fields = record.fields
+            memo.visit(fields, inds)
             chr = fields[inds[0]].strip()
             if chr.startswith("chr"):
                 chr = chr.replace("chr", "")
@@ -278,136 +1270,188 @@ def getBigRefGene(vcf, format="vcf", tmpextin=".1", tmpextout=".2", sep="\t"):
             compRef = getComplementary(ref)
             compAlt = getComplementary(alt)
 
-            sql1 = (
-                'select * from chrom_pos_equal_base where CHR="'
-                + str(chr)
-                + '" AND start = '
-                + str(pos)
-                + ' AND ((haplotypeReference="'
-                + str(ref)
-                + '" AND haplotypeAlternate ="'
-                + str(alt)
-                + '") OR (haplotypeReference="'
-                + str(compRef)
-                + '" AND haplotypeAlternate ="'
-                + str(compAlt)
-                + '"));'
-            )
+            if bigRefGene is not None:
+                rows = bigRefGene.fetch(chr, pos, ref, alt, compRef, compAlt)
+            else:
+                sql1 = (
+                    'select * from chrom_pos_equal_base where CHR="'
+                    + str(chr)
+                    + '" AND start = '
+                    + str(pos)
+                    + ' AND ((haplotypeReference="'
+                    + str(ref)
+                    + '" AND haplotypeAlternate ="'
+                    + str(alt)
+                    + '") OR (haplotypeReference="'
+                    + str(compRef)
+                    + '" AND haplotypeAlternate ="'
+                    + str(compAlt)
+                    + '"));'
+                )
 
-            sql2 = (
-                'select * from chrom_pos_equal_nobase where CHR="'
-                + str(chr)
-                + '" AND start = '
-                + str(pos)
-                + ";"
-            )
+                sql2 = (
+                    'select * from chrom_pos_equal_nobase where CHR="'
+                    + str(chr)
+                    + '" AND start = '
+                    + str(pos)
+                    + ";"
+                )
 
-            sql3 = (
-                'select * from chrom_pos_unequal where CHR="'
-                + str(chr)
-                + '" AND start <= '
-                + str(pos)
-                + " AND "
-                + str(pos)
-                + " <= end ;"
-            )
+                sql3 = (
+                    'select * from chrom_pos_unequal where CHR="'
+                    + str(chr)
+                    + '" AND start <= '
+                    + str(pos)
+                    + " AND "
+                    + str(pos)
+                    + " <= end ;"
+                )
 
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
+                cursor.execute(sql1)
+                rows = cursor.fetchall()
+                if len(rows) == 0:
+                    cursor.execute(sql2)
+                    rows = cursor.fetchall()
+                if len(rows) == 0:
+                    cursor.execute(sql3)
+                    rows = cursor.fetchall()
 
             if len(rows) > 0:
-                keep_going = False
-                m = set([])
-                for row in rows:
-                    m.add(
-                        collapseRefSeq("\t".join([str(x) for x in row[1 : len(row)]]))
-                    )
-
-                fields[7] = fields[7] + ";" + ";".join(m)
-                if str(fields[7]).startswith(".;"):
-                    fields[7] = str(fields[7]).replace(".;", "", 1)
+                yield addBigRefGeneRows(record, rows, collapsed)
+            else:
+                yield record
 
-                l = "\t".join([str(x) for x in fields])
-                fh_out.write(l + "\n")
+            vcf_linenum = vcf_linenum + 1
 
-            if keep_going:
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
+        else:
+            yield line
 
-                if len(rows) > 0:
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(
-                            collapseRefSeq(
-                                "\t".join([str(x) for x in row[1 : len(row)]])
-                            )
-                        )
+    closeConnection(conn)
 
-                    fields[7] = fields[7] + ";" + ";".join(m)
-                    if str(fields[7]).startswith(".;"):
-                        fields[7] = str(fields[7]).replace(".;", "", 1)
 
-                    l = "\t".join([str(x) for x in fields])
-                    fh_out.write(l + "\n")
+"""File-based form of streamBigRefGene
+"""
 
-            if keep_going:
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
 
-                if len(rows) > 0:
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(
-                            collapseRefSeq(
-                                "\t".join([str(x) for x in row[1 : len(row)]])
-                            )
-                        )
+def getBigRefGene(
+    vcf,
+    format="vcf",
+    tmpextin=".1",
+    tmpextout=".2",
+    sep="\t",
+    engine="sql",
+):
+    runStage(
+        streamBigRefGene,
+        vcf,
+        tmpextin,
+        tmpextout,
+        format=format,
+        sep=sep,
+        engine=engine,
+    )
 
-                    fields[7] = fields[7] + ";" + ";".join(m)
-                    if str(fields[7]).startswith(".;"):
-                        fields[7] = str(fields[7]).replace(".;", "", 1)
 
-                    l = "\t".join([str(x) for x in fields])
-                    fh_out.write(l + "\n")
+"""Region track of the transcripts of table and of cpgIslandExt (see
+   region_track.py), filled one chromosome at a time by regionAt; kept in
+   indexCache when set, like the interval indexes
+"""
 
-            if keep_going:
-                fh_out.write(line + "\n")
 
-            vcf_linenum = vcf_linenum + 1
+def getRegionTrack(table="refGene", promoter_offset=500):
+    key = ("regionTrack", table, int(promoter_offset))
+    if indexCache is not None and key in indexCache:
+        return indexCache[key]
+    track = rt.RegionTrack(promoter_offset)
+    if indexCache is not None:
+        indexCache[key] = track
+    return track
+
+
+"""Classes and first CpG island row (chrom, chromStart, chromEnd, name)
+   of chr:pos; the first lookup on a chromosome loads the whole chromosome
+   into the track, from the snapshot when cursor is None
+"""
+
 
+def regionAt(track, cursor, table, chr, pos):
+    if not track.hasChromosome(chr):
+        if cursor is None:
+            transcripts, islands = snapshotRegions(table, chr)
         else:
-            fh_out.write(line + "\n")
+            cursor.execute(
+                "select txStart, txEnd from " + table + ' where chrom="' + str(chr) + '";'
+            )
+            transcripts = [(int(row[0]), int(row[1])) for row in cursor.fetchall()]
+            cursor.execute(
+                "select chrom, chromStart, chromEnd, name from "
+                + 'cpgIslandExt where chrom="'
+                + str(chr)
+                + '";'
+            )
+            islands = [(int(row[1]), int(row[2]), row) for row in cursor.fetchall()]
+        track.addChromosome(chr, transcripts, islands)
+    return track.classify(chr, pos)
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+
+"""First CpG island row (chrom, chromStart, chromEnd, name) containing
+   chr:pos, queried when the region track does not hold chr yet
+"""
+
+
+def cpgIslandAt(cursor, chr, pos):
+    cursor.execute(
+        "select chrom, chromStart, chromEnd, name from "
+        + 'cpgIslandExt where chrom="'
+        + str(chr)
+        + '" AND (chromStart <= '
+        + str(pos)
+        + " AND "
+        + str(pos)
+        + " <= chromEnd);"
+    )
+    return cursor.fetchone()
+
+
+"""(txStart, txEnd) of the transcripts of table and (start, end, row) of
+   the CpG islands on chr, from the current snapshot
+"""
+
+
+def snapshotRegions(table, chr):
+    snapshot = sn.currentSnapshot()
+    transcripts = []
+    genes = snapshot.table(table)
+    arrays = genes.chromosome(chr)
+    if arrays is not None:
+        for row in arrays[3]:
+            txStart, txEnd = projectRow(genes, row, ["txStart", "txEnd"])
+            transcripts.append((int(txStart), int(txEnd)))
+
+    islands = []
+    cpg = snapshot.table("cpgIslandExt")
+    arrays = cpg.chromosome(chr)
+    if arrays is not None:
+        for i in range(0, len(arrays[3])):
+            row = projectRow(cpg, arrays[3][i], ["chrom", "chromStart", "chromEnd", "name"])
+            islands.append((int(row[1]), int(row[2]), row))
+    return transcripts, islands
 
 
 """Get information about location in gene structures
 """
 
 
-def getGenes(
-    vcf,
+def streamGenes(
+    lines,
+    fh_log,
     format="vcf",
     table="refGene",
     promoter_offset=500,
-    tmpextin=".2",
-    tmpextout=".3",
     sep="\t",
+    engine="sql",
 ):
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-
     interGenic_count = 0
     cds_count = 0
     utr3_count = 0
@@ -419,15 +1463,30 @@ def getGenes(
     promoter_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    conn, cursor = stageConnection(engine)
+    if engine == "snapshot":
+        genes = sn.currentSnapshot().table(table)
+    elif engine == "join":
+        genes = JoinLookup(cursor, table, "chrom", "txStart", "txEnd", promoter_offset)
+    # Variants outside every query window skip the lookup, and promoters
+    # take their CpG island from the track, once it holds the chromosome
+    track = getRegionTrack(table, promoter_offset)
+    trackCursor = cursor
+    chromVariants = {}
+    # Promoters are looked up in cpgIslandExt through the memo cursor too
+    memo = SiteMemo(engine, [table, "cpgIslandExt"])
+    if engine == "join":
+        genes = memo.lookup(genes)
+    cursor = memo.cursor(cursor)
+    transcripts = tx.TranscriptCache()
     linenum = 1
 
-    for line in fh:
+    for line in lines:
         line = line.strip()
         if not line.startswith("#"):
-            fields = line.split(sep)
+            record = rec.parse(line, sep)
+            fields = record.fields
+            memo.visit(fields, inds)
             chr = fields[inds[0]].strip()
 
             if not chr.startswith("chr"):
@@ -436,7 +1495,7 @@ def getGenes(
             pos = fields[inds[1]].strip()
             ref = clean_mysql_chars(fields[inds[2]]).strip()
             alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
+            info_field = clean_mysql_chars(record.info()).strip()
             this_gene_name = str(u.parse_field(info_field, "name", ";", "="))
 
             sql = (
@@ -455,8 +1514,26 @@ def getGenes(
                 + ");"
             )
 
-            cursor.execute(sql)
-            rows = cursor.fetchall()
+            classes = None
+            island = None
+            chromVariants[chr] = chromVariants.get(chr, 0) + 1
+            if (
+                engine in REGION_TRACK_ENGINES
+                or track.hasChromosome(chr)
+                or chromVariants[chr] >= REGION_TRACK_VARIANTS
+            ):
+                classes, island = regionAt(track, trackCursor, table, chr, pos)
+            if classes is not None and not classes & rt.WINDOW:
+                rows = []
+            elif engine == "snapshot":
+                rows = genes.fetchoverlap(
+                    chr, int(pos) - int(promoter_offset), int(pos) + int(promoter_offset)
+                )
+            elif engine == "join":
+                rows = genes.fetchall(chr, pos)
+            else:
+                cursor.execute(sql)
+                rows = cursor.fetchall()
             info = []
 
             if len(rows) > 0:
@@ -480,89 +1557,62 @@ def getGenes(
                     elif positionType == "utr3":
                         utr3_count = utr3_count + 1
 
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts = str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
+                    model = transcripts.model(row)
+                    txtStart = model.txStart
+                    txtEnd = model.txEnd
+                    cdsStart = model.cdsStart
+                    cdsEnd = model.cdsEnd
+                    exonCount = model.exonCount
+                    geneSymbol = model.geneSymbol
+                    strand = model.strand
 
                     promoter_plus = txtStart - int(promoter_offset)
                     promoter_minus = txtEnd + int(promoter_offset)
                     region = ""
                     pos = int(pos)
                     exons = []
-                    exonsSt = exonStarts.split(",")
-                    exonsEn = exonEnds.split(",")
 
                     if cdsStart == cdsEnd:
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if strand == "-":
-                                    exnum = exonCount - e
-                                exons.append(
-                                    "non_coding_exon="
-                                    + "ex"
-                                    + str(exnum)
-                                    + "/"
-                                    + str(exonCount)
-                                )
+                        for e in model.exonsAt(pos):
+                            exnum = e + 1
+                            if strand == "-":
+                                exnum = exonCount - e
+                            exons.append(
+                                "non_coding_exon="
+                                + "ex"
+                                + str(exnum)
+                                + "/"
+                                + str(exonCount)
+                            )
                         if len(exons) > 0:
                             region = ";".join(exons)
                     elif u.isBetween(pos, cdsStart, cdsEnd):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if strand == "-":
-                                    exnum = exonCount - e
-                                exons.append(
-                                    "exon=" + "ex" + str(exnum) + "/" + str(exonCount)
-                                )
-                                exonic_count = exonic_count + 1
+                        for e in model.exonsAt(pos):
+                            exnum = e + 1
+                            if strand == "-":
+                                exnum = exonCount - e
+                            exons.append(
+                                "exon=" + "ex" + str(exnum) + "/" + str(exonCount)
+                            )
+                            exonic_count = exonic_count + 1
                         if len(exons) > 0:
                             region = ";".join(exons)
 
                     elif u.isBetween(pos, promoter_plus, txtStart) and (strand == "+"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name from "
-                            + 'cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
-                        )
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if rows is not None:
+                        if classes is None:
+                            island = cpgIslandAt(cursor, chr, pos)
+                        if island is not None:
                             region = "putativePromoterRegion=" + "".join(
-                                str(rows[3]).split()
+                                str(island[3]).split()
                             )
                             promoter_count = promoter_count + 1
 
                     elif u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name from "
-                            + 'cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
-                        )
-                        cursor.execute(sql)
-
-                        rows = cursor.fetchone()
-                        if rows is not None:
+                        if classes is None:
+                            island = cpgIslandAt(cursor, chr, pos)
+                        if island is not None:
                             region = "putativePromoterRegion=" + "".join(
-                                str(rows[3]).split()
+                                str(island[3]).split()
                             )
                             promoter_count = promoter_count + 1
 
@@ -582,18 +1632,18 @@ def getGenes(
                     cnt = cnt + 1
 
                 str_info = ";".join(info)
-                fields[7] = fields[7] + ";" + str_info
-                fh_out.write("\t".join(fields) + "\n")
+                record.addInfo(";" + str_info)
+                yield record
 
             else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write("\t".join(fields) + "\n")
+                record.addInfo(";positionType=interGenic")
+                yield record
                 interGenic_count = interGenic_count + 1
 
             linenum = linenum + 1
 
         else:
-            fh_out.write(line + "\n")
+            yield line
 
     print("Variants located:")
     fh_log.write("Variants located:\n")
@@ -625,17 +1675,14 @@ def getGenes(
     print(f"In Putative Promoter Region {str(promoter_count)}")
     fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+    closeConnection(conn)
 
 
-"""Method used in INDELS, where bigRefGeneTable is not applicable
+"""File-based form of streamGenes
 """
 
 
-def getExonsEtAl(
+def getGenes(
     vcf,
     format="vcf",
     table="refGene",
@@ -643,15 +1690,34 @@ def getExonsEtAl(
     tmpextin=".2",
     tmpextout=".3",
     sep="\t",
+    engine="sql",
 ):
+    runStage(
+        streamGenes,
+        vcf,
+        tmpextin,
+        tmpextout,
+        format=format,
+        table=table,
+        promoter_offset=promoter_offset,
+        sep=sep,
+        engine=engine,
+    )
+
+
+"""Method used in INDELS, where bigRefGeneTable is not applicable
+"""
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
 
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
+def streamExonsEtAl(
+    lines,
+    fh_log,
+    format="vcf",
+    table="refGene",
+    promoter_offset=500,
+    sep="\t",
+    engine="sql",
+):
 
     interGenic_count = 0
     cds_count = 0
@@ -664,15 +1730,16 @@ def getExonsEtAl(
     promoter_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
     conn = u.db_connect()
     cursor = conn.cursor()
+    transcripts = tx.TranscriptCache()
     linenum = 1
 
-    for line in fh:
+    for line in lines:
         line = line.strip()
         if not line.startswith("#"):
-            fields = line.split(sep)
+            record = rec.parse(line, sep)
+            fields = record.fields
             chr = fields[inds[0]].strip()
 
             if not chr.startswith("chr"):
@@ -681,7 +1748,7 @@ def getExonsEtAl(
             pos = fields[inds[1]].strip()
             ref = clean_mysql_chars(fields[inds[2]]).strip()
             alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
+            info_field = clean_mysql_chars(record.info()).strip()
             this_gene_name = str(u.parse_field(info_field, "name", ";", "="))
 
             sql = (
@@ -705,38 +1772,34 @@ def getExonsEtAl(
             if len(rows) > 0:
                 cnt = 1
                 for row in rows:
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts = str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
+                    model = transcripts.model(row)
+                    txtStart = model.txStart
+                    txtEnd = model.txEnd
+                    cdsStart = model.cdsStart
+                    cdsEnd = model.cdsEnd
+                    exonCount = model.exonCount
+                    geneSymbol = model.geneSymbol
+                    strand = model.strand
 
                     promoter_plus = txtStart - int(promoter_offset)
                     promoter_minus = txtEnd + int(promoter_offset)
                     region = ""
                     pos = int(pos)
                     exons = []
-                    exonsSt = exonStarts.split(",")
-                    exonsEn = exonEnds.split(",")
 
                     if cdsStart == cdsEnd:
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if strand == "-":
-                                    exnum = exonCount - e
-                                exons.append(
-                                    "non_coding_exon="
-                                    + "ex"
-                                    + str(exnum)
-                                    + "/"
-                                    + str(exonCount)
-                                )
-                                non_coding_exonic_count = non_coding_exonic_count + 1
+                        for e in model.exonsAt(pos):
+                            exnum = e + 1
+                            if strand == "-":
+                                exnum = exonCount - e
+                            exons.append(
+                                "non_coding_exon="
+                                + "ex"
+                                + str(exnum)
+                                + "/"
+                                + str(exonCount)
+                            )
+                            non_coding_exonic_count = non_coding_exonic_count + 1
                         if len(exons) > 0:
                             region = "positionType=non_coding_exon;" + ";".join(exons)
                         else:
@@ -745,15 +1808,14 @@ def getExonsEtAl(
 
                     elif u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd):
                         cds_count = cds_count + 1
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if strand == "-":
-                                    exnum = exonCount - e
-                                exons.append(
-                                    "exon=" + "ex" + str(exnum) + "/" + str(exonCount)
-                                )
-                                exonic_count = exonic_count + 1
+                        for e in model.exonsAt(pos):
+                            exnum = e + 1
+                            if strand == "-":
+                                exnum = exonCount - e
+                            exons.append(
+                                "exon=" + "ex" + str(exnum) + "/" + str(exonCount)
+                            )
+                            exonic_count = exonic_count + 1
                         if len(exons) > 0:
                             region = "positionType=CDS;" + ";".join(exons)
                         else:
@@ -844,18 +1906,18 @@ def getExonsEtAl(
                     cnt = cnt + 1
 
                 str_info = ";".join(info)
-                fields[7] = fields[7] + ";" + str_info
-                fh_out.write("\t".join(fields) + "\n")
+                record.addInfo(";" + str_info)
+                yield record
 
             else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write("\t".join(fields) + "\n")
+                record.addInfo(";positionType=interGenic")
+                yield record
                 interGenic_count = interGenic_count + 1
 
             linenum = linenum + 1
 
         else:
-            fh_out.write(line + "\n")
+            yield line
 
     print("Variants located:")
     fh_log.write("Variants located:\n")
@@ -887,76 +1949,108 @@ def getExonsEtAl(
     print(f"In Putative Promoter Region {str(promoter_count)}")
     fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
     conn.close()
 
 
-"""Overlap with tfbsConsSites
+"""File-based form of streamExonsEtAl
 """
 
 
-def addOverlapWithTfbsConsSites(
-    vcf, format="vcf", table="tfbsConsSites", tmpextin=".2", tmpextout=".3", sep="\t"
+def getExonsEtAl(
+    vcf,
+    format="vcf",
+    table="refGene",
+    promoter_offset=500,
+    tmpextin=".2",
+    tmpextout=".3",
+    sep="\t",
+    engine="sql",
 ):
+    runStage(
+        streamExonsEtAl,
+        vcf,
+        tmpextin,
+        tmpextout,
+        format=format,
+        table=table,
+        promoter_offset=promoter_offset,
+        sep=sep,
+        engine=engine,
+    )
 
-    allowed_chrom = [
-        "1",
-        "2",
-        "3",
-        "4",
-        "5",
-        "6",
-        "7",
-        "8",
-        "9",
-        "10",
-        "11",
-        "12",
-        "13",
-        "14",
-        "15",
-        "16",
-        "17",
-        "18",
-        "19",
-        "20",
-        "21",
-        "22",
-        "X",
-        "Y",
-    ]
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+"""Chromosomes with a tfbsConsSites<n> table, and the default memory
+   budget (MB) of the tables the tfbsConsSites stage keeps loaded
+"""
+
+TFBS_CHROMOSOMES = set([str(c) for c in range(1, 23)] + ["X", "Y"])
+TFBS_MEMORY_BUDGET_MB = 512
+
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+"""Load tfbsConsSites<chrIndex> into an IntervalIndex with one query;
+   the table holds a single chromosome, indexed as sn.WHOLE_TABLE
+"""
+
+
+def loadTfbsConsSites(cursor, chrIndex):
+    cursor.execute(
+        "select chrom, chromStart, chromEnd, name from tfbsConsSites" + chrIndex + ";"
+    )
+    index = ii.IntervalIndex()
+    index.columns = ["chrom", "chromStart", "chromEnd", "name"]
+    for row in cursor.fetchall():
+        index.add(sn.WHOLE_TABLE, row[1], row[2], row)
+    return index.freeze()
+
+
+"""Overlap with tfbsConsSites
+"""
+
+
+def streamOverlapWithTfbsConsSites(
+    lines,
+    fh_log,
+    format="vcf",
+    table="tfbsConsSites",
+    sep="\t",
+    engine="sql",
+    memory_budget_mb=TFBS_MEMORY_BUDGET_MB,
+):
 
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
     var_count = 0
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    conn, cursor = stageConnection(engine)
+    # Join engine: one lookup per tfbsConsSites<n> table
+    sites_by_chrom = {}
+    join_cursor = cursor
+    # batch, index and sweep engines: each table is read whole when its
+    # first variant comes, and kept within memory_budget_mb
+    tfbs = None
+    if engine in ["batch", "index", "sweep"]:
+        tfbs = ii.LazyIndexes(
+            lambda chrIndex: loadTfbsConsSites(join_cursor, chrIndex),
+            memory_budget_mb * 1024 * 1024,
+        )
+    memo = SiteMemo(engine, [table])
+    cursor = memo.cursor(cursor)
 
     linenum = 1
-    for line in fh:
+    for line in lines:
         line = line.strip()
         ## not comments
         if line.startswith("##"):
-            fh_out.write(line + "\n")
+            yield line
 
         # header line
         elif line.startswith("#CHROM") or line.startswith("CHROM"):
-            fh_out.write(line + "\n")
+            yield line
 
         else:
-            fields = line.split(sep)
+            record = rec.parse(line, sep)
+            fields = record.fields
+            memo.visit(fields, inds)
             chr = fields[inds[0]].strip()
             # For some reason this table has no "chr" preceeding number
             if not chr.startswith("chr"):
@@ -966,7 +2060,7 @@ def addOverlapWithTfbsConsSites(
             isOverlap = False
             chrIndex = chr.replace("chr", "")
 
-            if chrIndex in allowed_chrom:
+            if chrIndex in TFBS_CHROMOSOMES:
                 isOverlap = False
                 sql = (
                     "select chrom, chromStart, chromEnd, name "
@@ -978,8 +2072,27 @@ def addOverlapWithTfbsConsSites(
                     + str(pos)
                     + " <= chromEnd;"
                 )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
+                if engine == "snapshot":
+                    sites = sn.currentSnapshot().table("tfbsConsSites" + chrIndex)
+                    rows = [
+                        projectRow(sites, row, ["chrom", "chromStart", "chromEnd", "name"])
+                        for row in sites.fetchall(sn.WHOLE_TABLE, pos)
+                    ]
+                elif engine == "join":
+                    if chrIndex not in sites_by_chrom:
+                        sites_by_chrom[chrIndex] = memo.lookup(
+                            JoinLookup(join_cursor, "tfbsConsSites" + chrIndex, None)
+                        )
+                    sites = sites_by_chrom[chrIndex]
+                    rows = [
+                        projectRow(sites, row, ["chrom", "chromStart", "chromEnd", "name"])
+                        for row in sites.fetchall(chr, pos)
+                    ]
+                elif tfbs is not None:
+                    rows = tfbs.get(chrIndex).fetchall(sn.WHOLE_TABLE, pos)
+                else:
+                    cursor.execute(sql)
+                    rows = cursor.fetchall()
                 records = []
 
                 if len(rows) > 0:
@@ -1001,757 +2114,544 @@ def addOverlapWithTfbsConsSites(
                         records.append("tfbsRegion" + "=" + t)
                         records_count = records_count + 1
 
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + ";".join(records)
+                    if record.infoEndsWith(";"):
+                        record.addInfo(";".join(records))
                     else:
-                        fields[7] = fields[7] + ";" + ";".join(records)
+                        record.addInfo(";" + ";".join(records))
 
-                    fh_out.write("\t".join(fields) + "\n")
+                    yield record
 
                 else:  # chrom is not on the list
-                    fh_out.write(line + "\n")
+                    yield record
 
             else:  # chrom is not on the list
-                fh_out.write(line + "\n")
+                yield record
 
         linenum = linenum + 1
 
     fh_log.write(
         f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
     )
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    if tfbs is not None:
+        tfbs.close()
+    closeConnection(conn)
 
 
-"""Overlap with GadAll table
+"""File-based form of streamOverlapWithTfbsConsSites
 """
 
 
-def addOverlapWithGadAll(
-    vcf, format="vcf", table="gadAll", tmpextin="", tmpextout=".1", sep="\t"
+def addOverlapWithTfbsConsSites(
+    vcf,
+    format="vcf",
+    table="tfbsConsSites",
+    tmpextin=".2",
+    tmpextout=".3",
+    sep="\t",
+    engine="sql",
 ):
+    runStage(
+        streamOverlapWithTfbsConsSites,
+        vcf,
+        tmpextin,
+        tmpextout,
+        format=format,
+        table=table,
+        sep=sep,
+        engine=engine,
+    )
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+"""Searches Genes Databases and returns Genes/Cytobands 
+   with which SNP or INDEL overlaps
+"""
+
+
+def streamOverlapWithRefGene(
+    lines,
+    fh_log,
+    format="vcf",
+    table="refGene",
+    sep="\t",
+    engine="sql",
+):
 
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
     var_count = 0
     line_count = 0
+    colindex = 1
+    colindex2 = 12
+    name = "name"
+    name2 = "name2"
+    startName = "txStart"
+    endName = "txEnd"
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    conn, cursor = stageConnection(engine)
+    lookup = getRangeLookup(cursor, table, "chrom", startName, endName, engine)
+    memo = SiteMemo(engine, [table])
+    lookup = memo.lookup(lookup)
     linenum = 1
 
-    for line in fh:
+    for line in lines:
         line = line.strip()
         ## not comments
         if not line.startswith("##"):
             # header line
             if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
+                yield line
             else:
-                fields = line.split(sep)
+                record = rec.parse(line, sep)
+                fields = record.fields
+                memo.visit(fields, inds)
                 chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
+                if not chr.startswith("chr"):
+                    chr = "chr" + chr
 
                 pos = fields[inds[1]].strip()
                 isOverlap = False
 
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chromosome="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
+                overlapsWith = []
+                rows = lookup.fetchall(chr, pos)
 
                 if len(rows) > 0:
-                    records_count = 1
                     line_count = line_count + 1
-                    r_tmp = []
                     for row in rows:
                         var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]))
-                            records.append(str(table) + "=" + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + ";".join(records)
+                        overlapsWith.append(
+                            name2
+                            + "="
+                            + str(row[colindex2])
+                            + ";"
+                            + name
+                            + "="
+                            + str(row[colindex])
+                        )
+
+                    genes = ";".join([str(x) for x in overlapsWith])
+                    if record.infoEndsWith(";"):
+                        record.addInfo(str(genes))
                     else:
-                        fields[7] = fields[7] + ";" + ";".join(records)
-                    fh_out.write("\t ".join(fields) + "\n")
-                else:
-                    fh_out.write(line + "\n")
+                        record.addInfo(";" + str(genes))
+                yield record
 
             linenum = linenum + 1
         else:
-            fh_out.write(line + "\n")
+            yield line
 
     fh_log.write(
         f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
     )
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    lookup.close()
+    closeConnection(conn)
 
 
-""" Overlap with gwasCatalog table """
+"""File-based form of streamOverlapWithRefGene
+"""
 
 
-def addOverlapWithGwasCatalog(
-    vcf, format="vcf", table="gwasCatalog", tmpextin="", tmpextout=".1", sep="\t"
+def addOverlapWithRefGene(
+    vcf,
+    format="vcf",
+    table="refGene",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    engine="sql",
 ):
+    runStage(
+        streamOverlapWithRefGene,
+        vcf,
+        tmpextin,
+        tmpextout,
+        format=format,
+        table=table,
+        sep=sep,
+        engine=engine,
+    )
+
+
+"""Lookup types of an overlap source (see Source): rows whose position
+   column is the variant's position, all rows whose interval contains
+   it, or only the first of those
+"""
+
+LOOKUP_EXACT = "exact"
+LOOKUP_INTERVAL = "interval"
+LOOKUP_FIRST = "first"
+
+
+class Source(object):
+    """
+    A reference table annotated by overlap with the variant's position,
+    as streamOverlap runs it:
+
+    table is the default table (a stage's "table" argument overrides
+    it); lookup is one of the lookup types, over chromCol and startCol
+    through endCol (endCol alone for LOOKUP_EXACT); plainChrom tables
+    name chromosomes without "chr". payload(table, rows) is the text
+    added to INFO for the rows found, logged as logName (the table by
+    default). The text starts with ";" unless INFO already ends with one,
+    or always with fixedSeparator; columnSeparator rejoins the columns of
+    the records annotated. Engines not in lookupEngines cannot answer the
+    lookups: the stage queries per variant under them.
+    """
+
+    def __init__(
+        self,
+        table,
+        lookup,
+        payload,
+        chromCol="chrom",
+        startCol="chromStart",
+        endCol="chromEnd",
+        plainChrom=False,
+        logName=None,
+        fixedSeparator=False,
+        columnSeparator="\t",
+        lookupEngines=ENGINES,
+    ):
+        self.table = table
+        self.lookup = lookup
+        self.payload = payload
+        self.chromCol = chromCol
+        self.startCol = endCol if lookup == LOOKUP_EXACT else startCol
+        self.endCol = endCol
+        self.plainChrom = plainChrom
+        self.logName = logName
+        self.fixedSeparator = fixedSeparator
+        self.columnSeparator = columnSeparator
+        self.lookupEngines = lookupEngines
+
+
+"""Annotates each record with the rows of source (see Source) that
+   overlap its position, and logs how many rows matched in how many
+   records
+"""
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+def streamOverlap(
+    lines,
+    fh_log,
+    source,
+    format="vcf",
+    table=None,
+    sep="\t",
+    engine="sql",
+):
 
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
     var_count = 0
     line_count = 0
+    if table is None:
+        table = source.table
+    lookupEngine = engine if engine in source.lookupEngines else "sql"
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    conn, cursor = stageConnection(engine)
+    lookup = getRangeLookup(
+        cursor, table, source.chromCol, source.startCol, source.endCol, lookupEngine
+    )
+    memo = SiteMemo(lookupEngine, [table])
+    lookup = memo.lookup(lookup)
 
-    for line in fh:
+    for line in lines:
         line = line.strip()
         ## not comments
         if not line.startswith("##"):
             # header line
             if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
+                yield line
             else:
-                fields = line.split(sep)
+                record = rec.parse(line, sep)
+                fields = record.fields
+                memo.visit(fields, inds)
                 chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
+                if source.plainChrom:
+                    if chr.startswith("chr"):
+                        chr = str(chr).replace("chr", "")
+                elif not chr.startswith("chr"):
                     chr = "chr" + chr
 
                 pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND chromEnd = '
-                    + str(pos)
-                    + ";"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
+                if source.lookup == LOOKUP_FIRST:
+                    row = lookup.fetchone(chr, pos)
+                    rows = [] if row is None else [row]
+                else:
+                    rows = lookup.fetchall(chr, pos)
 
                 if len(rows) > 0:
                     line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(
-                            str(table)
-                            + "="
-                            + str("pubMedID")
-                            + "="
-                            + str(row[5])
-                            + ",trait="
-                            + str(row[10])
-                        )
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + ";".join(records)
-                    else:
-                        fields[7] = fields[7] + ";" + ";".join(records)
-                    fh_out.write("\t".join(fields) + "\n")
-                else:
-                    fh_out.write(line + "\n")
-
-            linenum = linenum + 1
+                    var_count = var_count + len(rows)
+                    text = source.payload(table, rows)
+                    if source.fixedSeparator or not record.infoEndsWith(";"):
+                        text = ";" + text
+                    record.addInfo(text)
+                    if source.columnSeparator != "\t":
+                        record.info()
+                        record = rec.VariantRecord(source.columnSeparator.join(fields))
+                yield record
         else:
-            fh_out.write(line + "\n")
+            yield line
 
+    logName = table if source.logName is None else source.logName
     fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+        f"In {str(logName)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
     )
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    lookup.close()
+    closeConnection(conn)
 
 
-"""Overlap with HUGO Gene Nomenclature Committee (HGNC) table
+"""Payloads of the overlap sources
 """
 
 
-def addOverlapWitHUGOGeneNomenclature(
-    vcf, format="vcf", table="hugo", tmpextin="", tmpextout=".1", sep="\t"
-):
+def cytobandPayload(table, rows):
+    bands = u.dedup([str(row[3]) for row in rows])
+    return str(table) + "=" + ";".join(bands)
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+def gadAllPayload(table, rows):
+    genes = []
+    for row in rows:
+        if not fu.isOnTheList(genes, str(row[3])):
+            genes.append(str(row[3]))
+    return ";".join([str(table) + "=" + g for g in genes])
 
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+def gwasCatalogPayload(table, rows):
+    return ";".join(
+        [
+            str(table) + "=pubMedID=" + str(row[5]) + ",trait=" + str(row[10])
+            for row in rows
+        ]
+    )
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
+def miRNAPayload(table, rows):
+    row = rows[0]
+    t = str(row[4]) + "," + str(row[1]) + "_" + str(row[2]) + "_" + str(row[3])
+    return "miRNAsites=" + t.strip()
 
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
 
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + "," + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append("HGNC_GeneAnnotation" + "=" + t)
-                        records_count = records_count + 1
+def hugoPayload(table, rows):
+    genes = []
+    for row in rows:
+        t = str(str(row[5]) + "," + str(row[6])).strip()
+        if not fu.isOnTheList(genes, t):
+            genes.append(t)
+    return ",".join(["HGNC_GeneAnnotation=" + t for t in genes]).replace(";", ",")
 
-                    records_str = ",".join(records).replace(";", ",")
 
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + records_str
-                    else:
-                        fields[7] = fields[7] + ";" + records_str
-                    fh_out.write("\t".join(fields) + "\n")
-                else:
-                    fh_out.write(line + "\n")
+def cnvPayload(table, rows):
+    return str(table) + "=" + str(True)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+def genomicSuperDupsPayload(table, rows):
+    row = rows[0]
+    return (
+        str(table)
+        + "="
+        + str(True)
+        + ";otherChrom="
+        + str(row[7])
+        + ";otherStart="
+        + str(row[8])
+        + ";otherEnd="
+        + str(row[9])
     )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
-
-
-"""Overlap with segdup regions genomicSuperDups
-"""
-
-
-def addOverlapWithGenomicSuperDups(
-    vcf, format="vcf", table="genomicSuperDups", tmpextin="", tmpextout=".1", sep="\t"
-):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+CYTOBAND_SOURCE = Source("cytoBand", LOOKUP_INTERVAL, cytobandPayload)
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ""
-                otherStart = ""
-                otherEnd = ""
-                l = str(isOverlap)
+# gadAll names chromosomes without "chr"; the records it annotates are
+# separated by tab and space, which later stages keep
+GAD_ALL_SOURCE = Source(
+    "gadAll",
+    LOOKUP_INTERVAL,
+    gadAllPayload,
+    chromCol="chromosome",
+    plainChrom=True,
+    columnSeparator="\t ",
+)
 
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = (
-                        fields[7]
-                        + ";"
-                        + str(table)
-                        + "="
-                        + str(isOverlap)
-                        + ";"
-                        + "otherChrom="
-                        + str(otherChrom)
-                        + ";otherStart="
-                        + str(otherStart)
-                        + ";otherEnd="
-                        + str(otherEnd)
-                    )
+GWAS_CATALOG_SOURCE = Source(
+    "gwasCatalog",
+    LOOKUP_EXACT,
+    gwasCatalogPayload,
+    endCol="chromEnd",
+    lookupEngines=LOOKUP_ENGINES,
+)
 
-                fh_out.write("\t".join(fields) + "\n")
+MIRNA_SOURCE = Source("targetScanS", LOOKUP_FIRST, miRNAPayload, logName="miRNAsites")
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
+HUGO_SOURCE = Source("hugo", LOOKUP_INTERVAL, hugoPayload)
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
+# dgv_Cnv, abParts_IG_T_CelReceptors, mcCarroll_Cnv and conrad_Cnv
+CNV_SOURCE = Source("dgv_Cnv", LOOKUP_FIRST, cnvPayload)
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+GENOMIC_SUPER_DUPS_SOURCE = Source(
+    "genomicSuperDups", LOOKUP_FIRST, genomicSuperDupsPayload, fixedSeparator=True
+)
 
 
-"""Searches Genes Databases and returns Genes/Cytobands 
-   with which SNP or INDEL overlaps
+"""File-based forms of the overlap stages
 """
 
 
-def addOverlapWithRefGene(
-    vcf, format="vcf", table="refGene", tmpextin="", tmpextout=".1", sep="\t"
+def addOverlapWithGadAll(
+    vcf,
+    format="vcf",
+    table="gadAll",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    engine="sql",
 ):
+    runStage(
+        streamOverlap,
+        vcf,
+        tmpextin,
+        tmpextout,
+        source=GAD_ALL_SOURCE,
+        format=format,
+        table=table,
+        sep=sep,
+        engine=engine,
+    )
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-    colindex = 1
-    colindex2 = 12
-    name = "name"
-    name2 = "name2"
-    startName = "txStart"
-    endName = "txEnd"
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND ('
-                    + startName
-                    + " <= "
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= "
-                    + endName
-                    + ");"
-                )
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(
-                            name2
-                            + "="
-                            + str(row[colindex2])
-                            + ";"
-                            + name
-                            + "="
-                            + str(row[colindex])
-                        )
 
-                    genes = ";".join([str(x) for x in overlapsWith])
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(genes)
-                    else:
-                        fields[7] = fields[7] + ";" + str(genes)
-                fh_out.write("\t".join(fields) + "\n")
+def addOverlapWithGwasCatalog(
+    vcf,
+    format="vcf",
+    table="gwasCatalog",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    engine="sql",
+):
+    runStage(
+        streamOverlap,
+        vcf,
+        tmpextin,
+        tmpextout,
+        source=GWAS_CATALOG_SOURCE,
+        format=format,
+        table=table,
+        sep=sep,
+        engine=engine,
+    )
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+def addOverlapWitHUGOGeneNomenclature(
+    vcf,
+    format="vcf",
+    table="hugo",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    engine="sql",
+):
+    runStage(
+        streamOverlap,
+        vcf,
+        tmpextin,
+        tmpextout,
+        source=HUGO_SOURCE,
+        format=format,
+        table=table,
+        sep=sep,
+        engine=engine,
     )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
 
 
-"""Method to find overlap with Cytoband table
-"""
+def addOverlapWithGenomicSuperDups(
+    vcf,
+    format="vcf",
+    table="genomicSuperDups",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    engine="sql",
+):
+    runStage(
+        streamOverlap,
+        vcf,
+        tmpextin,
+        tmpextout,
+        source=GENOMIC_SUPER_DUPS_SOURCE,
+        format=format,
+        table=table,
+        sep=sep,
+        engine=engine,
+    )
 
 
 def addOverlapWithCytoband(
-    vcf, format="vcf", table="cytoBand", tmpextin="", tmpextout=".1", sep="\t"
+    vcf,
+    format="vcf",
+    table="cytoBand",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    engine="sql",
 ):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-    colindex = 12
-    startName = "txStart"
-    endName = "txEnd"
-
-    if table == "cytoBand":
-        colindex = 3
-        startName = "chromStart"
-        endName = "chromEnd"
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND ('
-                    + startName
-                    + " <= "
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= "
-                    + endName
-                    + ");"
-                )
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ";".join([str(x) for x in overlapsWith])
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + "=" + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ";" + str(table) + "=" + str(cytoband)
-                fh_out.write("\t".join(fields) + "\n")
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
-
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+    runStage(
+        streamOverlap,
+        vcf,
+        tmpextin,
+        tmpextout,
+        source=CYTOBAND_SOURCE,
+        format=format,
+        table=table,
+        sep=sep,
+        engine=engine,
     )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
-
-
-"""Method to find overlap with CNV tables
-"""
 
 
 def addOverlapWithCnvDatabase(
-    vcf, format="vcf", table="dgv_Cnv", tmpextin="", tmpextout=".1", sep="\t"
+    vcf,
+    format="vcf",
+    table="dgv_Cnv",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    engine="sql",
 ):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + "=" + str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ";" + str(table) + "=" + str(isOverlap)
-                fh_out.write("\t".join(fields) + "\n")
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
-
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+    runStage(
+        streamOverlap,
+        vcf,
+        tmpextin,
+        tmpextout,
+        source=CNV_SOURCE,
+        format=format,
+        table=table,
+        sep=sep,
+        engine=engine,
     )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
-
-
-"""Method to find overlap with targetScanS tables
-"""
 
 
 def addOverlapWithMiRNA(
-    vcf, format="vcf", table="targetScanS", tmpextin="", tmpextout=".1", sep="\t"
+    vcf,
+    format="vcf",
+    table="targetScanS",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    engine="sql",
 ):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = (
-                        str(rows[4])
-                        + ","
-                        + str(rows[1])
-                        + "_"
-                        + str(rows[2])
-                        + "_"
-                        + str(rows[3])
-                    )
-                    t = "miRNAsites=" + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ";" + t
-                fh_out.write("\t".join(fields) + "\n")
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
-
-    fh_log.write(
-        f"In miRNAsites: {str(var_count)} in " + f"{str(line_count)} variants\n"
+    runStage(
+        streamOverlap,
+        vcf,
+        tmpextin,
+        tmpextout,
+        source=MIRNA_SOURCE,
+        format=format,
+        table=table,
+        sep=sep,
+        engine=engine,
     )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
 
 
 ### EOF
@@ -0,0 +1,162 @@
+# bgzf.py
+#
+# BGZF (blocked gzip, as written by bgzip) compression of annotated files,
+# with the blocks compressed in parallel threads
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Uncompressed bytes per block (bgzip's), so a compressed block always
+# fits the 64 KB a block can address
+BLOCK_SIZE = 0xFF00
+
+# Empty block terminating every BGZF file
+EOF_BLOCK = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+COMPRESSION_LEVEL = 6
+
+
+"""One BGZF block: a gzip member with the BC extra field holding the
+   block size, so readers can seek to block boundaries
+"""
+
+
+def compressBlock(data, level=COMPRESSION_LEVEL):
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = c.compress(data) + c.flush()
+    header = struct.pack(
+        "<4BI2BH2BHH",
+        0x1F,
+        0x8B,
+        8,
+        4,
+        0,
+        0,
+        0xFF,
+        6,
+        ord("B"),
+        ord("C"),
+        2,
+        len(cdata) + 25,
+    )
+    return header + cdata + struct.pack("<II", zlib.crc32(data) & 0xFFFFFFFF, len(data))
+
+
+class BgzfWriter(object):
+    """
+    Writes text or bytes to a BGZF file. With threads > 1, full blocks
+    are compressed by a thread pool (zlib releases the GIL) and written
+    in order; at most 2 * threads blocks are in flight.
+
+    Every block but the last holds BLOCK_SIZE bytes, and blockOffsets
+    keeps the file offset of each block (the EOF block last), so the
+    virtual offset of any uncompressed position follows from them (see
+    virtualOffset).
+    """
+
+    def __init__(self, filename, threads=1, level=COMPRESSION_LEVEL):
+        self.fh = open(filename, "wb")
+        self.level = level
+        self.threads = max(1, threads)
+        self.pool = None
+        if self.threads > 1:
+            self.pool = ThreadPoolExecutor(max_workers=self.threads)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.offset = 0
+        self.blockOffsets = []
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.buffer.extend(data)
+        while len(self.buffer) >= BLOCK_SIZE:
+            self._block(bytes(self.buffer[:BLOCK_SIZE]))
+            del self.buffer[:BLOCK_SIZE]
+
+    def _block(self, data):
+        if self.pool is None:
+            self._emit(compressBlock(data, self.level))
+            return
+        self.pending.append(self.pool.submit(compressBlock, data, self.level))
+        while len(self.pending) > 2 * self.threads:
+            self._emit(self.pending.popleft().result())
+
+    def _emit(self, block):
+        self.blockOffsets.append(self.offset)
+        self.fh.write(block)
+        self.offset = self.offset + len(block)
+
+    def close(self):
+        if len(self.buffer) > 0:
+            self._block(bytes(self.buffer))
+            self.buffer = bytearray()
+        while len(self.pending) > 0:
+            self._emit(self.pending.popleft().result())
+        if self.pool is not None:
+            self.pool.shutdown()
+        self._emit(EOF_BLOCK)
+        self.fh.close()
+        return self.blockOffsets
+
+
+"""Virtual offset (block file offset << 16 | offset in the block) of
+   uncompressed position pos of a file written by BgzfWriter
+"""
+
+
+def virtualOffset(blockOffsets, pos):
+    return (blockOffsets[pos // BLOCK_SIZE] << 16) | (pos % BLOCK_SIZE)
+
+
+"""Decompressed blocks of data, a run of whole BGZF blocks starting at
+   file offset start, as (file offset, bytes)
+"""
+
+
+def readBlocks(data, start=0):
+    at = 0
+    while at + 18 <= len(data):
+        xlen = struct.unpack("<H", data[at + 10 : at + 12])[0]
+        bsize = None
+        extra = at + 12
+        while extra < at + 12 + xlen:
+            si1, si2, slen = struct.unpack("<BBH", data[extra : extra + 4])
+            if si1 == ord("B") and si2 == ord("C"):
+                bsize = struct.unpack("<H", data[extra + 4 : extra + 6])[0]
+            extra = extra + 4 + slen
+        if bsize is None or at + bsize + 1 > len(data):
+            break
+        cdata = data[at + 12 + xlen : at + bsize + 1 - 8]
+        yield start + at, zlib.decompress(cdata, -15)
+        at = at + bsize + 1
+
+
+"""Compresses infile into outfile (BGZF) with threads threads (0: one
+   per CPU); returns the block offsets of outfile
+"""
+
+
+def compressFile(infile, outfile, threads=0, level=COMPRESSION_LEVEL):
+    if threads == 0:
+        threads = os.cpu_count()
+    writer = BgzfWriter(outfile, threads, level)
+    fh = open(infile, "rb")
+    while True:
+        data = fh.read(BLOCK_SIZE * 16)
+        if len(data) == 0:
+            break
+        writer.write(data)
+    fh.close()
+    return writer.close()
+
+
+### EOF
@@ -0,0 +1,202 @@
+# bloom.py
+#
+# Bloom filter of the (CHR, POS) sites of dbSNP, built offline by
+# build_bloom.py: the dbSNP stage skips the query of a variant the
+# filter says is not in dbSNP
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import json
+import math
+import zlib
+
+import numpy as np
+
+BLOOM_VERSION = 1
+
+# The file is a JSON header padded to HEADER_BYTES, then the bit array
+HEADER_BYTES = 4096
+
+# False positive rate build_bloom.py sizes the filter for by default
+FP_RATE = 0.01
+
+MASK64 = (1 << 64) - 1
+SEED = 0x9E3779B97F4A7C15
+
+
+"""Filter file layout:
+
+   header    {"version", "bits", "hashes", "keys", "fp_rate", "table",
+              "reference_version"} as JSON, padded with spaces
+   bits      bits / 8 bytes; bit i of the filter is bit (i & 7) of byte i >> 3
+
+   A site is hashed to the 64-bit key crc32(CHR upper-cased) << 32 | POS
+   (CHR as the table stores it, without "chr"), and set at the bits
+   (h1 + i * h2) mod bits for i < hashes, h1 and h2 being two mixes of
+   the key (double hashing).
+"""
+
+
+def mix(z):
+    """splitmix64 finalizer, on an int or a uint64 array"""
+    if isinstance(z, np.ndarray):
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK64
+    return z ^ (z >> 31)
+
+
+def chromHash(chrom):
+    return zlib.crc32(str(chrom).strip().upper().encode("utf-8"))
+
+
+def siteKey(chrom, pos):
+    return (chromHash(chrom) << 32) | (int(pos) & 0xFFFFFFFF)
+
+
+"""Bits and hashes of a filter of keys sites with false positive rate
+"""
+
+
+def filterSize(keys, rate=FP_RATE):
+    keys = max(keys, 1)
+    bits = int(math.ceil(-keys * math.log(rate) / (math.log(2) ** 2)))
+    bits = max(64, (bits + 63) // 64 * 64)
+    hashes = max(1, int(round(bits / float(keys) * math.log(2))))
+    return bits, hashes
+
+
+class BloomFilter(object):
+    """
+    A Bloom filter over bits held in a byte array (a memory map when
+    read from a file, so the jobs on a host share its pages). has() is
+    False only for sites never added; checked and skipped count the
+    lookups asked and answered False.
+    """
+
+    def __init__(self, bits, hashes, array=None, meta=None):
+        self.bits = bits
+        self.hashes = hashes
+        if array is None:
+            array = np.zeros(bits // 8, dtype=np.uint8)
+        self.array = array
+        self.meta = meta or {}
+        self.checked = 0
+        self.skipped = 0
+
+    def add(self, chroms, positions):
+        """Adds the sites of two parallel sequences"""
+        if len(positions) == 0:
+            return
+        hashes = dict((c, chromHash(c)) for c in set(chroms))
+        keys = (
+            np.array([hashes[c] for c in chroms], dtype=np.uint64) << np.uint64(32)
+        ) | (np.array(positions, dtype=np.uint64) & np.uint64(0xFFFFFFFF))
+        h1 = mix(keys)
+        h2 = mix(keys ^ np.uint64(SEED)) | np.uint64(1)
+        bits = np.uint64(self.bits)
+        for i in range(0, self.hashes):
+            index = (h1 + np.uint64(i) * h2) % bits
+            np.bitwise_or.at(
+                self.array,
+                (index >> np.uint64(3)).astype(np.int64),
+                (np.uint8(1) << (index & np.uint64(7)).astype(np.uint8)),
+            )
+
+    def has(self, chrom, pos):
+        key = siteKey(chrom, pos)
+        h1 = mix(key)
+        h2 = mix(key ^ SEED) | 1
+        self.checked = self.checked + 1
+        for i in range(0, self.hashes):
+            index = ((h1 + i * h2) & MASK64) % self.bits
+            if not self.array[index >> 3] & (1 << (index & 7)):
+                self.skipped = self.skipped + 1
+                return False
+        return True
+
+    def takeCounts(self):
+        """checked and skipped since the last call"""
+        counts = (self.checked, self.skipped)
+        self.checked = 0
+        self.skipped = 0
+        return counts
+
+    def write(self, filename):
+        header = json.dumps(
+            dict(self.meta, version=BLOOM_VERSION, bits=self.bits, hashes=self.hashes)
+        )
+        if len(header) >= HEADER_BYTES:
+            raise ValueError("Bloom filter header too long")
+        fh = open(filename, "wb")
+        fh.write(header.ljust(HEADER_BYTES - 1).encode("utf-8") + b"\n")
+        fh.write(self.array.tobytes())
+        fh.close()
+
+
+def readFilter(filename):
+    fh = open(filename, "rb")
+    meta = json.loads(fh.read(HEADER_BYTES).decode("utf-8"))
+    fh.close()
+    if meta.get("version") != BLOOM_VERSION:
+        raise ValueError(
+            f"Unsupported Bloom filter version {meta.get('version')} in {filename}"
+        )
+    array = np.memmap(
+        filename,
+        dtype=np.uint8,
+        mode="r",
+        offset=HEADER_BYTES,
+        shape=(meta["bits"] // 8,),
+    )
+    return BloomFilter(meta["bits"], meta["hashes"], array, meta)
+
+
+"""The dbSNP filter of the running job; set by driver.run and
+   driver.reannotate, None when there is none
+"""
+
+active = None
+
+
+"""Reads the dbSNP filter at filename, if it was built from the dbSNP
+   of reference_version (the [references] version of dbSNP, "" when it
+   has none): a filter of another version could miss sites added since.
+   Returns None (and the job queries every variant) otherwise.
+"""
+
+
+def openFilter(filename, reference_version=""):
+    if filename is None:
+        return None
+    try:
+        bloom = readFilter(filename)
+    except (OSError, ValueError) as e:
+        print(f"No dbSNP filter: {e}")
+        return None
+    built = bloom.meta.get("reference_version", "")
+    if built != reference_version:
+        print(
+            f"dbSNP filter {filename} is of dbSNP version {built!r}, "
+            + f"not {reference_version!r}; not used"
+        )
+        return None
+    return bloom
+
+
+"""Whether dbSNP may have a site: False only if the filter rules it out
+"""
+
+
+def mightContain(chrom, pos):
+    if active is None:
+        return True
+    return active.has(chrom, pos)
+
+
+### EOF
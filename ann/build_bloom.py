@@ -0,0 +1,90 @@
+# build_bloom.py
+#
+# Builds the Bloom filter of the dbSNP sites (see bloom.py) that the
+# dbSNP stage screens variants with before querying
+#
+# Usage: python build_bloom.py --output /path/to/dbsnp.bloom [--fp-rate 0.01]
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import argparse
+import os
+import time
+
+import bloom as bl
+import utils as u
+
+# Rows added to the filter at a time
+CHUNK_ROWS = 1000000
+
+
+"""Adds the (CHR, POS) of every row of table to bloom, streamed
+"""
+
+
+def addSites(conn, bloom, table):
+    cursor = u.db_stream_cursor(conn)
+    cursor.execute("select CHR, POS from " + table + ";")
+    added = 0
+    while True:
+        rows = cursor.fetchmany(CHUNK_ROWS)
+        if len(rows) == 0:
+            break
+        bloom.add([str(r[0]) for r in rows], [int(r[1]) for r in rows])
+        added = added + len(rows)
+        print(f"{added} sites added")
+    cursor.close()
+    return added
+
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Build the Bloom filter of the dbSNP sites."
+    )
+    parser.add_argument('--output', type=str, required=True, help='Filter file to create.')
+    parser.add_argument('--fp-rate', type=float, default=bl.FP_RATE, help='False positive rate the filter is sized for.')
+    parser.add_argument('--reference-version', type=str, default='', help='Version of dbSNP in [references] of annotator_config.ini, if any.')
+    parser.add_argument('--table', type=str, default='dbSNP', help='Table to read the sites from.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    start = time.time()
+
+    conn = u.db_connect(shared=False)
+    cursor = conn.cursor()
+    cursor.execute("select count(*) from " + args.table + ";")
+    keys = int(cursor.fetchone()[0])
+    cursor.close()
+
+    bits, hashes = bl.filterSize(keys, args.fp_rate)
+    print(f"{keys} rows: {bits // 8 // (1 << 20)} MB, {hashes} hashes")
+    bloom = bl.BloomFilter(
+        bits,
+        hashes,
+        meta={
+            "keys": keys,
+            "fp_rate": args.fp_rate,
+            "table": args.table,
+            "reference_version": args.reference_version,
+        },
+    )
+    addSites(conn, bloom, args.table)
+    conn.close()
+
+    # Written next to the target and swapped in, so running jobs never
+    # read a half-written filter
+    bloom.write(args.output + ".tmp")
+    os.replace(args.output + ".tmp", args.output)
+    print(f"Filter written to {args.output} in {time.time() - start:.1f} seconds")
+
+
+if __name__ == "__main__":
+    main()
+
+### EOF
@@ -0,0 +1,188 @@
+# build_snapshot.py
+#
+# Exports the AnnTools reference tables into a snapshot directory
+# that the snapshot engine memory-maps (see snapshot.py)
+#
+# Usage: python build_snapshot.py --output /path/to/snapshot [--tables t1,t2]
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import snapshot as sn
+import utils as u
+
+# Suffix of the build directories next to the snapshot path, which is a
+# symlink to the current build
+BUILD_SUFFIX = ".build-"
+
+TFBS_CHROMS = [str(c) for c in range(1, 23)] + ["X", "Y"]
+
+# (table, chromosome column, start column, end column)
+# Exact-position tables use the same column for start and end; the
+# tfbsConsSites tables are split by chromosome already and have none.
+SNAPSHOT_TABLES = [
+    ("dbSNP", "CHR", "POS", "POS"),
+    ("chrom_pos_equal_base", "CHR", "start", "start"),
+    ("chrom_pos_equal_nobase", "CHR", "start", "start"),
+    ("chrom_pos_unequal", "CHR", "start", "end"),
+    ("refGene", "chrom", "txStart", "txEnd"),
+    ("cpgIslandExt", "chrom", "chromStart", "chromEnd"),
+    ("cytoBand", "chrom", "chromStart", "chromEnd"),
+    ("gadAll", "chromosome", "chromStart", "chromEnd"),
+    ("gwasCatalog", "chrom", "chromEnd", "chromEnd"),
+    ("targetScanS", "chrom", "chromStart", "chromEnd"),
+    ("hugo", "chrom", "chromStart", "chromEnd"),
+    ("dgv_Cnv", "chrom", "chromStart", "chromEnd"),
+    ("abParts_IG_T_CelReceptors", "chrom", "chromStart", "chromEnd"),
+    ("mcCarroll_Cnv", "chrom", "chromStart", "chromEnd"),
+    ("conrad_Cnv", "chrom", "chromStart", "chromEnd"),
+    ("genomicSuperDups", "chrom", "chromStart", "chromEnd"),
+] + [("tfbsConsSites" + c, None, "chromStart", "chromEnd") for c in TFBS_CHROMS]
+
+
+"""Streams one table ordered by (chrom, start) into the snapshot
+"""
+
+
+def exportTable(conn, root, table, chromCol, startCol, endCol):
+    order = startCol if chromCol is None else chromCol + ", " + startCol
+    cursor = u.db_stream_cursor(conn)
+    cursor.execute("select * from " + table + " order by " + order + ";")
+    columns = [str(d[0]) for d in cursor.description]
+    chrom_ind = None if chromCol is None else columns.index(chromCol)
+
+    meta = sn.writeTable(
+        root,
+        table,
+        columns,
+        iter(cursor.fetchone, None),
+        chrom_ind,
+        columns.index(startCol),
+        columns.index(endCol),
+    )
+    cursor.close()
+    return meta
+
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Export the annotator reference tables into a snapshot."
+    )
+    parser.add_argument('--output', type=str, required=True, help='Snapshot directory to create.')
+    parser.add_argument('--tables', type=str, default=None, help='Comma-separated subset of tables to export.')
+    return parser.parse_args()
+
+
+"""Directories of the builds of the snapshot at target
+"""
+
+
+def snapshotBuilds(target):
+    parent = os.path.dirname(os.path.abspath(target))
+    prefix = os.path.basename(target) + BUILD_SUFFIX
+    return [
+        os.path.join(parent, name)
+        for name in os.listdir(parent)
+        if name.startswith(prefix) and os.path.isdir(os.path.join(parent, name))
+    ]
+
+
+"""Points target at build: a symlink made next to it and renamed over
+   it, so jobs see either the previous build or the new one. Returns the
+   directory of the previous build, if any
+"""
+
+
+def switchSnapshot(target, build):
+    previous = os.path.realpath(target) if os.path.islink(target) else None
+    if os.path.isdir(target) and not os.path.islink(target):
+        # A snapshot from before builds were versioned: moved aside once
+        legacy = tempfile.mkdtemp(
+            prefix=os.path.basename(target) + BUILD_SUFFIX,
+            dir=os.path.dirname(os.path.abspath(target)),
+        )
+        os.rmdir(legacy)
+        os.rename(target, legacy)
+        print(f"Moved the snapshot at {target} to {legacy}")
+        previous = legacy
+
+    link = target + ".link"
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.basename(build), link)
+    os.replace(link, target)
+    return previous
+
+
+def main():
+    args = parse_arguments()
+    target = args.output.rstrip("/")
+
+    tables = SNAPSHOT_TABLES
+    current = None
+    if args.tables is not None:
+        wanted = [t.strip() for t in args.tables.split(",")]
+        tables = [t for t in SNAPSHOT_TABLES if t[0] in wanted]
+        if os.path.exists(target):
+            current = os.path.realpath(target)
+            manifest = sn.readManifest(current)
+            if manifest.get("version") != sn.SNAPSHOT_VERSION:
+                print(
+                    f"The snapshot at {target} is of version {manifest.get('version')}; "
+                    + "rebuild every table (without --tables)"
+                )
+                return
+
+    # Each build goes to a new directory that target is switched to at
+    # the end: running jobs keep reading the build they opened
+    build = tempfile.mkdtemp(
+        prefix=os.path.basename(target) + BUILD_SUFFIX,
+        dir=os.path.dirname(os.path.abspath(target)),
+    )
+    os.chmod(build, 0o755)
+
+    conn = u.db_connect(shared=False)
+    manifest = {}
+    for table, chromCol, startCol, endCol in tables:
+        start = time.time()
+        manifest[table] = exportTable(conn, build, table, chromCol, startCol, endCol)
+        print(f"{table}: {sum(manifest[table]['rows'])} rows in {time.time() - start:.1f} seconds")
+    conn.close()
+
+    # Tables not rebuilt are linked from the current build
+    if current is not None:
+        for table, meta in sn.readManifest(current)["tables"].items():
+            if table not in manifest:
+                shutil.copytree(
+                    os.path.join(current, table),
+                    os.path.join(build, table),
+                    copy_function=os.link,
+                )
+                manifest[table] = meta
+                print(f"{table}: kept")
+
+    sn.writeManifest(build, manifest)
+
+    previous = switchSnapshot(target, build)
+    print(f"Snapshot written to {build}, now at {target}")
+
+    # Builds other than the new and the previous one (still read by the
+    # jobs that opened it) are removed
+    for old in snapshotBuilds(target):
+        if old not in [build, previous]:
+            shutil.rmtree(old, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
+
+### EOF
@@ -0,0 +1,159 @@
+# checkpoint.py
+#
+# Durable record of the work a job has completed (stages of the staged
+# pipeline, shards of a parallel run), so a redelivered job resumes after
+# it instead of starting over
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import hashlib
+import json
+import os
+import file_utils as fu
+
+CHECKPOINT_VERSION = 1
+
+# Bytes hashed per read
+HASH_CHUNK = 1 << 20
+
+# Checkpoint of the running job; set by driver.run, None when disabled
+active = None
+
+
+"""SHA-256 of a file, after flushing it to disk so a checkpoint never
+   names data a crash could lose
+"""
+
+
+def fileHash(filename):
+    digest = hashlib.sha256()
+    fh = open(filename, "rb")
+    os.fsync(fh.fileno())
+    while True:
+        data = fh.read(HASH_CHUNK)
+        if len(data) == 0:
+            break
+        digest.update(data)
+    fh.close()
+    return digest.hexdigest()
+
+
+"""Writes filename atomically: a crash leaves the old or the new file
+"""
+
+
+def writeFile(filename, text):
+    fh = open(filename + ".tmp", "w")
+    fh.write(text)
+    fh.flush()
+    os.fsync(fh.fileno())
+    fh.close()
+    os.replace(filename + ".tmp", filename)
+
+
+class Checkpoint(object):
+    """
+    The completed stages and shards of a job, kept in
+    <job>.vcf.checkpoint.json. A stage entry names the stage's output
+    file with its hash and the count log written up to it; a shard entry
+    names the shard's annotated file and count log with their hashes.
+    Entries are only trusted while the files still match their hashes,
+    and the whole checkpoint only for the same input and settings.
+
+    store, if given, makes the checkpoint survive the instance: every
+    file recorded is also put() there (e.g. S3), get() fetches back those
+    missing locally and clear() drops them all.
+    """
+
+    def __init__(self, infile, settings, store=None):
+        self.path = fu.uncompressedName(infile) + ".checkpoint.json"
+        self.store = store
+        self.fingerprint = {
+            "version": CHECKPOINT_VERSION,
+            "input": fileHash(infile),
+            # As read back from JSON
+            "settings": json.loads(json.dumps(settings)),
+        }
+        self.state = dict(self.fingerprint, stages=[], shards={})
+
+        if not os.path.exists(self.path) and self.store is not None:
+            self.store.get(self.path)
+        if os.path.exists(self.path):
+            fh = open(self.path)
+            try:
+                state = json.load(fh)
+            except ValueError:
+                state = {}
+            fh.close()
+            if all(state.get(k) == v for k, v in self.fingerprint.items()):
+                self.state = state
+            else:
+                print("Checkpoint is for another input or settings; starting over")
+
+    def _save(self):
+        writeFile(self.path, json.dumps(self.state, indent=1))
+        if self.store is not None:
+            self.store.put(self.path)
+
+    def _record(self, filename):
+        """Hash of a file, which is put() in the store"""
+        digest = fileHash(filename)
+        if self.store is not None:
+            self.store.put(filename)
+        return digest
+
+    def _valid(self, filename, digest):
+        if not os.path.exists(filename) and self.store is not None:
+            self.store.get(filename)
+        return os.path.exists(filename) and fileHash(filename) == digest
+
+    def stageDone(self, stage, label, filename, logfile):
+        """Records stage (1-based) as done; later stages are redone"""
+        fh = open(logfile)
+        log = fh.read()
+        fh.close()
+        self.state["stages"] = [e for e in self.state["stages"] if e["stage"] < stage]
+        self.state["stages"].append(
+            {
+                "stage": stage,
+                "label": label,
+                "file": os.path.basename(filename),
+                "hash": self._record(filename),
+                "log": log,
+            }
+        )
+        self._save()
+
+    def lastStage(self, directory):
+        """Last completed stage whose file is intact, or None"""
+        for entry in reversed(self.state["stages"]):
+            if self._valid(os.path.join(directory, entry["file"]), entry["hash"]):
+                return entry
+        return None
+
+    def shardDone(self, shard, annotated, logfile):
+        self.state["shards"][os.path.basename(shard)] = {
+            "file": self._record(annotated),
+            "log": self._record(logfile),
+        }
+        self._save()
+
+    def shardIsDone(self, shard, annotated, logfile):
+        entry = self.state["shards"].get(os.path.basename(shard))
+        return (
+            entry is not None
+            and self._valid(annotated, entry["file"])
+            and self._valid(logfile, entry["log"])
+        )
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        if self.store is not None:
+            self.store.clear()
+
+
+### EOF
@@ -12,168 +12,714 @@ __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
 import sys
 import os
+import shutil
+import sqlite3
+from multiprocessing import Pool
 import file_utils as fu
+import bgzf
+import tabix
+import utils as u
 import annotate as ann
+import snapshot as sn
+import shards
+import profiling as pr
+import checkpoint as ck
+import layers as ly
+import stages as stg
+import planner as pl
+import site_cache as sc
+import bloom as bl
 
+# Annotation stages in pipeline order: (label, stage, keyword arguments),
+# by default every stage of the registry (see stages.py)
+STAGES = stg.buildPipeline()
 
-def run(infile, format):
 
-    print("Running . . .")
+"""Pipeline of a job: the stages labelled, in that order, or STAGES
+"""
 
-    ann.getSnpsFromDbSnp(vcf=infile, format="vcf", tmpextin="", tmpextout=".1")
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
 
-    ann.getBigRefGene(
-        vcf=infile,
-        format="vcf",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(
-        vcf=infile,
-        format="vcf",
-        table="refGene",
-        promoter_offset=500,
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(
-        vcf=infile,
-        format="vcf",
-        table="cytoBand",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(
-        vcf=infile,
-        format="vcf",
-        table="gadAll",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(
-        vcf=infile,
-        format="vcf",
-        table="gwasCatalog",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(
-        vcf=infile,
-        format="vcf",
-        table="targetScanS",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(
-        vcf=infile,
-        format="vcf",
-        table="hugo",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="dgv_Cnv",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="abParts_IG_T_CelReceptors",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="mcCarroll_Cnv",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="conrad_Cnv",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(
-        vcf=infile,
-        format="vcf",
-        table="genomicSuperDups",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(
-        vcf=infile,
-        table="tfbsConsSites",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
+def jobStages(stages=None):
+    if stages is None:
+        return STAGES
+    return stg.buildPipeline(stages)
+
+
+"""Keyword arguments for one stage: its defaults from STAGES, then the
+   job-wide format and engine, then any per-stage options (which may
+   choose another engine for the stage)
+"""
+
+
+def stageArguments(label, kwargs, format, engine, options=None):
+    arguments = dict(kwargs, format=format, engine=engine)
+    if options is not None and label in options:
+        arguments.update(options[label])
+    return arguments
+
+
+"""Engines the stages of a job run with
+"""
+
+
+def jobEngines(stages, engine, options=None):
+    return set(
+        [
+            stageArguments(label, kwargs, None, engine, options)["engine"]
+            for label, _, kwargs in stages
+        ]
     )
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+
+
+"""Raises ValueError for an engine of the job, or of a stage in options,
+   that is not one of annotate.ENGINES; the job's may also be the
+   planner's
+"""
+
+
+def checkEngines(engine, options=None):
+    engines = [o["engine"] for o in (options or {}).values() if "engine" in o]
+    if engine != pl.PLANNED_ENGINE:
+        engines.append(engine)
+    for e in engines:
+        if e not in ann.ENGINES:
+            raise ValueError(f"Unknown annotation engine: {e}")
+
+
+"""engine and per-stage options with the sweep engine replaced by the
+   index engine, for input that is not coordinate-sorted
+"""
+
+
+def withoutSweep(engine, options):
+    if engine == "sweep":
+        engine = "index"
+    if options is not None:
+        options = dict(
+            (label, dict(o, engine="index") if o.get("engine") == "sweep" else o)
+            for label, o in options.items()
+        )
+    return engine, options
+
+
+"""The host's site cache at path (see site_cache.py), or None if there
+   is none or it cannot be opened: jobs then go to the database
+"""
+
+
+def openSiteCache(path, reference_versions, maxMb):
+    if path is None:
+        return None
+    try:
+        return sc.SiteCache(path, reference_versions, maxMb)
+    except sqlite3.Error as e:
+        print(f"Site cache {path} is not available: {e}")
+        return None
+
+
+"""Notes when the site cache is open but no stage looks up with an engine
+   that consults it (sc.CACHED_ENGINES); overlap stages look up with sql
+   under the engines their source has no lookup for
+"""
+
+
+def noteSiteCacheUse(stages, engine, options):
+    if sc.active is None:
+        return
+    engines = set()
+    for label, _, kwargs in stages:
+        e = stageArguments(label, kwargs, None, engine, options)["engine"]
+        source = kwargs.get("source")
+        engines.add(e if source is None or e in source.lookupEngines else "sql")
+    if len(engines & set(sc.CACHED_ENGINES)) == 0:
+        print(
+            "Site cache unused: no stage runs the "
+            + " or ".join(sc.CACHED_ENGINES)
+            + " engine"
+        )
+
+
+"""The dbSNP filter at path (see bloom.py), if it was built from the
+   dbSNP version now in reference_versions
+"""
+
+
+def openDbSnpFilter(path, reference_versions):
+    version = ly.Layers(reference_versions).versions.get("dbsnp", "")
+    return bl.openFilter(path, str(version))
+
+
+"""Name of the annotated file: test.vcf -> test.annot.vcf
+"""
+
+
+def annotatedFileName(infile):
+    return (infile + ".annot").replace(".vcf.annot", ".annot.vcf")
+
+
+"""Pre-passes over the input before the stages run: counting repeated
+   sites, whose lookups the stages then make only once (see
+   annotate.SiteMemo), and uploading the variants if a stage runs the
+   join engine or reading them for the batched searches of the index
+   and snapshot engines (engines: those of the stages, see jobEngines)
+"""
+
+
+def prepareJob(infile, format, engines):
+    repeats = ann.findRepeatedSites(infile, format)
+    if repeats > 0:
+        print(f"{repeats} records repeat an earlier site")
+    if "join" in engines:
+        ann.loadJobVariants(infile, format)
+    elif len(engines & set(ann.BATCH_SEARCH_ENGINES)) > 0:
+        ann.readJobVariants(infile, format)
+    else:
+        ann.jobVariants = None
+        ann.jobVariantsSource = None
+
+
+"""Runs all stages in a single pass: each record is parsed once, flows
+   through the chained stage generators and is written once
+"""
+
+
+def runFused(infile, format, engine="sql", options=None, stages=None):
+    pipeline = jobStages(stages)
+    with pr.profilePhase("prepare"):
+        prepareJob(infile, format, jobEngines(pipeline, engine, options))
+
+    base = fu.uncompressedName(infile)
+    fh = fu.openText(infile)
+    fh_log = open(base + ".count.log", "w")
+    fh_out = open(base + ".annot", "w")
+
+    lines = fh
+    for n, (label, stage, kwargs) in enumerate(pipeline, 1):
+        lines = pr.profileStage(
+            label,
+            layeredStage(base, n, stage)(
+                lines, fh_log, **stageArguments(label, kwargs, format, engine, options)
+            ),
+        )
+
+    for line in lines:
+        fh_out.write(str(line) + "\n")
+    print("All stages - done.")
+
+    fh_out.close()
+    fh_log.close()
+    fh.close()
+
+    os.rename(base + ".annot", annotatedFileName(base))
+    writeLayerManifest(infile, base, stages)
+
+
+"""Stage function whose generator is profiled under label
+"""
+
+
+def profiledStage(label, stage):
+    def profiled(lines, fh_log, **kwargs):
+        return pr.profileStage(label, stage(lines, fh_log, **kwargs))
+
+    return profiled
+
+
+"""Stage function recording its layer as the n-th stage of the job when
+   layers are recorded (see layers.py), otherwise stage itself
+"""
+
+
+def layeredStage(base, n, stage):
+    if ly.active is None:
+        return stage
+    directory = ly.layerDirectory(base)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    return ly.LayerRecorder(directory, n).stage(stage)
+
+
+"""Writes the manifest of the layers recorded for a job: its input and
+   the reference version of every stage
+"""
+
+
+def writeLayerManifest(infile, base, stages=None):
+    if ly.active is None:
+        return
+    entries = [
+        {"label": label, "version": ly.active.stageVersion(stg.stageTables(label, kwargs))}
+        for label, _, kwargs in jobStages(stages)
+    ]
+    ly.writeManifest(ly.layerDirectory(base), ck.fileHash(infile), entries)
+
+
+"""Runs the stages one after another, each one reading the previous
+   stage's temporary file (.1, .2, ...) and writing the next. With a
+   checkpoint, each completed stage is recorded, and a rerun starts after
+   the last one recorded whose file is intact, with its count log.
+"""
+
+
+def runStaged(infile, format, engine="sql", options=None, stages=None):
+    pipeline = jobStages(stages)
+    with pr.profilePhase("prepare"):
+        prepareJob(infile, format, jobEngines(pipeline, engine, options))
+
+    # A compressed input is read as base + its suffix
+    base = fu.uncompressedName(infile)
+    tmpextin = infile[len(base) :]
+    tmpextout = 1
+    if ck.active is not None:
+        done = ck.active.lastStage(os.path.dirname(base))
+        if done is not None:
+            print(f"Resuming after {done['label']}")
+            ck.writeFile(base + ".count.log", done["log"])
+            tmpextin = "." + str(done["stage"])
+            tmpextout = done["stage"] + 1
+
+    for label, stage, kwargs in pipeline[tmpextout - 1 :]:
+        ann.runStage(
+            profiledStage(label, layeredStage(base, tmpextout, stage)),
+            base,
+            tmpextin,
+            "." + str(tmpextout),
+            logmode="w" if tmpextout == 1 else "a",
+            **stageArguments(label, kwargs, format, engine, options),
+        )
+        print(f"{label} - done.")
+        if ck.active is not None:
+            ck.active.stageDone(
+                tmpextout, label, base + "." + str(tmpextout), base + ".count.log"
+            )
+        tmpextin = "." + str(tmpextout)
+        tmpextout = tmpextout + 1
 
     ## Cleanup
-    for i in range(1, tmpextin):
-        fu.delete(infile + "." + str(i))
+    last = tmpextout - 1
+    for i in range(1, last):
+        fu.delete(base + "." + str(i))
+
+    os.rename(base + "." + str(last), annotatedFileName(base))
+    writeLayerManifest(infile, base, stages)
+
+
+"""Annotates one shard of a parallel run; returns the shard and its
+   annotated file
+"""
+
+
+def annotateShard(job):
+    shardfile, format, engine, fused, options, stages, profile = job
+    if profile:
+        pr.start()
+    if fused:
+        runFused(shardfile, format, engine=engine, options=options, stages=stages)
+    else:
+        runStaged(shardfile, format, engine=engine, options=options, stages=stages)
+    if profile:
+        pr.writeProfile(shardfile + ".profile.json", pr.stop().report())
+    if sc.active is not None:
+        sc.active.finish()
+    return shardfile, annotatedFileName(shardfile)
+
+
+"""Each worker process keeps its own database connection and, with the
+   index engine, loads each reference table once for all its shards.
+   Shards are checkpointed by the parent process only.
+"""
+
+
+def initWorker():
+    ann.indexCache = {}
+    ck.active = None
+
+
+"""Splits the input by chromosome (chr1 and chr2 by position block, see
+   shards.py), annotates the shards in a pool of worker processes and
+   merges the results and count logs back in input order. With a
+   checkpoint, each annotated shard is recorded, and a rerun annotates
+   only the shards not recorded.
+"""
+
+
+def runParallel(
+    infile, format, engine="sql", fused=True, options=None, workers=2, stages=None
+):
+    base = fu.uncompressedName(infile)
+    directory = base + ".shards"
+    # The shards a checkpoint names are kept; the split is the same
+    if os.path.exists(directory) and ck.active is None:
+        shutil.rmtree(directory)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    inds = ann.getFormatSpecificIndices(format=format)
+    with pr.profilePhase("split"):
+        files, order = shards.splitVcf(infile, directory, inds)
+    if len(files) == 0:
+        shutil.rmtree(directory)
+        runFused(infile, format, engine=engine, options=options, stages=stages)
+        return
+
+    # Largest shards first so a big one does not start last
+    jobs = sorted(files, key=os.path.getsize, reverse=True)
+    if ck.active is not None:
+        jobs = [
+            f
+            for f in jobs
+            if not ck.active.shardIsDone(f, annotatedFileName(f), f + ".count.log")
+        ]
+        if len(jobs) < len(files):
+            print(f"Resuming with {len(jobs)} of {len(files)} shards")
+
+    def shardDone(result):
+        if ck.active is not None:
+            shardfile, annotated = result
+            ck.active.shardDone(shardfile, annotated, shardfile + ".count.log")
+
+    if len(jobs) > 0:
+        # Every shard runs to the end, and is checkpointed, even if
+        # another one fails; the first failure is raised after
+        pool = Pool(processes=min(workers, len(jobs)), initializer=initWorker)
+        results = [
+            pool.apply_async(
+                annotateShard,
+                ((f, format, engine, fused, options, stages, pr.active is not None),),
+                callback=shardDone,
+            )
+            for f in jobs
+        ]
+        pool.close()
+        pool.join()
+        for result in results:
+            result.get()
+
+    with pr.profilePhase("merge"):
+        shards.mergeVcf(
+            [annotatedFileName(f) for f in files], order, annotatedFileName(base)
+        )
+        shards.mergeCountLogs(
+            [f + ".count.log" for f in files], base + ".count.log"
+        )
+        if ly.active is not None:
+            mergeLayers(infile, files, order, stages)
+    if pr.active is not None:
+        profiles = [f + ".profile.json" for f in files]
+        pr.active.addShards(*pr.mergeProfiles([p for p in profiles if os.path.exists(p)]))
+    shutil.rmtree(directory)
+    print(f"{len(files)} shards - done.")
+
+
+"""Merges the layers of the shards into those of the job, the records
+   back in input order as in shards.mergeVcf
+"""
+
+
+def mergeLayers(infile, files, order, stages=None):
+    directory = ly.layerDirectory(fu.uncompressedName(infile))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    for n in range(1, len(jobStages(stages)) + 1):
+        layerfile, logfile = ly.layerFiles(directory, n)
+        shardLayers = [ly.layerFiles(ly.layerDirectory(f), n) for f in files]
+        shards.mergeVcf([layer for layer, _ in shardLayers], order, layerfile)
+        shards.mergeCountLogs([log for _, log in shardLayers], logfile)
+    writeLayerManifest(infile, fu.uncompressedName(infile), stages)
+
+
+"""Replaces the annotated file of a job by its bgzip-compressed copy and,
+   with index, a tabix index of that
+"""
+
+
+def compressOutput(base, threads=0, index=False):
+    with pr.profilePhase("compress"):
+        annotated = annotatedFileName(base)
+        blocks = bgzf.compressFile(annotated, annotated + ".gz", threads)
+    if index:
+        with pr.profilePhase("index"):
+            tbi = tabix.buildIndex(annotated, blocks)
+            if tbi is not None:
+                tbi.write(annotated + ".gz.tbi")
+    os.remove(annotated)
+
+
+"""stages are the labels of the stages to run, in order (see
+   stages.py); all of them by default
+   options maps a stage label to keyword arguments overriding its
+   defaults, e.g. {"dbSNP": {"batch_size": 5000}}; an "engine" there
+   runs the stage with another engine than the job's
+   snapshot_dir is the reference snapshot used by the snapshot engine
+   workers > 1 annotates chromosome shards in that many processes; 0 uses
+   one process per CPU
+   profile writes per-stage timings and SQL counters to
+   infile + ".profile.json" (see profiling.py)
+   compress writes the annotated file bgzip-compressed (.annot.vcf.gz),
+   with compress_threads threads (0: one per CPU); index also writes its
+   tabix index (.annot.vcf.gz.tbi, see tabix.py)
+
+   checkpoint records the completed stages (staged pipeline) or shards
+   (workers > 1, and the fused pipeline, which then runs by shard even
+   in one worker) in infile + ".checkpoint.json", and a rerun of the
+   same job resumes after them (see checkpoint.py); checkpoint_store
+   copies the checkpoint and its files off the instance
+   layers records what every stage added to the records in
+   infile + ".layers", with the reference_versions (table: version) of
+   its tables, for reannotate()
+
+   infile may be gzip- or bgzip-compressed; the files of the job are
+   named after it without the .gz suffix
+"""
+
+
+def run(
+    infile,
+    format,
+    engine="sql",
+    fused=True,
+    options=None,
+    snapshot_dir=None,
+    workers=1,
+    profile=False,
+    compress=False,
+    compress_threads=0,
+    index=False,
+    checkpoint=False,
+    checkpoint_store=None,
+    layers=False,
+    reference_versions=None,
+    stages=None,
+    planner_engines=None,
+    planner_memory_mb=pl.PLANNER_MEMORY_MB,
+    site_cache=None,
+    site_cache_mb=sc.SITE_CACHE_MB,
+    dbsnp_filter=None,
+):
+
+    print("Running . . .")
+    checkEngines(engine, options)
+    if profile:
+        pr.start()
+
+    ck.active = None
+    if checkpoint:
+        settings = {
+            "format": format,
+            "fused": fused,
+            "options": options,
+            "stages": [label for label, _, _ in jobStages(stages)],
+        }
+        ck.active = ck.Checkpoint(infile, settings, checkpoint_store)
+    ly.active = ly.Layers(reference_versions) if layers else None
+    sc.active = openSiteCache(site_cache, reference_versions, site_cache_mb)
+    bl.active = openDbSnpFilter(dbsnp_filter, reference_versions)
+
+    if workers == 0:
+        workers = os.cpu_count()
+
+    # Engine auto: each stage runs with the engine the planner estimates
+    # cheapest for this job (see planner.py)
+    requested = engine
+    plan = None
+    if engine == pl.PLANNED_ENGINE:
+        plan = pl.planJob(
+            infile,
+            format,
+            jobStages(stages),
+            options,
+            candidates=planner_engines,
+            snapshot_dir=snapshot_dir,
+            workers=workers,
+            memory_mb=planner_memory_mb,
+        )
+        engine, options = plan.engine(), plan.options(options)
+
+    engines = jobEngines(jobStages(stages), engine, options)
+    if "snapshot" in engines:
+        sn.openSnapshot(snapshot_dir)
+
+    # The sweep join needs coordinate-sorted input
+    if "sweep" in engines and not fu.isCoordinateSorted(infile):
+        print("Input is not coordinate-sorted; using the index engine")
+        engine, options = withoutSweep(engine, options)
+    noteSiteCacheUse(jobStages(stages), engine, options)
+
+    # A fused pass leaves nothing to resume from; with a checkpoint it
+    # runs shard by shard, so a rerun resumes after the shards done
+    if workers > 1 or (fused and ck.active is not None):
+        runParallel(infile, format, engine, fused, options, workers, stages)
+    elif fused:
+        runFused(infile, format, engine=engine, options=options, stages=stages)
+    else:
+        runStaged(infile, format, engine=engine, options=options, stages=stages)
+
+    # All stages shared one reference database connection
+    u.db_disconnect()
+    if sc.active is not None:
+        sc.active.close()
+
+    base = fu.uncompressedName(infile)
+    if compress:
+        compressOutput(base, compress_threads, index)
+
+    if profile:
+        report = pr.stop().report(
+            job=os.path.basename(base),
+            engine=requested,
+            pipeline="fused" if fused else "staged",
+            workers=workers,
+        )
+        if plan is not None:
+            report["plan"] = plan.report()
+        pr.writeProfile(base + ".profile.json", report)
+
+
+"""Re-annotates a job from the layers a run with layers recorded (see
+   layers.py), with the reference_versions now current. A stage runs
+   again if the version of its tables changed, or if it reads INFO
+   (see stages.Stage) and an earlier stage changed the records; the layers of
+   the other stages are applied as stored, carried over to the records
+   an earlier stage changed. The annotated file, count log and layers
+   are rewritten; other arguments are those of run()
+"""
+
+
+def reannotate(
+    infile,
+    format,
+    engine="sql",
+    options=None,
+    snapshot_dir=None,
+    reference_versions=None,
+    compress=False,
+    compress_threads=0,
+    index=False,
+    stages=None,
+    planner_engines=None,
+    planner_memory_mb=pl.PLANNER_MEMORY_MB,
+    site_cache=None,
+    site_cache_mb=sc.SITE_CACHE_MB,
+    dbsnp_filter=None,
+):
+    print("Re-annotating . . .")
+    checkEngines(engine, options)
+    pipeline = jobStages(stages)
+    base = fu.uncompressedName(infile)
+    directory = ly.layerDirectory(base)
+    manifest = None
+    if os.path.exists(os.path.join(directory, "manifest.json")):
+        manifest = ly.readManifest(directory)
+    if (
+        manifest is None
+        or manifest["input"] != ck.fileHash(infile)
+        or [s["label"] for s in manifest["stages"]] != [l for l, _, _ in pipeline]
+    ):
+        print("No layers of this input and pipeline; annotating in full")
+        run(
+            infile,
+            format,
+            engine=engine,
+            options=options,
+            snapshot_dir=snapshot_dir,
+            compress=compress,
+            compress_threads=compress_threads,
+            index=index,
+            layers=True,
+            reference_versions=reference_versions,
+            stages=stages,
+            planner_engines=planner_engines,
+            planner_memory_mb=planner_memory_mb,
+            site_cache=site_cache,
+            site_cache_mb=site_cache_mb,
+            dbsnp_filter=dbsnp_filter,
+        )
+        return
+
+    if engine == pl.PLANNED_ENGINE:
+        plan = pl.planJob(
+            infile,
+            format,
+            pipeline,
+            options,
+            candidates=planner_engines,
+            snapshot_dir=snapshot_dir,
+            memory_mb=planner_memory_mb,
+        )
+        engine, options = plan.engine(), plan.options(options)
+
+    engines = jobEngines(pipeline, engine, options)
+    if "snapshot" in engines:
+        sn.openSnapshot(snapshot_dir)
+    if "sweep" in engines and not fu.isCoordinateSorted(infile):
+        engine, options = withoutSweep(engine, options)
+        engines = jobEngines(pipeline, engine, options)
+
+    ly.active = ly.Layers(reference_versions)
+    sc.active = openSiteCache(site_cache, reference_versions, site_cache_mb)
+    noteSiteCacheUse(pipeline, engine, options)
+    bl.active = openDbSnpFilter(dbsnp_filter, reference_versions)
+    prepared = False
+    # Whether the records differ from those the layers were recorded on
+    changed = False
+    tmpextin = infile[len(base) :]
+    for n, (label, stage, kwargs) in enumerate(pipeline, 1):
+        entry = manifest["stages"][n - 1]
+        version = ly.active.stageVersion(stg.stageTables(label, kwargs))
+        layerfile, logfile = ly.layerFiles(directory, n)
+        tmpextout = "." + str(n)
+
+        rerun = version != entry["version"] or (changed and stg.readsInfo(label))
+        if not rerun:
+            if ly.applyLayer(
+                base + tmpextin,
+                layerfile,
+                base + tmpextout,
+                rebase=changed,
+                fixedSeparator=stg.fixedSeparator(label),
+            ):
+                print(f"{label} - layer applied.")
+            else:
+                print(f"{label} - layer does not carry over")
+                rerun = True
+
+        if rerun:
+            if not prepared:
+                prepareJob(infile, format, engines)
+                prepared = True
+            before = ck.fileHash(layerfile)
+            ann.runStage(
+                ly.LayerRecorder(directory, n).stage(stage),
+                base,
+                tmpextin,
+                tmpextout,
+                logmode="w",
+                **stageArguments(label, kwargs, format, engine, options),
+            )
+            changed = changed or ck.fileHash(layerfile) != before
+            entry["version"] = version
+            print(f"{label} - done.")
+
+        if n > 1:
+            fu.delete(base + tmpextin)
+        tmpextin = tmpextout
+
+    u.db_disconnect()
+    if sc.active is not None:
+        sc.active.close()
+    os.rename(base + tmpextin, annotatedFileName(base))
+
+    # The count log is the stages' blocks, as each stage appends its own
+    fh_log = open(base + ".count.log", "w")
+    for n in range(1, len(pipeline) + 1):
+        fh = open(ly.layerFiles(directory, n)[1])
+        fh_log.write(fh.read())
+        fh.close()
+    fh_log.close()
 
-    os.rename(infile + "." + str(tmpextin), infile + ".annot")
-    finalout = (infile + ".annot").replace(".vcf.annot", ".annot.vcf")
-    os.rename(infile + ".annot", finalout)
+    ly.writeManifest(directory, manifest["input"], manifest["stages"])
+    if compress:
+        compressOutput(base, compress_threads, index)
 
 
 ### EOF
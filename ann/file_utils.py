@@ -10,6 +10,7 @@
 ##
 __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
+import gzip
 import os.path
 import linecache
 import csv
@@ -255,6 +256,98 @@ def linecount(filename):
     return linenum
 
 
+# Bytes of records read by estimateRecords before it extrapolates
+ESTIMATE_SAMPLE_BYTES = 8 << 20
+
+
+"""Number of records (lines not starting with "#") of a text file that
+   may be gzip-compressed: counted while they fit in sample bytes,
+   beyond that estimated from the share of the file read so far (of the
+   compressed file, for gzip), so large files are not read through
+"""
+
+
+def estimateRecords(filename, sample=ESTIMATE_SAMPLE_BYTES):
+    raw = open(filename, "rb")
+    compressed = raw.read(2) == b"\x1f\x8b"
+    raw.seek(0)
+    fh = gzip.GzipFile(fileobj=raw) if compressed else raw
+    records = 0
+    read = 0
+    for line in fh:
+        if not line.startswith(b"#") and len(line.strip()) > 0:
+            records = records + 1
+            read = read + len(line)
+            if read >= sample:
+                break
+    else:
+        raw.close()
+        return records
+
+    consumed = raw.tell()
+    raw.close()
+    return int(records * os.path.getsize(filename) / max(consumed, 1))
+
+
+"""Opens a text file for reading; gzip files (and so bgzip files, which
+   are series of gzip members) are decompressed as they are read
+"""
+
+
+def openText(filename):
+    fh = open(filename, "rb")
+    magic = fh.read(2)
+    fh.close()
+    if magic == b"\x1f\x8b":
+        return gzip.open(filename, "rt")
+    return open(filename, "r")
+
+
+"""Name of a file without its compression suffix (.gz or .bgz)
+"""
+
+
+def uncompressedName(filename):
+    for suffix in [".gz", ".bgz"]:
+        if filename.endswith(suffix):
+            return filename[: -len(suffix)]
+    return filename
+
+
+"""Checks whether a VCF is coordinate-sorted: the records of each
+   chromosome are contiguous and their positions never decrease.
+   A leading "chr" is ignored, so chr1 and 1 are the same chromosome
+"""
+
+
+def isCoordinateSorted(filename, sep="\t"):
+    fh = openText(filename)
+    seen = set()
+    chrom = None
+    pos = 0
+    inOrder = True
+
+    for line in fh:
+        if line.startswith("#") or len(line.strip()) == 0:
+            continue
+        fields = line.split(sep)
+        c = fields[0].strip().replace("chr", "")
+        p = int(fields[1].strip())
+        if c != chrom:
+            if c in seen:
+                inOrder = False
+                break
+            seen.add(c)
+            chrom = c
+        elif p < pos:
+            inOrder = False
+            break
+        pos = p
+
+    fh.close()
+    return inOrder
+
+
 """Saves list of rows and columns in a text file
 """
 
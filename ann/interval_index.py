@@ -0,0 +1,480 @@
+# interval_index.py
+#
+# Point-overlap lookups for the AnnTools range stages: an in-memory
+# interval index and a sort-merge sweep over tables streamed in order
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import sys
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from heapq import heappush, heappop
+
+import numpy as np
+
+
+class IntervalIndex(object):
+    """
+    Per-chromosome index over closed [start, end] intervals.
+
+    Intervals are kept sorted by start and split into length classes (see
+    lengthClasses). Within a class no interval is longer than the class
+    span, so a point query only looks at the intervals of each class that
+    start between pos - span and pos, found with two bisects. A few long
+    intervals no longer make every query walk back to them: the
+    candidates of a query are bounded by the intervals near it in each
+    class, whatever the rest of the table holds.
+
+    Matches are returned ordered by start (ties in load order), which is
+    the order the (chrom, chromStart) index scan on the SQL side produces.
+
+    Subclasses may provide the per-chromosome arrays lazily by overriding
+    chromosome() (see snapshot.SnapshotTable).
+    """
+
+    def __init__(self):
+        self.columns = None
+        self._pending = {}
+        self.starts = {}
+        self.ends = {}
+        self.bins = {}
+        self.rows = {}
+
+    def add(self, chrom, start, end, row):
+        self._pending.setdefault(chrom, []).append((int(start), int(end), row))
+
+    def freeze(self):
+        for chrom, entries in self._pending.items():
+            # Stable sort keeps load order among equal starts
+            entries.sort(key=lambda e: e[0])
+            starts = [e[0] for e in entries]
+            ends = [e[1] for e in entries]
+            self.starts[chrom] = starts
+            self.ends[chrom] = ends
+            self.bins[chrom] = [
+                (span, [starts[i] for i in members], members)
+                for span, members in lengthClasses(starts, ends)
+            ]
+            self.rows[chrom] = [e[2] for e in entries]
+        self._pending = {}
+        return self
+
+    def __len__(self):
+        return sum(len(s) for s in self.starts.values())
+
+    def column(self, name):
+        return self.columns.index(name)
+
+    def chromosome(self, chrom):
+        """(starts, ends, bins, rows) of a chromosome, or None; bins are
+        the (span, starts, indices) of its length classes
+        """
+        if chrom not in self.starts:
+            return None
+        return self.starts[chrom], self.ends[chrom], self.bins[chrom], self.rows[chrom]
+
+    def countStartsBefore(self, starts, pos):
+        return bisect_left(starts, pos)
+
+    def countStartsUpTo(self, starts, pos):
+        return bisect_right(starts, pos)
+
+    def find(self, chrom, lo, hi=None):
+        """Indices (into the chromosome's arrays) of intervals overlapping
+        [lo, hi]; a point query when hi is omitted
+        """
+        arrays = self.chromosome(chrom)
+        if arrays is None:
+            return []
+        starts, ends, bins, rows = arrays
+        lo = int(lo)
+        hi = lo if hi is None else int(hi)
+        hits = []
+        for span, binStarts, members in bins:
+            first = self.countStartsBefore(binStarts, lo - span)
+            last = self.countStartsUpTo(binStarts, hi)
+            for j in range(first, last):
+                i = int(members[j])
+                if ends[i] >= lo:
+                    hits.append(i)
+        if len(bins) > 1:
+            hits.sort()
+        return hits
+
+    def fetchall(self, chrom, pos):
+        return self.fetchoverlap(chrom, pos, pos)
+
+    def fetchone(self, chrom, pos):
+        hits = self.find(chrom, pos)
+        if len(hits) == 0:
+            return None
+        return self.chromosome(chrom)[3][hits[0]]
+
+    def fetchoverlap(self, chrom, lo, hi):
+        """Rows whose interval overlaps [lo, hi]"""
+        hits = self.find(chrom, lo, hi)
+        if len(hits) == 0:
+            return []
+        rows = self.chromosome(chrom)[3]
+        return [rows[i] for i in hits]
+
+    def close(self):
+        pass
+
+
+# Intervals are classed by length in powers of LENGTH_CLASS_BASE; a class
+# of fewer than MIN_CLASS_SIZE intervals is merged into the next longer
+# one, so a query checks a few classes, each bounded in its candidates
+LENGTH_CLASS_BASE = 4
+MIN_CLASS_SIZE = 64
+
+
+"""Length classes of the intervals (starts, ends) of one chromosome,
+   sorted by start: (span, indices) from the shortest class up, span
+   being the longest end - start of the class and indices its intervals
+   in start order. An interval overlapping position p with start <= p
+   then starts at or after p - span.
+"""
+
+
+def lengthClasses(starts, ends):
+    lengths = np.maximum(
+        np.asarray(ends, dtype=np.int64) - np.asarray(starts, dtype=np.int64), 0
+    )
+    if len(lengths) == 0:
+        return []
+    # Class k holds the lengths below LENGTH_CLASS_BASE ** k
+    classes = np.zeros(len(lengths), dtype=np.int64)
+    bound = np.ones(len(lengths), dtype=np.int64)
+    while True:
+        longer = lengths >= bound
+        if not longer.any():
+            break
+        classes[longer] = classes[longer] + 1
+        bound = bound * LENGTH_CLASS_BASE
+
+    order = np.argsort(classes, kind="stable")
+    sizes = np.bincount(classes)
+    bins = []
+    pending = np.zeros(0, dtype=np.int64)
+    first = 0
+    for k in range(0, len(sizes)):
+        members = np.concatenate([pending, order[first : first + sizes[k]]])
+        first = first + sizes[k]
+        if len(members) < MIN_CLASS_SIZE and first < len(order):
+            pending = members
+            continue
+        members = np.sort(members)
+        bins.append((int(lengths[members].max()), members.tolist()))
+        pending = np.zeros(0, dtype=np.int64)
+    return bins
+
+
+# Candidate intervals findBatch checks at once; positions are searched in
+# chunks of about this many candidates, so memory stays bounded however
+# many positions a call is given
+BATCH_CANDIDATES = 1 << 20
+
+
+"""Point queries for many positions of one chromosome at once, against
+   the (starts, ends, bins) arrays of an IntervalIndex chromosome, the
+   bins' starts and indices as NumPy arrays
+
+   In each length class the candidates of a position are the intervals
+   starting from position - span to the position, found with
+   np.searchsorted; they are checked against their ends BATCH_CANDIDATES
+   at a time (see findChunk). Returns (offsets, hits): the matches of
+   positions[k] are hits[offsets[k]:offsets[k + 1]], ordered by start as
+   find() returns them.
+"""
+
+
+def findBatch(starts, ends, bins, positions):
+    positions = np.asarray(positions, dtype=np.int64)
+    ends = np.asarray(ends)
+    ranges = []
+    candidates = np.zeros(len(positions), dtype=np.int64)
+    for span, binStarts, members in bins:
+        lo = np.searchsorted(binStarts, positions - span, side="left")
+        hi = np.searchsorted(binStarts, positions, side="right")
+        ranges.append((lo, hi, members))
+        candidates = candidates + (hi - lo)
+
+    counts = np.zeros(len(positions), dtype=np.int64)
+    hits = []
+    upTo = np.cumsum(candidates)
+    first = 0
+    while first < len(positions):
+        before = upTo[first - 1] if first > 0 else 0
+        last = int(np.searchsorted(upTo, before + BATCH_CANDIDATES, side="right"))
+        last = max(last, first + 1)
+        chunkCounts, chunkHits = findChunk(ends, ranges, positions, first, last)
+        counts[first:last] = chunkCounts
+        hits.append(chunkHits)
+        first = last
+
+    offsets = np.zeros(len(positions) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    return offsets, np.concatenate([np.zeros(0, dtype=np.int64)] + hits)
+
+
+"""Matches of positions[first:last] given the (lo, hi, members) ranges
+   of candidates of each length class: (counts, hits), the number of
+   matches of each position and the matches, position after position
+"""
+
+
+def findChunk(ends, ranges, positions, first, last):
+    owners = []
+    found = []
+    for lo, hi, members in ranges:
+        lo = lo[first:last]
+        counts = hi[first:last] - lo
+        owner = np.repeat(np.arange(first, last), counts)
+        firsts = np.cumsum(counts) - counts
+        candidates = members[
+            np.arange(int(counts.sum())) - np.repeat(firsts - lo, counts)
+        ]
+        keep = ends[candidates] >= positions[owner]
+        owners.append(owner[keep])
+        found.append(candidates[keep])
+
+    owner = np.concatenate([np.zeros(0, dtype=np.int64)] + owners)
+    hits = np.concatenate([np.zeros(0, dtype=np.int64)] + found)
+    order = np.lexsort((hits, owner))
+    counts = np.bincount(owner - first, minlength=last - first)
+    return counts, hits[order]
+
+
+"""Load a whole reference table into an IntervalIndex with one query
+"""
+
+
+def loadIntervalIndex(
+    cursor, table, chromCol="chrom", startCol="chromStart", endCol="chromEnd"
+):
+    cursor.execute("select * from " + table + ";")
+    names = [str(d[0]) for d in cursor.description]
+    chrom_ind = names.index(chromCol)
+    start_ind = names.index(startCol)
+    end_ind = names.index(endCol)
+
+    index = IntervalIndex()
+    index.columns = names
+    for row in cursor.fetchall():
+        index.add(str(row[chrom_ind]), row[start_ind], row[end_ind], row)
+    return index.freeze()
+
+
+"""Estimated memory of an IntervalIndex in bytes: its arrays and rows
+"""
+
+
+def indexSize(index):
+    size = 0
+    for chrom, starts in index.starts.items():
+        size = size + 5 * sys.getsizeof(starts)
+        for row in index.rows[chrom]:
+            size = size + sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row)
+    return size
+
+
+class LazyIndexes(object):
+    """
+    Indexes loaded the first time they are asked for, with load(key), and
+    kept within an estimated memory budget (bytes): the least recently
+    used are evicted to make room. An index larger than the budget is
+    still loaded, alone.
+    """
+
+    def __init__(self, load, budget):
+        self.load = load
+        self.budget = budget
+        self.indexes = OrderedDict()
+        self.sizes = {}
+        self.used = 0
+
+    def get(self, key):
+        if key in self.indexes:
+            self.indexes.move_to_end(key)
+            return self.indexes[key]
+
+        index = self.load(key)
+        size = indexSize(index)
+        while len(self.indexes) > 0 and self.used + size > self.budget:
+            evicted, _ = self.indexes.popitem(last=False)
+            self.used = self.used - self.sizes.pop(evicted)
+        self.indexes[key] = index
+        self.sizes[key] = size
+        self.used = self.used + size
+        return index
+
+    def close(self):
+        self.indexes.clear()
+        self.sizes = {}
+        self.used = 0
+
+
+class PositionIndex(object):
+    """
+    Rows of a table matched on an exact position, in a hash map keyed by
+    (chrom, position); rows at the same position keep their load order
+    """
+
+    def __init__(self):
+        self.columns = None
+        self.rows = {}
+
+    def add(self, chrom, pos, row):
+        self.rows.setdefault((chrom, int(pos)), []).append(row)
+
+    def __len__(self):
+        return sum(len(r) for r in self.rows.values())
+
+    def column(self, name):
+        return self.columns.index(name)
+
+    def fetchall(self, chrom, pos):
+        return self.rows.get((str(chrom), int(pos)), [])
+
+    def fetchone(self, chrom, pos):
+        rows = self.fetchall(chrom, pos)
+        if len(rows) == 0:
+            return None
+        return rows[0]
+
+    def close(self):
+        pass
+
+
+"""Load a whole exact-position table into a PositionIndex with one query
+"""
+
+
+def loadPositionIndex(cursor, table, chromCol="chrom", posCol="chromStart"):
+    cursor.execute("select * from " + table + ";")
+    names = [str(d[0]) for d in cursor.description]
+    chrom_ind = names.index(chromCol)
+    pos_ind = names.index(posCol)
+
+    index = PositionIndex()
+    index.columns = names
+    for row in cursor.fetchall():
+        index.add(str(row[chrom_ind]), row[pos_ind], row)
+    return index
+
+
+class SweepLookup(object):
+    """
+    Sort-merge join of coordinate-sorted point queries against a reference
+    table streamed in (chrom, start) order.
+
+    Each chromosome is read with one sequential scan ordered by start.
+    Rows whose start has been passed are kept in a heap keyed by end and
+    dropped once the queries move beyond them, so memory is bounded by the
+    number of intervals active at the current position. Queries must come
+    grouped by chromosome with non-decreasing positions.
+
+    openCursor returns a new (ideally unbuffered) cursor; one is used per
+    chromosome. A dedicated connection passed as conn is closed with the
+    lookup.
+    """
+
+    def __init__(
+        self,
+        openCursor,
+        table,
+        chromCol="chrom",
+        startCol="chromStart",
+        endCol="chromEnd",
+        conn=None,
+    ):
+        self.openCursor = openCursor
+        self.conn = conn
+        self.table = table
+        self.chromCol = chromCol
+        self.startCol = startCol
+        self.endCol = endCol
+        self.cursor = None
+        self.chrom = None
+        self.pos = None
+        self.seen = set()
+        self.next = None
+        self.active = []
+        self.seq = 0
+
+    def _open(self, chrom):
+        self.closeCursor()
+        self.cursor = self.openCursor()
+        self.cursor.execute(
+            "select * from "
+            + self.table
+            + " where "
+            + self.chromCol
+            + '="'
+            + str(chrom)
+            + '" order by '
+            + self.startCol
+            + ";"
+        )
+        names = [str(d[0]) for d in self.cursor.description]
+        self.start_ind = names.index(self.startCol)
+        self.end_ind = names.index(self.endCol)
+        self.chrom = chrom
+        self.seen.add(chrom)
+        self.pos = None
+        self.active = []
+        self.next = self.cursor.fetchone()
+
+    def _advance(self, chrom, pos):
+        pos = int(pos)
+        if chrom != self.chrom:
+            if chrom in self.seen:
+                raise ValueError(
+                    f"{self.table}: {chrom} queried again after other chromosomes"
+                )
+            self._open(chrom)
+        elif pos < self.pos:
+            raise ValueError(
+                f"{self.table}: {chrom}:{pos} queried after {chrom}:{self.pos}"
+            )
+        self.pos = pos
+
+        while self.next is not None and int(self.next[self.start_ind]) <= pos:
+            end = int(self.next[self.end_ind])
+            if end >= pos:
+                heappush(self.active, (end, self.seq, self.next))
+                self.seq = self.seq + 1
+            self.next = self.cursor.fetchone()
+
+        while len(self.active) > 0 and self.active[0][0] < pos:
+            heappop(self.active)
+
+        # Stream order is start order
+        return [e[2] for e in sorted(self.active, key=lambda e: e[1])]
+
+    def fetchall(self, chrom, pos):
+        return self._advance(chrom, pos)
+
+    def fetchone(self, chrom, pos):
+        hits = self._advance(chrom, pos)
+        if len(hits) == 0:
+            return None
+        return hits[0]
+
+    def closeCursor(self):
+        if self.cursor is not None:
+            self.cursor.close()
+            self.cursor = None
+
+    def close(self):
+        self.closeCursor()
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+### EOF
@@ -0,0 +1,286 @@
+# layers.py
+#
+# Per-stage annotation layers of a job: what each stage changed in every
+# record, with the reference version it used, so that a re-annotation
+# recomputes only the stages whose reference tables changed and splices
+# the stored layers of the others back in
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import json
+import os
+from collections import deque
+
+import file_utils as fu
+import records as rec
+
+LAYERS_VERSION = 1
+
+# Layer settings of the running job (see Layers); set by driver.run and
+# driver.reannotate, None when layers are not recorded
+active = None
+
+
+class Layers(object):
+    """
+    Reference versions of the job's stages: versions maps a table name
+    (lower case, as configparser keys are) to its version, and a stage's
+    version names the versions of all the tables it reads.
+    """
+
+    def __init__(self, versions=None):
+        self.versions = dict((k.lower(), v) for k, v in (versions or {}).items())
+
+    def stageVersion(self, tables):
+        return ";".join(t + "=" + str(self.versions.get(t.lower(), "")) for t in tables)
+
+
+"""Directory of the layers of a job: test.vcf -> test.vcf.layers
+"""
+
+
+def layerDirectory(base):
+    return base + ".layers"
+
+
+"""Layer and count log block file names of the stage-th stage (1-based)
+"""
+
+
+def layerFiles(directory, stage):
+    name = os.path.join(directory, "%02d" % stage)
+    return name + ".layer", name + ".log"
+
+
+"""Edits turning a stage's input line into its output line, by column:
+   [c, "s"] prefixes a space (as the gadAll stage does to every column
+   but the first), [c, "a", text] appends text, [c, "sa", text] does
+   both, [c, "r", text] replaces the column; [-1, "r", line] replaces a
+   line whose columns changed in number
+"""
+
+
+def lineEdits(before, after):
+    if before == after:
+        return []
+    cols = before.split("\t")
+    out = after.split("\t")
+    if len(cols) != len(out):
+        return [[-1, "r", after]]
+    edits = []
+    for c in range(0, len(cols)):
+        if out[c] == cols[c]:
+            continue
+        if out[c] == " " + cols[c]:
+            edits.append([c, "s"])
+        elif out[c].startswith(cols[c]):
+            edits.append([c, "a", out[c][len(cols[c]) :]])
+        elif out[c].startswith(" " + cols[c]):
+            edits.append([c, "sa", out[c][len(cols[c]) + 1 :]])
+        else:
+            edits.append([c, "r", out[c]])
+    return edits
+
+
+def applyEdits(edits, line):
+    if len(edits) == 0:
+        return line
+    if edits[0][0] == -1:
+        return edits[0][2]
+    cols = line.split("\t")
+    for edit in edits:
+        c = edit[0]
+        if edit[1] == "s":
+            cols[c] = " " + cols[c]
+        elif edit[1] == "a":
+            cols[c] = cols[c] + edit[2]
+        elif edit[1] == "sa":
+            cols[c] = " " + cols[c] + edit[2]
+        else:
+            cols[c] = edit[2]
+    return "\t".join(cols)
+
+
+"""The edits of a stage that annotates from the variant alone, carried
+   over to its record after an earlier stage changed it, or None if they
+   do not carry over. Spaces on any column and text appended to INFO
+   do; the stages start that text with ";" unless INFO already ends with
+   one (semicolon: it did when the edits were recorded), so the ";" is
+   added or dropped to match the record now, except for fixedSeparator
+   stages, which always start with ";".
+"""
+
+
+def rebaseEdits(edits, semicolon, line, fixedSeparator=False):
+    for edit in edits:
+        if edit[0] == -1 or edit[1] == "r":
+            return None
+        if edit[0] != rec.INFO and edit[1] != "s":
+            return None
+
+    now = 1 if endsWithSemicolon(line) else 0
+    if fixedSeparator or now == semicolon:
+        return edits
+    rebased = []
+    for edit in edits:
+        if edit[1] in ["a", "sa"] and len(edit[2]) > 0:
+            if now == 0:
+                edit = [edit[0], edit[1], ";" + edit[2]]
+            elif edit[2].startswith(";"):
+                edit = [edit[0], edit[1], edit[2][1:]]
+            else:
+                return None
+        rebased.append(edit)
+    return rebased
+
+
+def endsWithSemicolon(line):
+    cols = line.split("\t")
+    return len(cols) > rec.INFO and cols[rec.INFO].endswith(";")
+
+
+"""Layer file line of one record (or, with a "#", of a header line):
+   the edits, and for records whether INFO ended with ";" before them
+"""
+
+
+def layerLine(before, after):
+    edits = lineEdits(before, after)
+    if before.startswith("#"):
+        return "#" + json.dumps(edits)
+    return json.dumps([1 if endsWithSemicolon(before) else 0, edits])
+
+
+def parseLayerLine(line):
+    if line.startswith("#"):
+        return None, json.loads(line[1:])
+    semicolon, edits = json.loads(line)
+    return semicolon, edits
+
+
+class LayerLog(object):
+    """
+    The count log handle given to a stage: writes go to the job's count
+    log and are kept as the stage's block
+    """
+
+    def __init__(self, fh_log):
+        self.fh_log = fh_log
+        self.text = []
+
+    def write(self, text):
+        self.text.append(text)
+        return self.fh_log.write(text)
+
+    def getvalue(self):
+        return "".join(self.text)
+
+
+class LayerRecorder(object):
+    """
+    Records the layer of one stage while it runs: inputs() hands the
+    stage its lines, outputs() pairs each line the stage yields with the
+    line it read (stages yield one line per line) and writes the layer,
+    then the stage's count log block
+    """
+
+    def __init__(self, directory, stage):
+        self.layerfile, self.logfile = layerFiles(directory, stage)
+        self.pending = deque()
+        self.log = None
+
+    def inputs(self, lines):
+        for line in lines:
+            self.pending.append(str(line).strip())
+            yield line
+
+    def outputs(self, lines):
+        fh = open(self.layerfile, "w")
+        for line in lines:
+            fh.write(layerLine(self.pending.popleft(), str(line)) + "\n")
+            yield line
+        fh.close()
+        if len(self.pending) > 0:
+            raise ValueError(self.layerfile + ": the stage dropped lines")
+        fh = open(self.logfile, "w")
+        fh.write(self.log.getvalue() if self.log is not None else "")
+        fh.close()
+
+    def stage(self, stage):
+        """stage, recording its layer"""
+
+        def recorded(lines, fh_log, **kwargs):
+            self.log = LayerLog(fh_log)
+            return self.outputs(stage(self.inputs(lines), self.log, **kwargs))
+
+        return recorded
+
+
+"""Applies the layer of a stage to infile, writing what the stage wrote;
+   with rebase, infile may differ from the stage's recorded input: the
+   layer is rewritten on infile, or False is returned (outfile and layer
+   left incomplete and as they were) if a record's edits do not carry
+   over (see rebaseEdits)
+"""
+
+
+def applyLayer(infile, layerfile, outfile, rebase=False, fixedSeparator=False):
+    fh = fu.openText(infile)
+    fh_layer = open(layerfile)
+    fh_out = open(outfile, "w")
+    fh_rebased = open(layerfile + ".tmp", "w") if rebase else None
+    ok = True
+    for line in fh:
+        line = line.strip()
+        semicolon, edits = parseLayerLine(fh_layer.readline())
+        if rebase:
+            if semicolon is not None:
+                edits = rebaseEdits(edits, semicolon, line, fixedSeparator)
+                if edits is None:
+                    ok = False
+                    break
+                fh_rebased.write(json.dumps([1 if endsWithSemicolon(line) else 0, edits]) + "\n")
+            else:
+                fh_rebased.write("#" + json.dumps(edits) + "\n")
+        fh_out.write(applyEdits(edits, line) + "\n")
+    if ok and len(fh_layer.readline()) > 0:
+        raise ValueError(layerfile + " has more lines than " + infile)
+    fh.close()
+    fh_layer.close()
+    fh_out.close()
+    if fh_rebased is not None:
+        fh_rebased.close()
+        if ok:
+            os.replace(layerfile + ".tmp", layerfile)
+        else:
+            os.remove(layerfile + ".tmp")
+    return ok
+
+
+"""The manifest of a job's layers: its input and, per stage, the label
+   and reference version of the layer
+"""
+
+
+def readManifest(directory):
+    fh = open(os.path.join(directory, "manifest.json"))
+    manifest = json.load(fh)
+    fh.close()
+    return manifest
+
+
+def writeManifest(directory, input, stages):
+    manifest = {"version": LAYERS_VERSION, "input": input, "stages": stages}
+    fh = open(os.path.join(directory, "manifest.json") + ".tmp", "w")
+    json.dump(manifest, fh, indent=1)
+    fh.close()
+    os.replace(
+        os.path.join(directory, "manifest.json") + ".tmp",
+        os.path.join(directory, "manifest.json"),
+    )
+
+
+### EOF
@@ -0,0 +1,456 @@
+# planner.py
+#
+# Cost-based choice of the annotation engine of each stage of a job, from
+# the number of variants and the sizes of the reference tables
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import math
+import os
+import time
+
+import pymysql
+
+import file_utils as fu
+import utils as u
+import annotate as ann
+import snapshot as sn
+import stages as stg
+
+# Engine setting (Engine in annotator_config.ini) that has the planner
+# choose each stage's engine
+PLANNED_ENGINE = "auto"
+
+# Engines the planner chooses from by default; sweep needs a scan of the
+# input to find it sorted, so it is only considered when asked for
+PLANNER_ENGINES = ["sql", "batch", "index", "join", "snapshot"]
+
+# Memory (MB) of the tables a job may load whole (per worker)
+PLANNER_MEMORY_MB = 2048
+
+# Estimated costs, in seconds: a round trip of an indexed query, a join
+# of a window of variants and the setup of the variants table, and per
+# variant or per row the work of each way of reading a table
+QUERY_SECONDS = 0.0005
+JOIN_QUERY_SECONDS = 0.05
+UPLOAD_SETUP_SECONDS = 0.1
+BATCH_KEY_SECONDS = 0.00002
+UPLOAD_SECONDS = 0.00001
+JOIN_ROW_SECONDS = 0.00002
+LOAD_ROW_SECONDS = 0.000004
+STREAM_ROW_SECONDS = 0.000002
+SEARCH_SECONDS = 0.000005
+SNAPSHOT_SEARCH_SECONDS = 0.00001
+
+# Memory of a table row loaded into an interval index
+ROW_BYTES = 200
+
+# Chromosomes the variants of a job are taken to spread over, for the
+# per-chromosome loads of the region track
+TRACK_CHROMOSOMES = 24
+
+# Variants per dbSNP query, unless the stage's options set batch_size
+DBSNP_BATCH_SIZE = 5000
+
+# Seconds the table statistics are reused before they are read again
+STATISTICS_TTL = (
+    int(os.environ["STATISTICS_TTL"]) if ("STATISTICS_TTL" in os.environ) else 3600
+)
+
+# Rows a table is counted up to, when information_schema has no
+# estimate of it
+COUNT_ROWS_LIMIT = 1000000
+
+# Process-wide cache of the table statistics, and the tables looked up
+# in it (known or not)
+_statistics = None
+_statistics_expires = 0
+_statistics_tables = set()
+
+
+"""Rows of the tables of the reference database, from the estimates of
+   information_schema, or by counting the rows of the tables asked for
+   when those are not available; reused for STATISTICS_TTL seconds.
+   Tables that could not be counted, or have COUNT_ROWS_LIMIT rows or
+   more, are missing. Without a database, no table is known.
+"""
+
+
+def tableStatistics(tables):
+    global _statistics, _statistics_expires, _statistics_tables
+
+    refresh = _statistics is None or time.time() >= _statistics_expires
+    if refresh:
+        _statistics = {}
+        _statistics_tables = set()
+        _statistics_expires = time.time() + STATISTICS_TTL
+    missing = [t for t in tables if t not in _statistics_tables]
+    if len(missing) == 0:
+        return _statistics
+    _statistics_tables.update(missing)
+
+    try:
+        conn = u.db_connect()
+    except pymysql.MySQLError as e:
+        print(f"No table statistics; the reference database is unreachable: {e}")
+        return _statistics
+
+    if refresh:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "select table_name, table_rows from information_schema.tables "
+                + "where table_schema = database();"
+            )
+            for name, rows in cursor.fetchall():
+                if rows is not None:
+                    _statistics[str(name)] = int(rows)
+        except pymysql.MySQLError as e:
+            print(f"No table statistics in information_schema ({e}); counting rows")
+        finally:
+            cursor.close()
+
+    for table in missing:
+        if len(tableNames(_statistics, table)) > 0:
+            continue
+        try:
+            rows = countRows(conn, table)
+        except pymysql.err.ProgrammingError:
+            # No such table, e.g. one split by chromosome, which only
+            # information_schema knows
+            continue
+        except pymysql.MySQLError as e:
+            print(f"Table statistics incomplete; counting rows failed: {e}")
+            break
+        if rows is not None:
+            _statistics[table] = rows
+    conn.close()
+    return _statistics
+
+
+"""Rows of a table, or None if it has COUNT_ROWS_LIMIT rows or more: a
+   table that big (e.g. dbSNP) is not scanned at planning time
+"""
+
+
+def countRows(conn, table):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "select count(*) from (select 1 from "
+            + table
+            + " limit "
+            + str(COUNT_ROWS_LIMIT)
+            + ") as limited;"
+        )
+        rows = int(cursor.fetchone()[0])
+    finally:
+        cursor.close()
+    if rows >= COUNT_ROWS_LIMIT:
+        return None
+    return rows
+
+
+"""Names under which a table is stored: itself, or its per-chromosome
+   tables (tfbsConsSites1, ..., tfbsConsSitesY) when it is split
+"""
+
+
+def tableNames(names, table):
+    if table in names:
+        return [table]
+    return [
+        n
+        for n in names
+        if n.startswith(table) and n[len(table) :] in ann.TFBS_CHROMOSOMES
+    ]
+
+
+"""Rows of a table in statistics, or None if unknown
+"""
+
+
+def tableRows(statistics, table):
+    names = tableNames(statistics, table)
+    if len(names) == 0:
+        return None
+    return sum(statistics[n] for n in names)
+
+
+class StagePlan(object):
+    """
+    The engine chosen for a stage, how it then reads its tables (see
+    stages.ACCESS_QUERY) and its estimated seconds, with those of the
+    other engines considered; fixed stages keep the engine of their
+    options
+    """
+
+    def __init__(self, label, engine, access, seconds, costs, fixed=False):
+        self.label = label
+        self.engine = engine
+        self.access = access
+        self.seconds = seconds
+        self.costs = costs
+        self.fixed = fixed
+
+    def report(self):
+        return {
+            "label": self.label,
+            "engine": self.engine,
+            "access": self.access,
+            "estimated_seconds": None if self.fixed else round(self.seconds, 6),
+            "fixed": self.fixed,
+            "costs": dict((e, round(s, 6)) for e, s in self.costs.items()),
+        }
+
+
+class JobPlan(object):
+    """
+    The plan of a job: the variants it was made for and a StagePlan per
+    stage, plus the upload of the variants when a stage joins with them
+    """
+
+    def __init__(self, variants, stages, uploadSeconds):
+        self.variants = variants
+        self.stages = stages
+        self.uploadSeconds = uploadSeconds
+
+    def seconds(self):
+        return self.uploadSeconds + sum(
+            s.seconds for s in self.stages if s.seconds is not None
+        )
+
+    def engine(self):
+        """Most used engine of the plan, the job-wide engine"""
+        engines = [s.engine for s in self.stages]
+        if len(engines) == 0:
+            return "sql"
+        return max(ann.ENGINES, key=lambda e: engines.count(e))
+
+    def options(self, options=None):
+        """options with the engine of every stage set"""
+        planned = dict((label, dict(o)) for label, o in (options or {}).items())
+        for s in self.stages:
+            planned.setdefault(s.label, {})["engine"] = s.engine
+        return planned
+
+    def report(self):
+        return {
+            "variants": self.variants,
+            "estimated_seconds": round(self.seconds(), 6),
+            "upload_seconds": round(self.uploadSeconds, 6),
+            "stages": [s.report() for s in self.stages],
+        }
+
+    def log(self):
+        print(
+            f"Plan for about {self.variants} variants, "
+            + f"estimated {self.seconds():.2f} seconds:"
+        )
+        if self.uploadSeconds > 0:
+            print(f"  upload of the variants: {self.uploadSeconds:.2f} s")
+        for s in self.stages:
+            if s.fixed:
+                print(f"  {s.label}: {s.engine} ({s.access}), set by the options")
+                continue
+            others = ", ".join(
+                f"{e} {c:.2f} s" for e, c in s.costs.items() if e != s.engine
+            )
+            print(
+                f"  {s.label}: {s.engine} ({s.access}), estimated {s.seconds:.2f} s"
+                + (f" [{others}]" if len(others) > 0 else "")
+            )
+
+
+"""Estimated seconds for a stage to read its tables (of rows in all, None
+   if unknown) by access, for variants spread over workers; None if it
+   cannot, e.g. the tables would not fit in memory (bytes of each worker,
+   which loads its own copy)
+"""
+
+
+def accessSeconds(access, variants, rows, queries, workers, batchSize, memory):
+    perWorker = float(variants) / max(workers, 1)
+    if access == stg.ACCESS_QUERY:
+        return perWorker * queries * QUERY_SECONDS
+    if access == stg.ACCESS_BATCH:
+        return math.ceil(perWorker / batchSize) * QUERY_SECONDS + (
+            perWorker * BATCH_KEY_SECONDS
+        )
+    if access == stg.ACCESS_JOIN:
+        return math.ceil(perWorker / ann.JOIN_WINDOW) * JOIN_QUERY_SECONDS + (
+            perWorker * JOIN_ROW_SECONDS
+        )
+    if access == stg.ACCESS_SNAPSHOT:
+        return perWorker * SNAPSHOT_SEARCH_SECONDS
+    if rows is None:
+        return None
+    if access == stg.ACCESS_LOAD:
+        if rows * ROW_BYTES > memory:
+            return None
+        return QUERY_SECONDS + rows * LOAD_ROW_SECONDS + perWorker * SEARCH_SECONDS
+    if access == stg.ACCESS_STREAM:
+        return QUERY_SECONDS + rows * STREAM_ROW_SECONDS + perWorker * SEARCH_SECONDS
+    return None
+
+
+"""Estimated seconds for a region track stage (see stages.Stage) to load
+   the chromosomes of its tables (of rows in all, None if unknown) under
+   engine, for variants spread over workers: every chromosome with a
+   variant under ann.REGION_TRACK_ENGINES, and under the others those
+   with ann.REGION_TRACK_VARIANTS variants, taking the variants to be
+   spread evenly over TRACK_CHROMOSOMES chromosomes
+"""
+
+
+def trackSeconds(engine, variants, rows, tables, workers):
+    perWorker = float(variants) / max(workers, 1)
+    if (
+        engine not in ann.REGION_TRACK_ENGINES
+        and perWorker / TRACK_CHROMOSOMES < ann.REGION_TRACK_VARIANTS
+    ):
+        return 0
+    chromosomes = min(perWorker, TRACK_CHROMOSOMES / float(max(workers, 1)))
+    seconds = 0
+    if engine != "snapshot":
+        seconds = chromosomes * tables * QUERY_SECONDS
+    if rows is not None:
+        seconds = seconds + rows * chromosomes / TRACK_CHROMOSOMES * LOAD_ROW_SECONDS
+    return seconds
+
+
+"""Whether the snapshot has all the tables
+"""
+
+
+def inSnapshot(snapshot, tables):
+    names = snapshot.manifest["tables"]
+    return all(len(tableNames(names, t)) > 0 for t in tables)
+
+
+"""Plans the stages (see driver.jobStages) of the job of infile: for each
+   stage the engine of candidates with the lowest estimated cost. Stages
+   whose options name an engine keep it. A table is loaded whole only
+   while the tables loaded before it leave room in memory_mb, the memory
+   of each of the workers; the upload
+   of the variants is charged once if any stage joins with them, and
+   the plan without joins taken when it costs less.
+"""
+
+
+def planJob(
+    infile,
+    format,
+    stages,
+    options=None,
+    candidates=None,
+    snapshot_dir=None,
+    workers=1,
+    memory_mb=PLANNER_MEMORY_MB,
+):
+    candidates = list(candidates or PLANNER_ENGINES)
+    for engine in candidates:
+        if engine not in ann.ENGINES:
+            raise ValueError(f"Unknown annotation engine: {engine}")
+    options = options or {}
+    variants = fu.estimateRecords(infile)
+
+    snapshot = None
+    if "snapshot" in candidates:
+        try:
+            snapshot = sn.openSnapshot(snapshot_dir)
+        except (OSError, TypeError, ValueError) as e:
+            print(f"No reference snapshot to plan with: {e}")
+    if snapshot is None and "snapshot" in candidates:
+        candidates.remove("snapshot")
+    if "sweep" in candidates and not fu.isCoordinateSorted(infile):
+        candidates.remove("sweep")
+
+    tables = set()
+    for label, _, kwargs in stages:
+        tables.update(stg.stageTables(label, kwargs))
+    statistics = {}
+    if len(set(candidates) & set(["index", "sweep"])) > 0 or any(
+        stg.stage(label).regionTrack for label, _, _ in stages
+    ):
+        statistics = tableStatistics(sorted(tables))
+
+    plans = []
+    for engines in [candidates, [e for e in candidates if e != "join"]]:
+        plans.append(
+            planStages(
+                variants,
+                stages,
+                options,
+                engines,
+                snapshot,
+                statistics,
+                workers,
+                memory_mb,
+            )
+        )
+    plan = min(plans, key=lambda p: p.seconds())
+    plan.log()
+    return plan
+
+
+def planStages(
+    variants, stages, options, candidates, snapshot, statistics, workers, memory_mb
+):
+    memory = memory_mb * 1024 * 1024
+    plans = []
+    for label, _, kwargs in stages:
+        stage = stg.stage(label)
+        tables = stg.stageTables(label, kwargs)
+        rows = None
+        if all(tableRows(statistics, t) is not None for t in tables):
+            rows = sum(tableRows(statistics, t) for t in tables)
+        batchSize = options.get(label, {}).get("batch_size", DBSNP_BATCH_SIZE)
+
+        if "engine" in options.get(label, {}):
+            engine = options[label]["engine"]
+            plans.append(
+                StagePlan(label, engine, stage.accessFor(engine), None, {}, fixed=True)
+            )
+            continue
+
+        costs = {}
+        for engine in candidates:
+            if engine == "snapshot" and not inSnapshot(snapshot, tables):
+                continue
+            access = stage.accessFor(engine)
+            seconds = accessSeconds(
+                access, variants, rows, stage.queries, workers, batchSize, memory
+            )
+            if seconds is not None:
+                costs[engine] = seconds
+        if len(costs) == 0:
+            costs["sql"] = accessSeconds(
+                stg.ACCESS_QUERY, variants, rows, stage.queries, workers, batchSize, memory
+            )
+        if stage.regionTrack:
+            for engine in costs:
+                costs[engine] = costs[engine] + trackSeconds(
+                    engine, variants, rows, len(tables), workers
+                )
+        engine = min(costs, key=lambda e: (costs[e], ann.ENGINES.index(e)))
+        access = stage.accessFor(engine)
+        if access == stg.ACCESS_LOAD:
+            memory = memory - rows * ROW_BYTES
+        plans.append(StagePlan(label, engine, access, costs[engine], costs))
+
+    uploadSeconds = 0
+    if any(p.access == stg.ACCESS_JOIN for p in plans):
+        perWorker = float(variants) / max(workers, 1)
+        uploadSeconds = (
+            UPLOAD_SETUP_SECONDS
+            + math.ceil(perWorker / ann.JOB_VARIANTS_INSERT) * QUERY_SECONDS
+            + perWorker * UPLOAD_SECONDS
+        )
+    return JobPlan(variants, plans, uploadSeconds)
+
+
+### EOF
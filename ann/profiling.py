@@ -0,0 +1,311 @@
+# profiling.py
+#
+# Per-stage instrumentation of an annotation job: wall and CPU time,
+# records, SQL queries with their latency and rows, peak RSS. Written as
+# <job>.profile.json next to the count log.
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import json
+import resource
+import time
+from bisect import bisect_left
+
+PROFILE_VERSION = 1
+
+# Upper bounds (milliseconds) of the SQL latency histogram buckets; the
+# last bucket counts everything slower
+LATENCY_BUCKETS_MS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000]
+
+
+def peakRss():
+    """Peak resident set size of this process in kB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class StageProfile(object):
+    """
+    Counters of one stage (or pre-/post-processing phase). Times are the
+    stage's own: time spent in the stages feeding it is subtracted.
+    """
+
+    def __init__(self, label):
+        self.label = label
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.childWall = 0.0
+        self.childCpu = 0.0
+        self.records = 0
+        self.queries = 0
+        self.sqlSeconds = 0.0
+        self.rowsFetched = 0
+        self.latency = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.peakRss = 0
+
+    def query(self, seconds):
+        self.queries = self.queries + 1
+        self.sqlSeconds = self.sqlSeconds + seconds
+        self.latency[bisect_left(LATENCY_BUCKETS_MS, seconds * 1000.0)] += 1
+
+    def report(self):
+        return {
+            "label": self.label,
+            "wall_seconds": round(self.wall - self.childWall, 6),
+            "cpu_seconds": round(self.cpu - self.childCpu, 6),
+            "records": self.records,
+            "sql_queries": self.queries,
+            "sql_seconds": round(self.sqlSeconds, 6),
+            "sql_latency_histogram": self.latency,
+            "rows_fetched": self.rowsFetched,
+            "peak_rss_kb": self.peakRss,
+        }
+
+
+class Profile(object):
+    """
+    Profile of one job. Stages are timed on every step of their
+    generator; steps nest when stages are chained, and whichever stage is
+    innermost is charged for the SQL issued meanwhile.
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.byLabel = {}
+        self.running = []
+        self.shardStages = []
+        self.shardPeakRss = 0
+        self.start = time.perf_counter()
+        self.cpuStart = time.process_time()
+
+    def get(self, label):
+        if label not in self.byLabel:
+            self.byLabel[label] = StageProfile(label)
+            self.stages.append(self.byLabel[label])
+        return self.byLabel[label]
+
+    def current(self):
+        if len(self.running) == 0:
+            return None
+        return self.running[-1]
+
+    def enter(self, stage):
+        self.running.append(stage)
+        return time.perf_counter(), time.process_time()
+
+    def leave(self, stage, started):
+        wall = time.perf_counter() - started[0]
+        cpu = time.process_time() - started[1]
+        self.running.pop()
+        stage.wall = stage.wall + wall
+        stage.cpu = stage.cpu + cpu
+        if len(self.running) > 0:
+            self.running[-1].childWall = self.running[-1].childWall + wall
+            self.running[-1].childCpu = self.running[-1].childCpu + cpu
+
+    def stage(self, label, lines):
+        """Times the stage generator lines and counts the records it yields"""
+        # Registered now, so stages are reported in pipeline order
+        return self.timed(self.get(label), lines)
+
+    def timed(self, stage, lines):
+        while True:
+            started = self.enter(stage)
+            try:
+                line = next(lines)
+            except StopIteration:
+                self.leave(stage, started)
+                stage.peakRss = peakRss()
+                return
+            self.leave(stage, started)
+            if not line.startswith("#"):
+                stage.records = stage.records + 1
+            yield line
+
+    def phase(self, label):
+        """Context manager timing work outside the stages"""
+        return Phase(self, self.get(label))
+
+    def addShards(self, stages, peakRss):
+        """Stages of the shards of a parallel job, see mergeProfiles"""
+        self.shardStages = stages
+        self.shardPeakRss = peakRss
+
+    def report(self, **job):
+        # CPU time of this process only; with shards, see their stages
+        report = {
+            "version": PROFILE_VERSION,
+            "wall_seconds": round(time.perf_counter() - self.start, 6),
+            "cpu_seconds": round(time.process_time() - self.cpuStart, 6),
+            "peak_rss_kb": max(peakRss(), self.shardPeakRss),
+            "sql_latency_buckets_ms": LATENCY_BUCKETS_MS,
+            "stages": [s.report() for s in self.stages] + self.shardStages,
+        }
+        report.update(job)
+        return report
+
+
+class Phase(object):
+    def __init__(self, profile, stage):
+        self.profile = profile
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = self.profile.enter(self.stage)
+        return self.stage
+
+    def __exit__(self, *args):
+        self.profile.leave(self.stage, self.started)
+        self.stage.peakRss = peakRss()
+
+
+class ProfilingCursor(object):
+    """
+    Cursor charging its queries and fetched rows to the running stage
+    """
+
+    def __init__(self, profile, cursor):
+        self.profile = profile
+        self.cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def execute(self, sql, *args):
+        started = time.perf_counter()
+        result = self.cursor.execute(sql, *args)
+        stage = self.profile.current()
+        if stage is not None:
+            stage.query(time.perf_counter() - started)
+        return result
+
+    def _fetched(self, n):
+        stage = self.profile.current()
+        if stage is not None:
+            stage.rowsFetched = stage.rowsFetched + n
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            self._fetched(1)
+        return row
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self._fetched(len(rows))
+        return rows
+
+
+"""The profile of the job running in this process, if any
+"""
+
+active = None
+
+
+def start():
+    global active
+    active = Profile()
+    return active
+
+
+def stop():
+    global active
+    profile = active
+    active = None
+    return profile
+
+
+"""Wraps a cursor so its queries are profiled, when a job is profiled
+"""
+
+
+def profileCursor(cursor):
+    if active is None or cursor is None:
+        return cursor
+    return ProfilingCursor(active, cursor)
+
+
+"""Stage generator, timed when a job is profiled
+"""
+
+
+def profileStage(label, lines):
+    if active is None:
+        return lines
+    return active.stage(label, lines)
+
+
+"""Context manager timing a phase of the job (or doing nothing)
+"""
+
+
+def profilePhase(label):
+    if active is None:
+        return NoPhase()
+    return active.phase(label)
+
+
+class NoPhase(object):
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *args):
+        pass
+
+
+def writeProfile(filename, report):
+    fh = open(filename, "w")
+    json.dump(report, fh, indent=1)
+    fh.write("\n")
+    fh.close()
+
+
+"""Combines the profiles of the shards of a parallel job: the counters of
+   each stage are added up over the shards and the peak RSS is the
+   largest of any worker
+"""
+
+
+def mergeProfiles(filenames):
+    stages = []
+    byLabel = {}
+    peak = 0
+    for name in filenames:
+        fh = open(name)
+        report = json.load(fh)
+        fh.close()
+        peak = max(peak, report["peak_rss_kb"])
+        for s in report["stages"]:
+            if s["label"] not in byLabel:
+                byLabel[s["label"]] = dict(s)
+                stages.append(byLabel[s["label"]])
+                continue
+            merged = byLabel[s["label"]]
+            for key in [
+                "wall_seconds",
+                "cpu_seconds",
+                "records",
+                "sql_queries",
+                "sql_seconds",
+                "rows_fetched",
+            ]:
+                merged[key] = merged[key] + s[key]
+            merged["sql_latency_histogram"] = [
+                a + b
+                for a, b in zip(merged["sql_latency_histogram"], s["sql_latency_histogram"])
+            ]
+            merged["peak_rss_kb"] = max(merged["peak_rss_kb"], s["peak_rss_kb"])
+
+    for s in stages:
+        s["wall_seconds"] = round(s["wall_seconds"], 6)
+        s["cpu_seconds"] = round(s["cpu_seconds"], 6)
+        s["sql_seconds"] = round(s["sql_seconds"], 6)
+    return stages, peak
+
+
+### EOF
@@ -0,0 +1,98 @@
+# records.py
+#
+# Variant records passed between the annotation stages: split once, with
+# the INFO annotations of every stage appended as fragments and joined
+# only when the record is written
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+# Column of INFO in a VCF record
+INFO = 7
+
+
+class VariantRecord(object):
+    """
+    A record as a list of columns plus the fragments appended to its INFO
+    column since it was last read. str() gives the tab-separated line the
+    stages used to build with "\t".join(fields).
+
+    Stages treat records and header lines alike: strip() and startswith()
+    behave as they do on the line, so a record goes through a stage
+    without being serialized unless the stage reads its INFO (info()).
+    """
+
+    __slots__ = ("fields", "fragments")
+
+    def __init__(self, line, sep="\t"):
+        self.fields = line.split(sep)
+        self.fragments = []
+
+    def info(self):
+        """The INFO column, with the appended fragments"""
+        if len(self.fragments) > 0:
+            self.fields[INFO] = str(self.fields[INFO]) + "".join(self.fragments)
+            self.fragments = []
+        return self.fields[INFO]
+
+    def setInfo(self, text):
+        self.fragments = []
+        self.fields[INFO] = text
+
+    def addInfo(self, text):
+        self.fragments.append(text)
+
+    def infoEndsWith(self, suffix):
+        for fragment in reversed(self.fragments):
+            if len(fragment) >= len(suffix):
+                return fragment.endswith(suffix)
+            if len(fragment) > 0:
+                break
+        return str(self.info()).endswith(suffix)
+
+    def _last(self):
+        """Last non-empty piece of the last column (or "")"""
+        if len(self.fields) == INFO + 1:
+            for fragment in reversed(self.fragments):
+                if len(fragment) > 0:
+                    return fragment
+        return str(self.fields[-1])
+
+    def strip(self):
+        first = str(self.fields[0])
+        last = self._last()
+        if (
+            len(first) > 0
+            and not first[0].isspace()
+            and len(last) > 0
+            and not last[-1].isspace()
+        ):
+            return self
+        # Whitespace at either end: strip the line itself
+        return VariantRecord(str(self).strip())
+
+    def startswith(self, prefix):
+        first = str(self.fields[0])
+        if len(self.fields) == 1 or len(prefix) <= len(first):
+            return first.startswith(prefix)
+        return str(self).startswith(prefix)
+
+    def __str__(self):
+        if len(self.fragments) > 0:
+            self.info()
+        return "\t".join([str(x) for x in self.fields])
+
+
+"""The record of a line, which is split unless it already is a record
+"""
+
+
+def parse(line, sep="\t"):
+    if isinstance(line, VariantRecord):
+        return line
+    return VariantRecord(line, sep)
+
+
+### EOF
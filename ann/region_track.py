@@ -0,0 +1,115 @@
+# region_track.py
+#
+# Run-length encoded classification of every base of a chromosome: whether
+# a refGene transcript's query window covers it, and the CpG island of
+# cpgIslandExt that does
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+from array import array
+from bisect import bisect_right
+
+# Classes of a base, as bits. All ranges are closed, as
+# annotate.streamGenes tests them.
+WINDOW = 1  # within promoter_offset of a transcript: refGene query matches
+CPG_ISLAND = 2
+
+
+class RegionTrack(object):
+    """
+    Per-chromosome track of runs of bases with the same classes and the
+    same CpG island: one bisect classifies a position. Chromosomes are
+    added whole (addChromosome), from their transcripts and islands.
+
+    The island of a run is the first of those covering it by start, ties
+    in load order, which is the row a point query on cpgIslandExt returns
+    first.
+    """
+
+    def __init__(self, promoter_offset=500):
+        self.offset = int(promoter_offset)
+        self.starts = {}
+        self.classes = {}
+        self.islands = {}
+
+    def hasChromosome(self, chrom):
+        return chrom in self.starts
+
+    def addChromosome(self, chrom, transcripts, islands):
+        """transcripts: (txStart, txEnd); islands: (start, end, row) in
+        load order
+        """
+        events = []
+        for txStart, txEnd in transcripts:
+            if txStart - self.offset <= txEnd + self.offset:
+                events.append((txStart - self.offset, 1, WINDOW))
+                events.append((txEnd + self.offset + 1, -1, WINDOW))
+
+        for n, (start, end, row) in enumerate(islands):
+            if start <= end:
+                events.append((start, 1, (start, n, row)))
+                events.append((end + 1, -1, (start, n, row)))
+
+        events.sort(key=lambda e: e[0])
+        counts = {}
+        active = {}
+        bits = 0
+        starts = array("l")
+        classes = array("B")
+        runIslands = []
+
+        i = 0
+        while i < len(events):
+            pos = events[i][0]
+            while i < len(events) and events[i][0] == pos:
+                _, delta, what = events[i]
+                if isinstance(what, tuple):
+                    if delta > 0:
+                        active[what[1]] = what
+                    else:
+                        del active[what[1]]
+                else:
+                    counts[what] = counts.get(what, 0) + delta
+                    if counts[what] > 0:
+                        bits = bits | what
+                    else:
+                        bits = bits & ~what
+                i = i + 1
+
+            island = None
+            if len(active) > 0:
+                island = min(active.values(), key=lambda a: (a[0], a[1]))[2]
+            runBits = bits | (CPG_ISLAND if island is not None else 0)
+            if (
+                len(starts) > 0
+                and classes[-1] == runBits
+                and runIslands[-1] is island
+            ):
+                continue
+            starts.append(pos)
+            classes.append(runBits)
+            runIslands.append(island)
+
+        self.starts[chrom] = starts
+        self.classes[chrom] = classes
+        self.islands[chrom] = runIslands
+
+    def __len__(self):
+        """Number of runs"""
+        return sum(len(s) for s in self.starts.values())
+
+    def classify(self, chrom, pos):
+        """(classes, island row or None) of chrom:pos"""
+        starts = self.starts.get(chrom)
+        if starts is None:
+            return 0, None
+        i = bisect_right(starts, int(pos)) - 1
+        if i < 0:
+            return 0, None
+        return self.classes[chrom][i], self.islands[chrom][i]
+
+
+### EOF
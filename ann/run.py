@@ -14,6 +14,8 @@ import shutil
 import sys
 import time
 import driver
+import stages
+import checkpoint
 import boto3
 from datetime import datetime
 from botocore.exceptions import ClientError
@@ -120,6 +122,79 @@ def upload_file_to_s3(file_path, bucket, s3_key):
         return False
 
 
+class S3CheckpointStore(object):
+    """
+    Keeps copies of a job's checkpoint files (see checkpoint.py) under an
+    S3 prefix, so a job redelivered to another instance resumes too
+    """
+    def __init__(self, bucket, prefix):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.s3_client = boto3.client('s3', region_name=config['aws']['AwsRegionName'])
+
+    def put(self, file_path):
+        return upload_file_to_s3(file_path, self.bucket, f"{self.prefix}/{os.path.basename(file_path)}")
+
+    def get(self, file_path):
+        # download_file reference: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/download_file.html
+        try:
+            os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+            self.s3_client.download_file(self.bucket, f"{self.prefix}/{os.path.basename(file_path)}", file_path)
+            return True
+        except ClientError:
+            return False
+
+    def clear(self):
+        # list_objects_v2 reference: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/list_objects_v2.html
+        try:
+            paginator = self.s3_client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=f"{self.prefix}/"):
+                for obj in page.get('Contents', []):
+                    self.s3_client.delete_object(Bucket=self.bucket, Key=obj['Key'])
+        except ClientError as e:
+            print(f"Failed to delete checkpoint files under {self.prefix}: {e}")
+
+
+def upload_layers(layer_dir, bucket, s3_prefix):
+    """
+    Upload the annotation layers of a job (see layers.py)
+    """
+    uploaded = True
+    for name in sorted(os.listdir(layer_dir)):
+        uploaded = upload_file_to_s3(os.path.join(layer_dir, name), bucket, f"{s3_prefix}/{name}") and uploaded
+    return uploaded
+
+
+def download_layers(layer_dir, bucket, s3_prefix):
+    """
+    Download the annotation layers of a job; a job without layers is re-annotated in full
+    """
+    # list_objects_v2 reference: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/list_objects_v2.html
+    s3_client = boto3.client('s3', region_name=config['aws']['AwsRegionName'])
+    try:
+        os.makedirs(layer_dir, exist_ok=True)
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=f"{s3_prefix}/"):
+            for obj in page.get('Contents', []):
+                name = os.path.basename(obj['Key'])
+                s3_client.download_file(bucket, obj['Key'], os.path.join(layer_dir, name))
+        return True
+    except ClientError as e:
+        print(f"Failed to download layers from {bucket}/{s3_prefix}: {e}")
+        return False
+
+
+def reference_versions():
+    """
+    Versions of the reference tables ([references] in annotator_config.ini)
+    """
+    if not config.has_section('references'):
+        return {}
+    # The DEFAULT section (and the environment) shows through every section
+    defaults = config.defaults()
+    return {k: v for k, v in config.items('references', raw=True) if k not in defaults}
+
+
 def delete_local_file(file_path):
     """
     Delete a local file
@@ -137,6 +212,8 @@ def parse_arguments():
     parser.add_argument('--local_input_file', type=str, required=True, help='Local path to the input VCF file.')
     parser.add_argument('--s3_key', type=str, required=True, help='S3 key where the results will be stored.')
     parser.add_argument('--job_id', type=str, required=True, help='Job ID of the input VCF file.')
+    parser.add_argument('--reannotate', action='store_true',
+                        help='Re-annotate a completed job from its stored layers, redoing only the stages whose reference tables changed version.')
     return parser.parse_args()
 
 
@@ -164,27 +241,120 @@ def main():
     # Split the input file name to get the base file name (job_id~test.vcf -> job_id~test)
     base_file_name = os.path.basename(input_file).split('.vcf')[0]
     job_id = base_file_name.split('~')[0]
-    # test.vcf -> test.annot.vcf
+    # test.vcf -> test.annot.vcf (test.annot.vcf.gz when compressed, see bgzf.py)
+    compress = config.getboolean('ann', 'CompressOutput', fallback=False)
     output_file = f"{base_file_name}.annot.vcf"
+    if compress:
+        output_file = output_file + ".gz"
+    # test.annot.vcf.gz -> test.annot.vcf.gz.tbi (see tabix.py)
+    index = compress and config.getboolean('ann', 'IndexOutput', fallback=True)
+    index_file = f"{output_file}.tbi"
     # test.vcf -> test.vcf.count.log
     log_file = f"{base_file_name}.vcf.count.log"
+    # test.vcf -> test.vcf.profile.json (per-stage timings, see profiling.py)
+    profile_file = f"{base_file_name}.vcf.profile.json"
 
     # Define the paths for the output and log files (jobs/job_id/test.annot.vcf, jobs/job_id/test.vcf.count.log)
     # join reference: https://docs.python.org/3/library/os.path.html
     # os.path.join reference: https://docs.python.org/3/library/os.path.html
     output_file_path = os.path.join(job_dir, output_file)
     log_file_path = os.path.join(job_dir, log_file)
+    profile_file_path = os.path.join(job_dir, profile_file)
+    index_file_path = os.path.join(job_dir, index_file)
 
     s3_key_prefix = os.path.dirname(s3_key)
 
     # Define the S3 keys for the output and log files
     s3_key_result_file = f"{s3_key_prefix}/{output_file}"
     s3_key_log_file = f"{s3_key_prefix}/{log_file}"
+    s3_key_profile_file = f"{s3_key_prefix}/{profile_file}"
+    s3_key_index_file = f"{s3_key_prefix}/{index_file}"
+
+    # Per-stage annotation layers, kept with the results for --reannotate
+    # (test.vcf -> test.vcf.layers, see layers.py)
+    layers = args.reannotate or config.getboolean('ann', 'Layers', fallback=False)
+    layer_dir = os.path.join(job_dir, f"{base_file_name}.vcf.layers")
+    s3_key_layers = f"{s3_key_prefix}/layers"
+
+    # Completed stages and shards are checkpointed so a redelivered job
+    # resumes after them (see checkpoint.py)
+    checkpoint_store = None
+    if config.getboolean('ann', 'CheckpointToS3', fallback=False):
+        checkpoint_store = S3CheckpointStore(results_bucket, f"{s3_key_prefix}/checkpoint")
 
     # Run the AnnTools pipeline
 
+    # Annotation engine (see annotate.ENGINES)
+    engine = config.get('ann', 'Engine', fallback='sql')
+    # fused: single pass through all stages; staged: one temp file per stage
+    fused = config.get('ann', 'Pipeline', fallback='fused') == 'fused'
+    # Per-stage overrides; dbSNP lookups are resolved a window at a time,
+    # tfbsConsSites tables are kept in memory up to a budget
+    options = {
+        'dbSNP': {'batch_size': config.getint('ann', 'DbSnpBatchSize', fallback=5000)},
+        'addOverlapWithTfbsConsSites': {
+            'memory_budget_mb': config.getint('ann', 'TfbsMemoryBudgetMB', fallback=512)
+        },
+    }
+    # Engines the planner chooses from with Engine = auto (see planner.py)
+    planner_engines = [e.strip() for e in config.get('ann', 'PlannerEngines', fallback='').split(',') if e.strip()] or None
+    planner_memory_mb = config.getint('ann', 'PlannerMemoryMB', fallback=2048)
+    # Lookups shared with earlier jobs on this host (see site_cache.py)
+    site_cache = config.get('ann', 'SiteCache', fallback='') or None
+    site_cache_mb = config.getint('ann', 'SiteCacheMB', fallback=2048)
+    # dbSNP sites screened with a Bloom filter before querying (see bloom.py)
+    dbsnp_filter = config.get('ann', 'DbSnpFilter', fallback='') or None
+    # Stages to run in order, and engines of single stages (see stages.py)
+    pipeline = stages.parseStages(config.get('ann', 'Stages', fallback=''))
+    for label, stage_options in stages.parseStageEngines(
+        config.get('ann', 'StageEngines', fallback='')
+    ).items():
+        options.setdefault(label, {}).update(stage_options)
+
     with Timer():
-        driver.run(input_file, 'vcf')  # Assuming driver.run generates the files correctly
+        if args.reannotate:
+            download_layers(layer_dir, results_bucket, s3_key_layers)
+            driver.reannotate(
+                input_file,
+                'vcf',
+                engine=engine,
+                options=options,
+                snapshot_dir=config.get('ann', 'SnapshotDirectory', fallback=None),
+                reference_versions=reference_versions(),
+                compress=compress,
+                compress_threads=config.getint('ann', 'CompressionThreads', fallback=0),
+                index=index,
+                stages=pipeline,
+                planner_engines=planner_engines,
+                planner_memory_mb=planner_memory_mb,
+                site_cache=site_cache,
+                site_cache_mb=site_cache_mb,
+                dbsnp_filter=dbsnp_filter,
+            )
+        else:
+            driver.run(
+                input_file,
+                'vcf',
+                engine=engine,
+                fused=fused,
+                options=options,
+                snapshot_dir=config.get('ann', 'SnapshotDirectory', fallback=None),
+                workers=config.getint('ann', 'Workers', fallback=1),
+                profile=config.getboolean('ann', 'Profile', fallback=True),
+                compress=compress,
+                compress_threads=config.getint('ann', 'CompressionThreads', fallback=0),
+                index=index,
+                checkpoint=config.getboolean('ann', 'Checkpoint', fallback=True),
+                checkpoint_store=checkpoint_store,
+                layers=layers,
+                reference_versions=reference_versions(),
+                stages=pipeline,
+                planner_engines=planner_engines,
+                planner_memory_mb=planner_memory_mb,
+                site_cache=site_cache,
+                site_cache_mb=site_cache_mb,
+                dbsnp_filter=dbsnp_filter,
+            )  # Assuming driver.run generates the files correctly
 
     # Upload the output and log files to S3 and delete the local files
     # Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.upload_file
@@ -194,15 +364,35 @@ def main():
     # Upload the output and log files to S3
     output_upload_successful = upload_file_to_s3(output_file_path, results_bucket, s3_key_result_file)
     log_upload_successful = upload_file_to_s3(log_file_path, results_bucket, s3_key_log_file)
+    # The index sits next to the result, where tabix readers look for it;
+    # an unsorted result has none
+    index_upload_successful = True
+    if index and os.path.exists(index_file_path):
+        index_upload_successful = upload_file_to_s3(index_file_path, results_bucket, s3_key_index_file)
+    # The profile is diagnostic only: a failed upload does not hold the job back
+    if os.path.exists(profile_file_path):
+        if upload_file_to_s3(profile_file_path, results_bucket, s3_key_profile_file):
+            delete_local_file(profile_file_path)
+        else:
+            print(f"Failed to upload profile file: {profile_file_path}")
+    # Without its layers a job can still be re-annotated, in full
+    if layers and os.path.isdir(layer_dir):
+        if not upload_layers(layer_dir, results_bucket, s3_key_layers):
+            print(f"Failed to upload layers: {layer_dir}")
 
     # Check if the files were uploaded successfully
-    if output_upload_successful and log_upload_successful:
+    if output_upload_successful and log_upload_successful and index_upload_successful:
         print("Both files were successfully uploaded.")
         delete_local_file(output_file_path)
         delete_local_file(log_file_path)
+        if os.path.exists(index_file_path):
+            delete_local_file(index_file_path)
         # Update the DynamoDB entry with the S3 keys and completion time
         if update_dynamodb(job_id, results_bucket, s3_key_result_file, s3_key_log_file):
             print("DynamoDB updated successfully.")
+            # The job is complete: a redelivery must not resume it
+            if checkpoint.active is not None:
+                checkpoint.active.clear()
             delete_local_file(input_file)
             try:
                 shutil.rmtree(job_dir)  # Remove the job directory if empty
@@ -216,6 +406,8 @@ def main():
             print(f"Failed to upload output file: {output_file_path}")
         if not log_upload_successful:
             print(f"Failed to upload log file: {log_file_path}")
+        if not index_upload_successful:
+            print(f"Failed to upload index file: {index_file_path}")
         print("Files retained due to upload failure.")
 
 
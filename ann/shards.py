@@ -0,0 +1,151 @@
+# shards.py
+#
+# Splits a VCF into chromosome shards for parallel annotation and merges
+# the annotated shards and their count logs back into one job
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import re
+from array import array
+
+import file_utils as fu
+
+# Chromosomes large enough to be split further into position blocks
+SPLIT_CHROMOSOMES = ["1", "2"]
+BLOCK_SIZE = 50000000
+
+# Contigs beyond this many shards share the last one, to bound open files
+MAX_SHARDS = 256
+
+# Counts in the count logs: numbers standing alone between spaces (so not
+# the 3 of "In '3 UTR" nor the digits of a percentage)
+COUNT = re.compile(r"(?<!\S)\d+(?!\S)")
+
+
+"""Shard of a record: its chromosome, or chromosome and position block
+   for SPLIT_CHROMOSOMES
+"""
+
+
+def shardKey(chr, pos, block_size=BLOCK_SIZE):
+    if chr.startswith("chr"):
+        chr = chr.replace("chr", "")
+    if chr in SPLIT_CHROMOSOMES:
+        return chr + ":" + str(int(pos) // block_size)
+    return chr
+
+
+"""Splits infile into directory/<n>.vcf, each with the full header
+   Returns the shard file names and, for every record in input order, the
+   number of the shard it went to
+"""
+
+
+def splitVcf(infile, directory, inds, sep="\t", block_size=BLOCK_SIZE):
+    header = []
+    shards = {}
+    files = []
+    handles = []
+    order = array("H")
+
+    fh = fu.openText(infile)
+    for line in fh:
+        line = line.strip()
+        if line.startswith("#"):
+            header.append(line)
+            continue
+
+        fields = line.split(sep)
+        key = shardKey(fields[inds[0]].strip(), fields[inds[1]].strip(), block_size)
+        if key not in shards:
+            if len(files) < MAX_SHARDS:
+                files.append(os.path.join(directory, str(len(files)) + ".vcf"))
+                handles.append(open(files[-1], "w"))
+                for h in header:
+                    handles[-1].write(h + "\n")
+                shards[key] = len(files) - 1
+            else:
+                shards[key] = MAX_SHARDS - 1
+
+        n = shards[key]
+        handles[n].write(line + "\n")
+        order.append(n)
+    fh.close()
+
+    for h in handles:
+        h.close()
+    return files, order
+
+
+"""Writes the annotated shards to outfile with the records back in input
+   order; the header is taken from the first shard
+"""
+
+
+def mergeVcf(annotated, order, outfile):
+    fh_out = open(outfile, "w")
+
+    fh = open(annotated[0])
+    for line in fh:
+        if not line.startswith("#"):
+            break
+        fh_out.write(line)
+    fh.close()
+
+    handles = [open(name) for name in annotated]
+    records = [(line for line in h if not line.startswith("#")) for h in handles]
+    for n in order:
+        fh_out.write(next(records[n]))
+
+    for h in handles:
+        h.close()
+    fh_out.close()
+
+
+"""Writes the count log of the whole job from the count logs of its shards
+
+   Every shard log has the same lines with its own counts, which add up,
+   except for dbSNP: its Total is one more than the records seen and its
+   percentage is recomputed from the merged counts.
+"""
+
+
+def mergeCountLogs(logs, outfile):
+    contents = []
+    for name in logs:
+        fh = open(name)
+        contents.append(fh.read().splitlines())
+        fh.close()
+
+    if len(set([len(c) for c in contents])) != 1:
+        raise ValueError("Shard count logs have different lengths")
+
+    fh_out = open(outfile, "w")
+    total = 1
+    for lines in zip(*contents):
+        template = COUNT.sub("", lines[0])
+        for line in lines:
+            if COUNT.sub("", line) != template and not line.startswith("In dbSNP: "):
+                raise ValueError(f"Shard count logs differ: {lines[0]} / {line}")
+
+        counts = [[int(c) for c in COUNT.findall(line)] for line in lines]
+        sums = [sum(c) for c in zip(*counts)]
+
+        if lines[0].startswith("Total: "):
+            total = sums[0] - len(lines) + 1
+            fh_out.write(f"Total: {str(total)}\n")
+        elif lines[0].startswith("In dbSNP: "):
+            var_count = sum([c[0] for c in counts])
+            ratioInDbSnp = (var_count / float(total)) * 100
+            fh_out.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
+        else:
+            sums = iter(sums)
+            fh_out.write(COUNT.sub(lambda m: str(next(sums)), lines[0]) + "\n")
+    fh_out.close()
+
+
+### EOF
@@ -0,0 +1,286 @@
+# site_cache.py
+#
+# Host-wide cache of what the reference tables hold for each variant
+# site, shared by the jobs annotated on the host: the stages' lookups of
+# a site already seen in an earlier job are answered without the database
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import pickle
+import sqlite3
+import time
+
+import layers as ly
+
+# Engines whose lookups go to the database for every variant; the others
+# answer from memory or a window of variants at once, as cheaply as the
+# cache would
+CACHED_ENGINES = ["sql", "batch"]
+
+# Size (MB) the cache file is kept within by evicting the least recently
+# used sites
+SITE_CACHE_MB = 2048
+
+# Sites written (and hits recorded) per transaction, and evicted per
+# delete
+FLUSH_SITES = 1000
+EVICT_SITES = 1000
+
+# Seconds a job waits for another one writing the cache
+BUSY_TIMEOUT = 60
+
+SCHEMA = [
+    "create table if not exists sites ("
+    + "namespace text not null, version text not null, "
+    + "chrom text not null, pos text not null, ref text not null, alt text not null, "
+    + "results blob not null, used integer not null, "
+    + "primary key (namespace, version, chrom, pos, ref, alt));",
+    "create index if not exists sites_used on sites (used);",
+    "create table if not exists versions ("
+    + "namespace text primary key, version text not null);",
+]
+
+# Cache of the running job; set by driver.run and driver.reannotate,
+# None when disabled
+active = None
+
+
+class SiteCache(object):
+    """
+    The cache file, an SQLite database in WAL mode so concurrent jobs
+    read while one writes. A site's entry holds, for one stage namespace
+    (tables and engine) at the reference version of those tables, the
+    rows of every query the stage made for the site. Entries of another
+    version of a namespace are dropped when it is first used, and the
+    least recently used entries when the file outgrows maxMb. Only stages
+    whose every table has a version in versions are cached: without one
+    a refreshed table could not be told from the one cached.
+
+    Each process (e.g. a worker of a parallel run) opens its own
+    connection; entries are written in batches, and by finish().
+    """
+
+    def __init__(self, path, versions=None, maxMb=SITE_CACHE_MB):
+        self.path = path
+        self.layers = ly.Layers(versions)
+        self.maxBytes = maxMb * 1024 * 1024
+        self.unversioned = set()
+        self.conn = None
+        self.pid = None
+        self._connect()
+
+    def _connect(self):
+        if self.conn is not None and self.pid == os.getpid():
+            return self.conn
+        # A connection inherited from a parent process is never used
+        conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT)
+        conn.execute("pragma journal_mode=wal;")
+        conn.execute("pragma synchronous=normal;")
+        for sql in SCHEMA:
+            conn.execute(sql)
+        conn.commit()
+        self.conn = conn
+        self.pid = os.getpid()
+        self.pending = {}
+        self.touched = set()
+        self.stages = []
+        self.versions = {}
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        return conn
+
+    def stage(self, tables, engine):
+        """Cache of the lookups of a stage reading tables with engine, or
+        None if a table has no version
+        """
+        missing = [
+            t for t in tables if str(self.layers.versions.get(t.lower(), "")) == ""
+        ]
+        if len(missing) > 0:
+            if tuple(tables) not in self.unversioned:
+                self.unversioned.add(tuple(tables))
+                print(
+                    "Site cache: not used for "
+                    + ", ".join(tables)
+                    + "; no version in [references] for "
+                    + ", ".join(missing)
+                )
+            return None
+        namespace = ",".join(tables) + "/" + engine
+        version = self.layers.stageVersion(tables)
+        self._connect()
+        if self.versions.get(namespace) != version:
+            self._invalidate(namespace, version)
+            self.versions[namespace] = version
+        stage = StageCache(self, namespace, version)
+        self.stages.append(stage)
+        return stage
+
+    def _invalidate(self, namespace, version):
+        """Drops the entries of other versions of namespace"""
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "select version from versions where namespace = ?;", (namespace,)
+            ).fetchone()
+            if row is not None and row[0] == version:
+                return
+            if row is not None:
+                print(f"Site cache: {namespace} is now at {version}; dropping {row[0]}")
+            conn.execute(
+                "delete from sites where namespace = ? and version != ?;",
+                (namespace, version),
+            )
+            conn.execute(
+                "insert or replace into versions values (?, ?);", (namespace, version)
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"Site cache: failed to invalidate {namespace}: {e}")
+
+    def get(self, namespace, version, site):
+        """Results of a site (query -> rows), or None"""
+        try:
+            row = (
+                self._connect()
+                .execute(
+                    "select results from sites where namespace = ? and version = ? "
+                    + "and chrom = ? and pos = ? and ref = ? and alt = ?;",
+                    (namespace, version) + site,
+                )
+                .fetchone()
+            )
+        except sqlite3.Error as e:
+            print(f"Site cache: read failed: {e}")
+            return None
+        if row is None:
+            return None
+        self.touched.add((namespace, version) + site)
+        return pickle.loads(row[0])
+
+    def put(self, namespace, version, site, results):
+        self.pending[(namespace, version) + site] = results
+        if len(self.pending) + len(self.touched) >= FLUSH_SITES:
+            self.flush()
+
+    def flush(self):
+        """Writes the pending entries and the use of those read"""
+        if len(self.pending) == 0 and len(self.touched) == 0:
+            return
+        now = int(time.time())
+        conn = self._connect()
+        try:
+            conn.executemany(
+                "insert or replace into sites values (?, ?, ?, ?, ?, ?, ?, ?);",
+                [
+                    key + (pickle.dumps(results, pickle.HIGHEST_PROTOCOL), now)
+                    for key, results in self.pending.items()
+                ],
+            )
+            conn.executemany(
+                "update sites set used = ? where namespace = ? and version = ? "
+                + "and chrom = ? and pos = ? and ref = ? and alt = ?;",
+                [(now,) + key for key in self.touched if key not in self.pending],
+            )
+            conn.commit()
+            self.evict()
+        except sqlite3.Error as e:
+            print(f"Site cache: write failed: {e}")
+            conn.rollback()
+        self.pending = {}
+        self.touched = set()
+
+    def usedBytes(self):
+        conn = self._connect()
+        pages = conn.execute("pragma page_count;").fetchone()[0]
+        free = conn.execute("pragma freelist_count;").fetchone()[0]
+        return (pages - free) * conn.execute("pragma page_size;").fetchone()[0]
+
+    def evict(self):
+        """Drops the least recently used sites while the file is too big"""
+        conn = self._connect()
+        while self.usedBytes() > self.maxBytes:
+            deleted = conn.execute(
+                "delete from sites where rowid in "
+                + "(select rowid from sites order by used limit ?);",
+                (EVICT_SITES,),
+            ).rowcount
+            conn.commit()
+            if deleted <= 0:
+                break
+            self.evicted = self.evicted + deleted
+
+    def finish(self):
+        """Writes everything the stages of this process looked up"""
+        if self.pid != os.getpid():
+            return
+        for stage in self.stages:
+            stage.leave()
+        self.flush()
+        self.stages = []
+        if self.hits + self.misses > 0:
+            print(
+                f"Site cache: {self.hits} lookups answered, {self.misses} made, "
+                + f"{self.evicted} sites evicted"
+            )
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def close(self):
+        self.finish()
+        if self.pid == os.getpid():
+            self.conn.close()
+        self.conn = None
+
+
+class StageCache(object):
+    """
+    The cache seen by one stage (see annotate.SiteMemo): visit() moves to
+    the site of the next record; recall() answers a query of the current
+    site from its entry, or makes it and adds it to the entry, which is
+    written once the stage moves on.
+    """
+
+    def __init__(self, cache, namespace, version):
+        self.cache = cache
+        self.namespace = namespace
+        self.version = version
+        self.site = None
+        self.results = None
+        self.dirty = False
+
+    def visit(self, site):
+        self.leave()
+        self.site = site
+
+    def leave(self):
+        if self.dirty:
+            self.cache.put(self.namespace, self.version, self.site, self.results)
+        self.site = None
+        self.results = None
+        self.dirty = False
+
+    def recall(self, query, fetch):
+        if self.site is None:
+            return fetch()
+        if self.results is None:
+            self.results = self.cache.get(self.namespace, self.version, self.site)
+            if self.results is None:
+                self.results = {}
+        if query in self.results:
+            self.cache.hits = self.cache.hits + 1
+            return self.results[query]
+        rows = fetch()
+        self.cache.misses = self.cache.misses + 1
+        self.results[query] = rows
+        self.dirty = True
+        return rows
+
+
+### EOF
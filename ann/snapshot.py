@@ -0,0 +1,294 @@
+# snapshot.py
+#
+# Memory-mapped, per-chromosome snapshot of the AnnTools reference tables
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import json
+import mmap
+import os
+import numpy as np
+
+from interval_index import IntervalIndex, lengthClasses
+
+"""Snapshot layout (one directory, written by build_snapshot.py):
+
+   MANIFEST.json               tables with their columns and chromosomes
+   <table>/<n>.start.npy       int64 interval starts, sorted
+   <table>/<n>.end.npy         int64 interval ends
+   <table>/<n>.members.npy     int64 indices of the intervals by length
+                               class (see interval_index.lengthClasses)
+   <table>/<n>.binstart.npy    int64 starts of those intervals
+   <table>/<n>.offsets.npy     int64 offsets of each row in rows.bin (rows + 1)
+   <table>/<n>.rows.bin        the rows as JSON arrays, back to back
+
+   <n> is the position of the chromosome in the table's manifest entry,
+   whose bins hold the [span, size] of each length class of chromosome n.
+   Arrays are opened with mmap, so concurrent jobs on one host share the
+   same pages through the page cache.
+
+   build_snapshot.py writes each build to a new directory and points the
+   snapshot path, a symlink, at it. A Snapshot resolves the link when it
+   is opened and maps every chromosome from that directory, so a job
+   never mixes two builds.
+"""
+
+SNAPSHOT_VERSION = 2
+MANIFEST = "MANIFEST.json"
+
+# Chromosome key of tables exported without a chromosome column
+WHOLE_TABLE = ""
+
+
+"""Encodes a database row for rows.bin; bytes columns (e.g. refGene
+   exonStarts) are stored as text and restored as bytes on read
+"""
+
+
+def encodeRow(row):
+    values = []
+    for v in row:
+        if isinstance(v, (bytes, bytearray)):
+            v = bytes(v).decode("utf-8", "surrogateescape")
+        elif not (v is None or isinstance(v, (int, float, str))):
+            v = str(v)
+        values.append(v)
+    return json.dumps(values).encode("utf-8")
+
+
+class SnapshotRows(object):
+    """
+    Read-only sequence of the rows of one chromosome, decoded on access
+    """
+
+    def __init__(self, offsets, blob, bytesColumns):
+        self.offsets = offsets
+        self.blob = blob
+        self.bytesColumns = bytesColumns
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        row = json.loads(self.blob[int(self.offsets[i]) : int(self.offsets[i + 1])])
+        for c in self.bytesColumns:
+            if row[c] is not None:
+                row[c] = row[c].encode("utf-8", "surrogateescape")
+        return tuple(row)
+
+
+class SnapshotTable(IntervalIndex):
+    """
+    One reference table of a snapshot, answering the same queries as an
+    IntervalIndex from memory-mapped arrays. Chromosomes are mapped the
+    first time they are queried.
+    """
+
+    def __init__(self, root, name, meta):
+        IntervalIndex.__init__(self)
+        self.path = os.path.join(root, name)
+        self.name = name
+        self.columns = meta["columns"]
+        self.bytesColumns = meta["bytesColumns"]
+        self.chroms = meta["chroms"]
+        self.rowCounts = meta["rows"]
+        self.binSizes = meta["bins"]
+        self._mapped = {}
+        self._blobs = []
+
+    def column(self, name):
+        return self.columns.index(name)
+
+    def chromosome(self, chrom):
+        if chrom in self._mapped:
+            return self._mapped[chrom]
+        if chrom not in self.chroms:
+            return None
+
+        n = self.chroms.index(chrom)
+        prefix = os.path.join(self.path, str(n))
+        starts = np.load(prefix + ".start.npy", mmap_mode="r")
+        ends = np.load(prefix + ".end.npy", mmap_mode="r")
+        members = np.load(prefix + ".members.npy", mmap_mode="r")
+        binStarts = np.load(prefix + ".binstart.npy", mmap_mode="r")
+        bins = []
+        first = 0
+        for span, size in self.binSizes[n]:
+            bins.append(
+                (
+                    span,
+                    binStarts[first : first + size],
+                    members[first : first + size],
+                )
+            )
+            first = first + size
+        offsets = np.load(prefix + ".offsets.npy", mmap_mode="r")
+        fh = open(prefix + ".rows.bin", "rb")
+        if os.fstat(fh.fileno()).st_size > 0:
+            blob = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            self._blobs.append(blob)
+        else:
+            blob = b""
+        fh.close()
+
+        arrays = (starts, ends, bins, SnapshotRows(offsets, blob, self.bytesColumns))
+        self._mapped[chrom] = arrays
+        return arrays
+
+    def countStartsBefore(self, starts, pos):
+        return int(np.searchsorted(starts, pos, side="left"))
+
+    def countStartsUpTo(self, starts, pos):
+        return int(np.searchsorted(starts, pos, side="right"))
+
+    def __len__(self):
+        return sum(self.rowCounts)
+
+    def close(self):
+        # Tables stay mapped for the lifetime of the snapshot
+        pass
+
+
+class Snapshot(object):
+    """
+    An opened snapshot directory
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.path = os.path.realpath(root)
+        manifest = readManifest(self.path)
+        if manifest.get("version") != SNAPSHOT_VERSION:
+            raise ValueError(
+                f"Unsupported snapshot version {manifest.get('version')} in {root}"
+            )
+        self.manifest = manifest
+        self._tables = {}
+
+    def hasTable(self, name):
+        return name in self.manifest["tables"]
+
+    def table(self, name):
+        if name not in self._tables:
+            if not self.hasTable(name):
+                raise KeyError(f"Table {name} is not in the snapshot at {self.root}")
+            self._tables[name] = SnapshotTable(
+                self.path, name, self.manifest["tables"][name]
+            )
+        return self._tables[name]
+
+
+"""The snapshot used by the snapshot engine; opened once per process, and
+   again when root has been pointed at a new build
+"""
+
+opened = None
+
+
+def openSnapshot(root):
+    global opened
+    if (
+        opened is None
+        or opened.root != root
+        or opened.path != os.path.realpath(root)
+    ):
+        opened = Snapshot(root)
+    return opened
+
+
+def currentSnapshot():
+    if opened is None:
+        raise ValueError("No reference snapshot has been opened")
+    return opened
+
+
+"""Writes one table of a snapshot from rows ordered by (chrom, start)
+   Returns the table's manifest entry
+"""
+
+
+def writeTable(root, name, columns, rows, chrom_ind, start_ind, end_ind):
+    path = os.path.join(root, name)
+    os.makedirs(path, exist_ok=True)
+
+    chroms = []
+    bytesColumns = set()
+    counts = []
+    binSizes = []
+
+    def flush(n, starts, ends, offsets, fh_rows):
+        fh_rows.close()
+        prefix = os.path.join(path, str(n))
+        starts = np.array(starts, dtype=np.int64)
+        ends = np.array(ends, dtype=np.int64)
+        np.save(prefix + ".start.npy", starts)
+        np.save(prefix + ".end.npy", ends)
+        bins = lengthClasses(starts, ends)
+        members = np.concatenate(
+            [np.zeros(0, dtype=np.int64)]
+            + [np.array(m, dtype=np.int64) for _, m in bins]
+        )
+        np.save(prefix + ".members.npy", members)
+        np.save(prefix + ".binstart.npy", starts[members])
+        binSizes.append([[span, len(m)] for span, m in bins])
+        np.save(prefix + ".offsets.npy", np.array(offsets, dtype=np.int64))
+        counts.append(len(starts))
+
+    chrom = None
+    fh_rows = None
+    for row in rows:
+        c = WHOLE_TABLE if chrom_ind is None else str(row[chrom_ind])
+        if c != chrom:
+            if fh_rows is not None:
+                flush(len(chroms) - 1, starts, ends, offsets, fh_rows)
+            if c in chroms:
+                raise ValueError(f"{name}: rows are not grouped by chromosome")
+            chroms.append(c)
+            chrom = c
+            starts = []
+            ends = []
+            offsets = [0]
+            fh_rows = open(os.path.join(path, str(len(chroms) - 1) + ".rows.bin"), "wb")
+
+        start = int(row[start_ind])
+        if len(starts) > 0 and start < starts[-1]:
+            raise ValueError(f"{name}: rows of {chrom} are not sorted by start")
+
+        for i in range(0, len(row)):
+            if isinstance(row[i], (bytes, bytearray)):
+                bytesColumns.add(i)
+        data = encodeRow(row)
+        fh_rows.write(data)
+        starts.append(start)
+        ends.append(int(row[end_ind]))
+        offsets.append(offsets[-1] + len(data))
+
+    if fh_rows is not None:
+        flush(len(chroms) - 1, starts, ends, offsets, fh_rows)
+
+    return {
+        "columns": columns,
+        "bytesColumns": sorted(bytesColumns),
+        "chroms": chroms,
+        "rows": counts,
+        "bins": binSizes,
+    }
+
+
+def readManifest(root):
+    fh = open(os.path.join(root, MANIFEST))
+    manifest = json.load(fh)
+    fh.close()
+    return manifest
+
+
+def writeManifest(root, tables):
+    fh = open(os.path.join(root, MANIFEST), "w")
+    json.dump({"version": SNAPSHOT_VERSION, "tables": tables}, fh, indent=1)
+    fh.close()
+
+
+### EOF
@@ -0,0 +1,227 @@
+# stages.py
+#
+# Registry of the annotation stages: what each stage runs, with which
+# arguments, and which reference tables it reads. The driver builds a
+# job's pipeline from a list of stage labels (see buildPipeline).
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import annotate as ann
+
+# How a stage reads its tables under an engine, as costed by the job
+# planner (see planner.py): one indexed query per variant, IN queries
+# over windows of variants, a join with the uploaded variants, the whole
+# table loaded into memory, the table streamed in order, or the snapshot
+ACCESS_QUERY = "query"
+ACCESS_BATCH = "batch"
+ACCESS_JOIN = "join"
+ACCESS_LOAD = "load"
+ACCESS_STREAM = "stream"
+ACCESS_SNAPSHOT = "snapshot"
+
+# Access of the overlap stages, under the engines of their Source
+OVERLAP_ACCESS = {
+    "sql": ACCESS_QUERY,
+    "batch": ACCESS_QUERY,
+    "index": ACCESS_LOAD,
+    "sweep": ACCESS_STREAM,
+    "snapshot": ACCESS_SNAPSHOT,
+    "join": ACCESS_JOIN,
+}
+
+
+class Stage(object):
+    """
+    An annotation stage: its stream function (see annotate.runStage)
+    with default keyword arguments; overlap stages run
+    annotate.streamOverlap with the Source of their table.
+
+    tables are the reference tables it reads, when not just its "table"
+    argument; a stage's reference version is that of its tables (see
+    layers.py). readsInfo stages annotate from the INFO column written
+    before them, not only from the variant: a re-annotation runs them
+    again whenever an earlier stage changed the records.
+
+    access maps each engine to how the stage then reads its tables (one
+    of the ACCESS_ values, ACCESS_QUERY for engines it does not name),
+    and queries is the number of queries per variant of ACCESS_QUERY.
+    regionTrack stages also load their tables a chromosome at a time
+    into the region track (see annotate.regionAt), whatever the engine.
+    """
+
+    def __init__(
+        self,
+        label,
+        stream,
+        kwargs=None,
+        tables=None,
+        readsInfo=False,
+        access=None,
+        queries=1,
+        regionTrack=False,
+    ):
+        self.label = label
+        self.stream = stream
+        self.kwargs = kwargs or {}
+        self.tables = tables
+        self.readsInfo = readsInfo
+        self.access = access or {}
+        self.queries = queries
+        self.regionTrack = regionTrack
+
+    def accessFor(self, engine):
+        return self.access.get(engine, ACCESS_QUERY)
+
+    def fixedSeparator(self):
+        """Whether what it adds to INFO always starts with ";" """
+        source = self.kwargs.get("source")
+        return source is not None and source.fixedSeparator
+
+
+"""Stage annotating by overlap with the table of source, or table
+"""
+
+
+def overlapStage(label, source, table=None):
+    return Stage(
+        label,
+        ann.streamOverlap,
+        {"source": source, "table": source.table if table is None else table},
+        access=dict((e, OVERLAP_ACCESS[e]) for e in source.lookupEngines),
+    )
+
+
+# Every stage, in default pipeline order
+REGISTRY = [
+    Stage(
+        "dbSNP",
+        ann.streamSnpsFromDbSnp,
+        tables=["dbSNP"],
+        readsInfo=True,
+        access={
+            "batch": ACCESS_BATCH,
+            "index": ACCESS_BATCH,
+            "sweep": ACCESS_BATCH,
+            "join": ACCESS_BATCH,
+            "snapshot": ACCESS_SNAPSHOT,
+        },
+    ),
+    # Up to three queries per variant, one per table until one matches
+    Stage(
+        "BigRefGene",
+        ann.streamBigRefGene,
+        tables=["chrom_pos_equal_base", "chrom_pos_equal_nobase", "chrom_pos_unequal"],
+        readsInfo=True,
+        access={"index": ACCESS_LOAD, "snapshot": ACCESS_SNAPSHOT, "join": ACCESS_JOIN},
+        queries=2,
+    ),
+    Stage(
+        "refGene",
+        ann.streamGenes,
+        {"table": "refGene", "promoter_offset": 500},
+        tables=["refGene", "cpgIslandExt"],
+        readsInfo=True,
+        access={"snapshot": ACCESS_SNAPSHOT, "join": ACCESS_JOIN},
+        regionTrack=True,
+    ),
+    overlapStage("Cytoband", ann.CYTOBAND_SOURCE),
+    overlapStage("gadAll", ann.GAD_ALL_SOURCE),
+    overlapStage("GwasCatalog", ann.GWAS_CATALOG_SOURCE),
+    overlapStage("miRNA", ann.MIRNA_SOURCE),
+    overlapStage("HUGO Gene Nomenclature Committee", ann.HUGO_SOURCE),
+    overlapStage("dgv_Cnv", ann.CNV_SOURCE, "dgv_Cnv"),
+    overlapStage("abParts_IG_T_CelReceptors", ann.CNV_SOURCE, "abParts_IG_T_CelReceptors"),
+    overlapStage("mcCarroll_Cnv", ann.CNV_SOURCE, "mcCarroll_Cnv"),
+    overlapStage("conrad_Cnv", ann.CNV_SOURCE, "conrad_Cnv"),
+    overlapStage("genomicSuperDups", ann.GENOMIC_SUPER_DUPS_SOURCE),
+    Stage(
+        "addOverlapWithTfbsConsSites",
+        ann.streamOverlapWithTfbsConsSites,
+        {"table": "tfbsConsSites"},
+        access={
+            "batch": ACCESS_LOAD,
+            "index": ACCESS_LOAD,
+            "sweep": ACCESS_LOAD,
+            "snapshot": ACCESS_SNAPSHOT,
+            "join": ACCESS_JOIN,
+        },
+    ),
+]
+
+BY_LABEL = dict((s.label, s) for s in REGISTRY)
+
+DEFAULT_PIPELINE = [s.label for s in REGISTRY]
+
+
+def stage(label):
+    if label not in BY_LABEL:
+        raise ValueError(f"Unknown annotation stage: {label}")
+    return BY_LABEL[label]
+
+
+"""Pipeline of the stages labelled, in that order (all of them in
+   registry order by default): (label, stage, keyword arguments) each
+"""
+
+
+def buildPipeline(labels=None):
+    if labels is None:
+        labels = DEFAULT_PIPELINE
+    return [(label, stage(label).stream, dict(stage(label).kwargs)) for label in labels]
+
+
+"""Reference tables read by a stage
+"""
+
+
+def stageTables(label, kwargs):
+    if label in BY_LABEL and BY_LABEL[label].tables is not None:
+        return BY_LABEL[label].tables
+    return [kwargs.get("table", label)]
+
+
+def readsInfo(label):
+    return label in BY_LABEL and BY_LABEL[label].readsInfo
+
+
+def fixedSeparator(label):
+    return label in BY_LABEL and BY_LABEL[label].fixedSeparator()
+
+
+"""Stage labels of a comma-separated list, e.g. the Stages option of
+   annotator_config.ini; None (the default pipeline) if it is empty
+"""
+
+
+def parseStages(text):
+    labels = [l.strip() for l in (text or "").split(",") if len(l.strip()) > 0]
+    if len(labels) == 0:
+        return None
+    for label in labels:
+        stage(label)
+    return labels
+
+
+"""Per-stage engines of a comma-separated list of label=engine, e.g. the
+   StageEngines option of annotator_config.ini, as stage options (see
+   driver.stageArguments)
+"""
+
+
+def parseStageEngines(text):
+    options = {}
+    for item in (text or "").split(","):
+        if len(item.strip()) == 0:
+            continue
+        label, engine = [s.strip() for s in item.split("=", 1)]
+        stage(label)
+        if engine not in ann.ENGINES:
+            raise ValueError(f"Unknown annotation engine: {engine}")
+        options[label] = {"engine": engine}
+    return options
+
+
+### EOF
@@ -0,0 +1,345 @@
+# tabix.py
+#
+# Tabix (.tbi) coordinate index of a bgzip-compressed annotated VCF, and
+# region queries answered with byte-range reads of the compressed file
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import struct
+
+import bgzf
+
+# Binning scheme of tabix: 16 KB linear windows, bins 5 levels deep
+MIN_SHIFT = 14
+DEPTH = 5
+META_BIN = 37450
+
+# Tabix header of a VCF: sequence, start and (from REF) end columns,
+# "#" header lines
+FORMAT_VCF = 2
+COL_SEQ = 1
+COL_BEG = 2
+COL_END = 0
+META_CHAR = "#"
+
+
+"""Bin of the 0-based, half-open range beg..end
+"""
+
+
+def reg2bin(beg, end):
+    end = end - 1
+    shift = MIN_SHIFT
+    first = ((1 << DEPTH * 3) - 1) // 7
+    for level in range(DEPTH, 0, -1):
+        if beg >> shift == end >> shift:
+            return first + (beg >> shift)
+        shift = shift + 3
+        first = first - (1 << (level - 1) * 3)
+    return 0
+
+
+"""Bins that may hold records overlapping beg..end
+"""
+
+
+def reg2bins(beg, end):
+    end = end - 1
+    bins = [0]
+    shift = MIN_SHIFT + DEPTH * 3
+    first = 0
+    for level in range(1, DEPTH + 1):
+        first = first + (1 << (level - 1) * 3)
+        shift = shift - 3
+        bins.extend(range(first + (beg >> shift), first + (end >> shift) + 1))
+    return bins
+
+
+"""Chromosome and 0-based, half-open range of a region such as
+   chr17:41,196,312-41,277,500 (1-based, closed, as tabix reads it)
+"""
+
+
+def parseRegion(region):
+    region = region.replace(",", "")
+    if ":" not in region:
+        return region, 0, 1 << 31
+    chrom, span = region.rsplit(":", 1)
+    if "-" in span:
+        beg, end = span.split("-", 1)
+    else:
+        beg, end = span, span
+    return chrom, max(0, int(beg) - 1), int(end)
+
+
+"""0-based, half-open range of a VCF record (columns as bytes): from POS
+   over the length of REF. Columns may start with a space (as the gadAll
+   stage writes them), which tabix skips too.
+"""
+
+
+def recordRange(fields):
+    beg = int(fields[COL_BEG - 1]) - 1
+    return beg, beg + max(1, len(fields[3].strip()))
+
+
+class TabixIndex(object):
+    """
+    Per chromosome: chunks of virtual offsets per bin and the linear
+    index (virtual offset of the first record overlapping each 16 KB
+    window), as tabix writes them. chunks() gives the virtual offset
+    ranges that hold the records of a region.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.bins = []
+        self.linear = []
+        self.meta = []
+
+    def addChromosome(self, name):
+        self.names.append(name)
+        self.bins.append({})
+        self.linear.append([])
+        self.meta.append([None, None, 0])
+
+    def add(self, beg, end, start, stop):
+        """Adds a record of the last chromosome at virtual offsets start..stop"""
+        chunks = self.bins[-1].setdefault(reg2bin(beg, end), [])
+        if len(chunks) > 0 and chunks[-1][1] == start:
+            chunks[-1][1] = stop
+        else:
+            chunks.append([start, stop])
+
+        linear = self.linear[-1]
+        last = (end - 1) >> MIN_SHIFT
+        while len(linear) <= last:
+            linear.append(None)
+        for w in range(beg >> MIN_SHIFT, last + 1):
+            if linear[w] is None:
+                linear[w] = start
+
+        meta = self.meta[-1]
+        if meta[0] is None:
+            meta[0] = start
+        meta[1] = stop
+        meta[2] = meta[2] + 1
+
+    def encode(self):
+        names = b"".join(n.encode("utf-8") + b"\0" for n in self.names)
+        out = [
+            b"TBI\1",
+            struct.pack(
+                "<8i",
+                len(self.names),
+                FORMAT_VCF,
+                COL_SEQ,
+                COL_BEG,
+                COL_END,
+                ord(META_CHAR),
+                0,
+                len(names),
+            ),
+            names,
+        ]
+        for i in range(0, len(self.names)):
+            bins = self.bins[i]
+            out.append(struct.pack("<i", len(bins) + 1))
+            for b in sorted(bins):
+                out.append(struct.pack("<Ii", b, len(bins[b])))
+                for start, stop in bins[b]:
+                    out.append(struct.pack("<QQ", start, stop))
+            meta = self.meta[i]
+            out.append(struct.pack("<Ii", META_BIN, 2))
+            out.append(struct.pack("<QQQQ", meta[0], meta[1], meta[2], 0))
+
+            # Windows no record overlaps take the offset of the window
+            # before them (the first record for leading ones), as in tabix
+            linear = list(self.linear[i])
+            previous = meta[0]
+            for w in range(0, len(linear)):
+                if linear[w] is None:
+                    linear[w] = previous
+                previous = linear[w]
+            out.append(struct.pack("<i", len(linear)))
+            out.append(struct.pack("<%dQ" % len(linear), *linear))
+        out.append(struct.pack("<Q", 0))
+        return b"".join(out)
+
+    def write(self, filename):
+        writer = bgzf.BgzfWriter(filename)
+        writer.write(self.encode())
+        writer.close()
+
+    def chunks(self, chrom, beg, end):
+        """Merged virtual offset ranges holding the records of a region"""
+        if chrom not in self.names:
+            return []
+        i = self.names.index(chrom)
+        linear = self.linear[i]
+        minOffset = 0
+        if len(linear) > 0:
+            minOffset = linear[min(beg >> MIN_SHIFT, len(linear) - 1)] or 0
+
+        found = []
+        for b in reg2bins(beg, end):
+            for start, stop in self.bins[i].get(b, []):
+                if stop > minOffset:
+                    found.append([start, stop])
+        found.sort()
+        merged = []
+        for start, stop in found:
+            if len(merged) > 0 and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], stop)
+            else:
+                merged.append([start, stop])
+        return merged
+
+
+"""Indexes filename, the uncompressed annotated VCF that was compressed
+   into blocks at blockOffsets (see bgzf.compressFile); None if the
+   records are not sorted by position within contiguous chromosomes,
+   which tabix requires
+"""
+
+
+def buildIndex(filename, blockOffsets):
+    index = TabixIndex()
+    seen = set()
+    chrom = None
+    previous = 0
+    pos = 0
+    fh = open(filename, "rb")
+    for line in fh:
+        start = pos
+        pos = pos + len(line)
+        if line.startswith(META_CHAR.encode("utf-8")) or len(line.strip()) == 0:
+            continue
+        fields = line.rstrip(b"\r\n").split(b"\t", 4)
+        if len(fields) < 4 or not fields[1].strip().isdigit():
+            continue
+        name = fields[0].decode("utf-8")
+        beg, end = recordRange(fields)
+        if name != chrom:
+            if name in seen:
+                print("Not indexed: " + name + " is not contiguous in " + filename)
+                fh.close()
+                return None
+            seen.add(name)
+            index.addChromosome(name)
+            chrom = name
+            previous = 0
+        if beg < previous:
+            print("Not indexed: " + filename + " is not sorted by position")
+            fh.close()
+            return None
+        previous = beg
+        index.add(
+            beg,
+            end,
+            bgzf.virtualOffset(blockOffsets, start),
+            bgzf.virtualOffset(blockOffsets, pos),
+        )
+    fh.close()
+    return index
+
+
+"""Reads a .tbi file
+"""
+
+
+def readIndex(filename):
+    data = b"".join(block for _, block in bgzf.readBlocks(open(filename, "rb").read()))
+    if data[0:4] != b"TBI\1":
+        raise ValueError(filename + " is not a tabix index")
+    n = struct.unpack("<8i", data[4:36])
+    at = 36 + n[7]
+    index = TabixIndex()
+    for name in data[36:at].split(b"\0")[0 : n[0]]:
+        index.addChromosome(name.decode("utf-8"))
+    for i in range(0, n[0]):
+        nBins = struct.unpack("<i", data[at : at + 4])[0]
+        at = at + 4
+        for _ in range(0, nBins):
+            b, nChunks = struct.unpack("<Ii", data[at : at + 8])
+            at = at + 8
+            chunks = []
+            for _ in range(0, nChunks):
+                chunks.append(list(struct.unpack("<QQ", data[at : at + 16])))
+                at = at + 16
+            if b == META_BIN:
+                index.meta[i] = [chunks[0][0], chunks[0][1], chunks[1][0]]
+            else:
+                index.bins[i][b] = chunks
+        nIntervals = struct.unpack("<i", data[at : at + 4])[0]
+        at = at + 4
+        index.linear[i] = list(
+            struct.unpack("<%dQ" % nIntervals, data[at : at + 8 * nIntervals])
+        )
+        at = at + 8 * nIntervals
+    return index
+
+
+"""Records of the compressed VCF overlapping region, read through
+   readRange(first, last), which returns the bytes first..last (inclusive,
+   as in an HTTP Range header, e.g. an S3 GetObject) of the file and may
+   return fewer at its end. Header lines are not included.
+"""
+
+
+def fetchRegion(index, region, readRange):
+    chrom, beg, end = parseRegion(region)
+
+    # One read per run of chunks whose blocks overlap or abut; the last
+    # block of a chunk is at most 64 KB long
+    reads = []
+    for start, stop in index.chunks(chrom, beg, end):
+        last = (stop >> 16) + 0xFFFF
+        if len(reads) > 0 and start >> 16 <= reads[-1][1] + 1:
+            reads[-1][1] = max(reads[-1][1], last)
+            reads[-1][2].append((start, stop))
+        else:
+            reads.append([start >> 16, last, [(start, stop)]])
+
+    records = []
+    for first, last, chunks in reads:
+        blocks = list(bgzf.readBlocks(readRange(first, last), first))
+        at = dict((offset, i) for i, (offset, _) in enumerate(blocks))
+        for start, stop in chunks:
+            text = bytearray()
+            i = at[start >> 16]
+            lo = start & 0xFFFF
+            while blocks[i][0] < stop >> 16:
+                text.extend(blocks[i][1][lo:])
+                i = i + 1
+                lo = 0
+            text.extend(blocks[i][1][lo : stop & 0xFFFF])
+            for line in bytes(text).split(b"\n"):
+                fields = line.split(b"\t", 4)
+                if len(fields) < 4 or fields[0].decode("utf-8") != chrom:
+                    continue
+                recordBeg, recordEnd = recordRange(fields)
+                if recordBeg < end and recordEnd > beg:
+                    records.append(line.decode("utf-8"))
+    return records
+
+
+"""readRange of a local file, for fetchRegion
+"""
+
+
+def fileRange(filename):
+    def readRange(first, last):
+        fh = open(filename, "rb")
+        fh.seek(first)
+        data = fh.read(last - first + 1)
+        fh.close()
+        return data
+
+    return readRange
+
+
+### EOF
@@ -0,0 +1,163 @@
+# conftest.py
+#
+# pytest setup of the annotator tests: the annotator modules import each
+# other by name from the ann directory, and the tests that run stages
+# read a small reference database in SQLite
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+
+import pymysql
+import pytest
+
+ANN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+BENCHMARKS_DIR = os.path.join(ANN_DIR, "..", "benchmarks")
+sys.path.insert(0, ANN_DIR)
+
+# Records of the synthetic job, in chr-prefixed and bare chromosome names
+SYNTHETIC_RECORDS = 600
+
+
+class StandInCursor(sqlite3.Cursor):
+    """
+    Cursor running the annotator's MySQL statements on SQLite
+    """
+
+    def execute(self, sql, *args):
+        sql = sql.replace("drop temporary table", "drop table")
+        sql = sql.replace(" straight_join ", " cross join ")
+        try:
+            return sqlite3.Cursor.execute(self, sql, *args)
+        except sqlite3.OperationalError as e:
+            # As pymysql reports e.g. a missing table
+            raise pymysql.err.ProgrammingError(str(e))
+
+
+class StandInConnection(sqlite3.Connection):
+    """
+    SQLite connection with the parts of a pymysql connection the
+    annotator uses
+    """
+
+    def ping(self, reconnect=True):
+        pass
+
+    def thread_id(self):
+        return id(self)
+
+    def cursor(self, factory=StandInCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+
+class Reference(object):
+    """
+    Reference database of a test: create() makes a table of the named
+    columns and fills it with rows; the annotator connects to it in
+    place of the RDS database
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, factory=StandInConnection)
+        conn.create_function("concat", 2, lambda a, b: a + b)
+        return conn
+
+    def create(self, table, columns, rows):
+        conn = sqlite3.connect(self.path)
+        conn.execute("drop table if exists " + table)
+        conn.execute("create table " + table + " (" + ", ".join(columns) + ")")
+        conn.executemany(
+            "insert into " + table + " values (" + ",".join("?" * len(columns)) + ")",
+            rows,
+        )
+        conn.commit()
+        conn.close()
+
+    def execute(self, sql, *args):
+        conn = sqlite3.connect(self.path)
+        conn.execute(sql, *args)
+        conn.commit()
+        conn.close()
+
+
+"""Makes the annotator connect to db for the test
+"""
+
+
+def installReference(db, monkeypatch):
+    import utils as u
+
+    u.db_disconnect()
+    monkeypatch.setattr(u, "open_db_connection", db.connect)
+    monkeypatch.setattr(u, "db_stream_cursor", lambda conn: conn.cursor())
+
+
+@pytest.fixture
+def reference(tmp_path, monkeypatch):
+    import utils as u
+
+    db = Reference(str(tmp_path / "reference.sqlite"))
+    installReference(db, monkeypatch)
+    yield db
+    u.db_disconnect()
+
+
+"""A synthetic VCF and reference database of every table the stages
+   read, written once per session by the benchmark generators (see
+   benchmarks/README.md)
+"""
+
+
+@pytest.fixture(scope="session")
+def syntheticData(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("synthetic")
+    vcf = str(directory / "job.vcf")
+    sqlitePath = str(directory / "reference.sqlite")
+    for script, arguments in [
+        (
+            "generate_vcf.py",
+            ["--output", vcf, "--records", str(SYNTHETIC_RECORDS), "--naming", "mixed"],
+        ),
+        ("load_reference.py", ["--sqlite", sqlitePath, "--vcf", vcf, "--density", "0.05"]),
+    ]:
+        subprocess.run(
+            [sys.executable, os.path.join(BENCHMARKS_DIR, script)] + arguments,
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+    return vcf, sqlitePath
+
+
+"""A copy of the synthetic job in the test's directory, annotated against
+   a copy of the synthetic reference; returns its input file and the
+   reference
+"""
+
+
+@pytest.fixture
+def syntheticJob(tmp_path, monkeypatch, syntheticData):
+    import utils as u
+
+    vcf, sqlitePath = syntheticData
+    jobDir = tmp_path / "job"
+    jobDir.mkdir()
+    infile = str(jobDir / "job.vcf")
+    shutil.copy(vcf, infile)
+    db = Reference(str(tmp_path / "reference.sqlite"))
+    shutil.copy(sqlitePath, db.path)
+    installReference(db, monkeypatch)
+    yield infile, db
+    u.db_disconnect()
+
+
+### EOF
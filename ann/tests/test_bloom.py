@@ -0,0 +1,100 @@
+# test_bloom.py
+#
+# The dbSNP Bloom filter (bloom.py) never rules out a site it was built
+# with, in memory or memory-mapped from its file, and keeps close to the
+# false positive rate it was sized for
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import random
+
+import pytest
+
+import bloom as bl
+
+# CHR values as a table may store them: bare, "chr" prefixed and lower
+# case names
+CHROMOSOMES = ["1", "2", "10", "X", "x", "MT", "chr7", "chrX", "chrUn_gl000220"]
+
+
+"""(CHR, POS) sites over all CHROMOSOMES, positions up to 2^31 - 1
+"""
+
+
+def randomSites(count, seed):
+    rng = random.Random(seed)
+    return [
+        (rng.choice(CHROMOSOMES), rng.choice([rng.randint(1, 250000000), 2**31 - 1]))
+        for _ in range(count)
+    ]
+
+
+"""A filter of sites sized for rate, filled as build_bloom.addSites
+   does: in chunks of parallel CHR and POS lists
+"""
+
+
+def buildFilter(sites, rate=bl.FP_RATE, chunk=5000):
+    bits, hashes = bl.filterSize(len(sites), rate)
+    bloom = bl.BloomFilter(bits, hashes, meta={"reference_version": "v1"})
+    for i in range(0, len(sites), chunk):
+        part = sites[i : i + chunk]
+        bloom.add([c for c, _ in part], [p for _, p in part])
+    return bloom
+
+
+@pytest.fixture(scope="module")
+def sites():
+    return randomSites(20000, 3)
+
+
+def testNoFalseNegatives(sites):
+    bloom = buildFilter(sites)
+    for chrom, pos in sites:
+        assert bloom.has(chrom, pos), (chrom, pos)
+        # Names compare case-insensitively, as MySQL compares CHR
+        assert bloom.has(chrom.lower(), pos), (chrom, pos)
+        assert bloom.has(chrom.upper(), str(pos)), (chrom, pos)
+    assert bloom.takeCounts() == (3 * len(sites), 0)
+
+
+def testNoFalseNegativesFromFile(sites, tmp_path):
+    filename = str(tmp_path / "dbsnp.bloom")
+    buildFilter(sites).write(filename)
+    bloom = bl.readFilter(filename)
+    assert bloom.meta["reference_version"] == "v1"
+    for chrom, pos in sites:
+        assert bloom.has(chrom, pos), (chrom, pos)
+
+
+def testFalsePositiveRate(sites):
+    bloom = buildFilter(sites)
+    inserted = set((c.upper(), p) for c, p in sites)
+    others = [s for s in randomSites(20000, 5) if (s[0].upper(), s[1]) not in inserted]
+    falsePositives = sum(1 for chrom, pos in others if bloom.has(chrom, pos))
+    assert falsePositives < 2 * bl.FP_RATE * len(others)
+
+
+"""mightContain as the dbSNP stages call it, through the filter
+   openFilter loads for the configured reference version
+"""
+
+
+def testMightContain(sites, tmp_path):
+    filename = str(tmp_path / "dbsnp.bloom")
+    buildFilter(sites).write(filename)
+
+    assert bl.openFilter(filename, "v2") is None
+    bl.active = bl.openFilter(filename, "v1")
+    try:
+        for chrom, pos in sites:
+            assert bl.mightContain(chrom.lower(), pos), (chrom, pos)
+    finally:
+        bl.active = None
+    assert bl.mightContain("1", 12345)
+
+
+### EOF
@@ -0,0 +1,152 @@
+# test_checkpoint.py
+#
+# A job killed part way and run again resumes from its checkpoint
+# (checkpoint.py) and writes what an uninterrupted run does, and files
+# changed since they were checkpointed are annotated again
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import shutil
+
+import pytest
+
+import driver
+
+# Stage killed in the staged pipeline, after KILLED_AFTER records
+KILLED_STAGE = 3
+KILLED_AFTER = 100
+
+# Shard whose worker is killed in the fused pipeline
+KILLED_SHARD = "1.vcf"
+
+annotateShard = driver.annotateShard
+
+
+"""Annotated file and count log of running the job in infile
+"""
+
+
+def annotate(infile, **kwargs):
+    driver.run(infile, "vcf", **kwargs)
+    results = []
+    for filename in [driver.annotatedFileName(infile), infile + ".count.log"]:
+        fh = open(filename)
+        results.append(fh.read())
+        fh.close()
+    return tuple(results)
+
+
+"""Results of an uninterrupted run of a copy of infile
+"""
+
+
+def uninterrupted(infile, **kwargs):
+    directory = os.path.join(os.path.dirname(infile), "uninterrupted")
+    os.makedirs(directory)
+    copy = os.path.join(directory, os.path.basename(infile))
+    shutil.copy(infile, copy)
+    return annotate(copy, **kwargs)
+
+
+"""Stage function failing after KILLED_AFTER records of stage
+"""
+
+
+def killedStage(stage):
+    def killed(lines, fh_log, **kwargs):
+        for n, line in enumerate(stage(lines, fh_log, **kwargs)):
+            if n == KILLED_AFTER:
+                raise RuntimeError("stage killed")
+            yield line
+
+    return killed
+
+
+def killShard(job):
+    if os.path.basename(job[0]) == KILLED_SHARD:
+        raise RuntimeError("shard killed")
+    return annotateShard(job)
+
+
+"""Runs the staged pipeline of infile until KILLED_STAGE fails; returns
+   the labels of the stages before it
+"""
+
+
+def killStaged(infile, monkeypatch):
+    stages = list(driver.STAGES)
+    label, stage, kwargs = stages[KILLED_STAGE - 1]
+    stages[KILLED_STAGE - 1] = (label, killedStage(stage), kwargs)
+    with monkeypatch.context() as m:
+        m.setattr(driver, "STAGES", stages)
+        with pytest.raises(RuntimeError):
+            driver.run(infile, "vcf", engine="index", fused=False, checkpoint=True)
+    return [label for label, _, _ in driver.STAGES[: KILLED_STAGE - 1]]
+
+
+def testResumeAfterKilledStage(syntheticJob, monkeypatch, capsys):
+    infile, _ = syntheticJob
+    expected = uninterrupted(infile, engine="index", fused=False)
+    done = killStaged(infile, monkeypatch)
+    capsys.readouterr()
+
+    assert annotate(infile, engine="index", fused=False, checkpoint=True) == expected
+    assert "Resuming after " + done[-1] in capsys.readouterr().out
+
+
+def testTamperedStageFileIsRedone(syntheticJob, monkeypatch, capsys):
+    infile, _ = syntheticJob
+    expected = uninterrupted(infile, engine="index", fused=False)
+    done = killStaged(infile, monkeypatch)
+    capsys.readouterr()
+
+    # The last stage checkpointed loses a record
+    staged = infile + "." + str(len(done))
+    fh = open(staged)
+    lines = fh.readlines()
+    fh.close()
+    fh = open(staged, "w")
+    fh.writelines(lines[:-1])
+    fh.close()
+
+    assert annotate(infile, engine="index", fused=False, checkpoint=True) == expected
+    assert "Resuming after " + done[-2] in capsys.readouterr().out
+
+
+def testResumeAfterKilledShard(syntheticJob, monkeypatch, capsys):
+    infile, _ = syntheticJob
+    expected = uninterrupted(infile, engine="sql")
+    with monkeypatch.context() as m:
+        m.setattr(driver, "annotateShard", killShard)
+        with pytest.raises(RuntimeError):
+            driver.run(infile, "vcf", engine="sql", checkpoint=True)
+    capsys.readouterr()
+
+    # The fused pipeline is checkpointed by shard even in one worker
+    assert annotate(infile, engine="sql", checkpoint=True) == expected
+    assert "Resuming with 1 of " in capsys.readouterr().out
+
+
+def testTamperedShardIsRedone(syntheticJob, monkeypatch, capsys):
+    infile, _ = syntheticJob
+    expected = uninterrupted(infile, engine="sql")
+    with monkeypatch.context() as m:
+        m.setattr(driver, "annotateShard", killShard)
+        with pytest.raises(RuntimeError):
+            driver.run(infile, "vcf", engine="sql", checkpoint=True)
+    capsys.readouterr()
+
+    annotated = driver.annotatedFileName(os.path.join(infile + ".shards", "0.vcf"))
+    fh = open(annotated, "a")
+    fh.write("chr1\t1\t.\tA\tG\t.\t.\t.\n")
+    fh.close()
+
+    assert annotate(infile, engine="sql", checkpoint=True) == expected
+    assert "Resuming with 2 of " in capsys.readouterr().out
+
+
+### EOF
@@ -0,0 +1,223 @@
+# test_interval_index.py
+#
+# Point and range queries of the interval index (interval_index.py), one
+# at a time (find) and in batches (findBatch), and the point queries of
+# the sweep join (SweepLookup) match a scan of the intervals, with long
+# intervals among short ones and batches split at BATCH_CANDIDATES
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import random
+
+import numpy as np
+import pytest
+
+import interval_index as ii
+
+CHROMOSOME_LENGTH = 1000000
+
+# Chromosomes of the test index; "chrEmpty" has no intervals, "chr2" a
+# single one and "chr3" only long ones
+CHROMOSOMES = ["chr1", "chr2", "chr3", "chrEmpty"]
+
+
+"""Random closed intervals (chrom, start, end, row) in load order: on
+   chr1 mostly short ones, some of them equal, with a share up to the
+   whole chromosome long; rows are their load order
+"""
+
+
+def randomIntervals(seed=11, count=5000):
+    rng = random.Random(seed)
+    intervals = []
+    for n in range(0, count):
+        start = rng.randint(1, CHROMOSOME_LENGTH)
+        length = rng.choice([0, 1, 10, 100, rng.randint(0, 5000)])
+        if rng.random() < 0.01:
+            length = rng.randint(100000, CHROMOSOME_LENGTH)
+        if rng.random() < 0.05 and len(intervals) > 0:
+            _, start, end, _ = intervals[-1]
+            length = end - start
+        intervals.append(("chr1", start, start + length, (len(intervals),)))
+    intervals.append(("chr2", 5000, 6000, (len(intervals),)))
+    for n in range(0, 40):
+        start = rng.randint(1, CHROMOSOME_LENGTH // 2)
+        intervals.append(("chr3", start, start + CHROMOSOME_LENGTH // 2, (len(intervals),)))
+    return intervals
+
+
+"""Rows of the intervals of chrom overlapping [lo, hi], by start with
+   ties in load order
+"""
+
+
+def scan(intervals, chrom, lo, hi):
+    hits = [i for i in intervals if i[0] == chrom and i[1] <= hi and i[2] >= lo]
+    return [i[3] for i in sorted(hits, key=lambda i: i[1])]
+
+
+"""Positions to query on a chromosome: random ones, the interval
+   boundaries and either side of them, and the chromosome's ends
+"""
+
+
+def queryPositions(intervals, chrom, rng, count=300):
+    positions = [rng.randint(0, CHROMOSOME_LENGTH + 10) for _ in range(count)]
+    for _, start, end, _ in rng.sample(intervals, 100):
+        positions.extend([start - 1, start, end, end + 1])
+    return positions + [0, 1, CHROMOSOME_LENGTH]
+
+
+@pytest.fixture(scope="module")
+def intervals():
+    return randomIntervals()
+
+
+@pytest.fixture(scope="module")
+def index(intervals):
+    index = ii.IntervalIndex()
+    index.columns = ["id"]
+    for chrom, start, end, row in intervals:
+        index.add(chrom, start, end, row)
+    return index.freeze()
+
+
+"""The (starts, ends, bins) arrays of a chromosome as findBatch takes
+   them (see annotate.BatchLookup)
+"""
+
+
+def batchArrays(index, chrom):
+    starts, ends, bins, _ = index.chromosome(chrom)
+    bins = [
+        (span, np.asarray(binStarts, dtype=np.int64), np.asarray(members, dtype=np.int64))
+        for span, binStarts, members in bins
+    ]
+    return np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64), bins
+
+
+def testLengthClasses(index):
+    starts, ends, bins, _ = index.chromosome("chr1")
+    assert sorted(i for _, _, members in bins for i in members) == list(range(len(starts)))
+    for span, binStarts, members in bins:
+        assert list(members) == sorted(members)
+        assert binStarts == [starts[i] for i in members]
+        assert max(ends[i] - starts[i] for i in members) == span
+    # Small classes are merged into the next longer one
+    assert all(len(members) >= ii.MIN_CLASS_SIZE for _, _, members in bins[:-1])
+    assert len(bins) > 1
+
+
+def testPointQueriesMatchScan(index, intervals):
+    rng = random.Random(3)
+    for chrom in CHROMOSOMES:
+        for pos in queryPositions(intervals, chrom, rng):
+            expected = scan(intervals, chrom, pos, pos)
+            assert index.fetchall(chrom, pos) == expected, (chrom, pos)
+            first = expected[0] if len(expected) > 0 else None
+            assert index.fetchone(chrom, pos) == first, (chrom, pos)
+
+
+def testRangeQueriesMatchScan(index, intervals):
+    rng = random.Random(5)
+    for chrom in CHROMOSOMES:
+        for lo in queryPositions(intervals, chrom, rng, 100):
+            hi = lo + rng.choice([0, 1, 50, 5000, 200000])
+            assert index.fetchoverlap(chrom, lo, hi) == scan(intervals, chrom, lo, hi)
+
+
+def testUnknownChromosome(index):
+    assert index.find("chrUnknown", 5000) == []
+    assert index.fetchone("chrUnknown", 5000) is None
+    assert index.chromosome("chrEmpty") is None
+
+
+@pytest.mark.parametrize("candidates", [1, 2, 7, 1000, ii.BATCH_CANDIDATES])
+def testFindBatchMatchesFind(index, intervals, monkeypatch, candidates):
+    monkeypatch.setattr(ii, "BATCH_CANDIDATES", candidates)
+    rng = random.Random(candidates)
+    for chrom in ["chr1", "chr2", "chr3"]:
+        starts, ends, bins = batchArrays(index, chrom)
+        # Unsorted, with repeats, as a window of variants comes
+        positions = queryPositions(intervals, chrom, rng)
+        positions = positions + positions[:50]
+        rng.shuffle(positions)
+
+        offsets, hits = ii.findBatch(starts, ends, bins, positions)
+        assert len(offsets) == len(positions) + 1
+        for k, pos in enumerate(positions):
+            found = hits[offsets[k] : offsets[k + 1]].tolist()
+            assert found == index.find(chrom, pos), (chrom, pos)
+
+
+def testFindBatchChunkBoundaries(index, intervals, monkeypatch):
+    """Chunks ending exactly at BATCH_CANDIDATES candidates, and single
+    positions with more candidates than that
+    """
+    starts, ends, bins = batchArrays(index, "chr3")
+    positions = list(range(CHROMOSOME_LENGTH // 4, CHROMOSOME_LENGTH // 4 + 20))
+    counts = [len(index.find("chr3", pos)) for pos in positions]
+    expected = ii.findBatch(starts, ends, bins, positions)
+    for candidates in [counts[0], counts[0] + counts[1], max(counts) - 1, 3 * max(counts)]:
+        monkeypatch.setattr(ii, "BATCH_CANDIDATES", candidates)
+        offsets, hits = ii.findBatch(starts, ends, bins, positions)
+        assert offsets.tolist() == expected[0].tolist()
+        assert hits.tolist() == expected[1].tolist()
+
+
+def testFindBatchWithoutIntervals():
+    empty = np.zeros(0, dtype=np.int64)
+    offsets, hits = ii.findBatch(empty, empty, [], [5, 10, 15])
+    assert offsets.tolist() == [0, 0, 0, 0]
+    assert len(hits) == 0
+
+    starts, ends, bins = empty, empty, []
+    offsets, hits = ii.findBatch(starts, ends, bins, [])
+    assert offsets.tolist() == [0]
+    assert len(hits) == 0
+
+
+"""A SweepLookup over the intervals, loaded into table of the test's
+   reference database in shuffled order
+"""
+
+
+def sweepLookup(reference, intervals, table="intervals"):
+    rows = [(row[0], chrom, start, end) for chrom, start, end, row in intervals]
+    random.Random(1).shuffle(rows)
+    reference.create(table, ["id", "chrom", "chromStart", "chromEnd"], rows)
+    return ii.SweepLookup(lambda: reference.connect().cursor(), table)
+
+
+def testSweepMatchesScan(reference, intervals):
+    lookup = sweepLookup(reference, intervals)
+    rng = random.Random(9)
+    for chrom in ["chr2", "chrEmpty", "chr1", "chr3"]:
+        # Coordinate-sorted, with repeated positions
+        positions = sorted(queryPositions(intervals, chrom, rng) * 2)
+        for pos in positions:
+            rows = lookup.fetchall(chrom, pos)
+            expected = scan(intervals, chrom, pos, pos)
+            # Rows with equal starts come in the order of the scan
+            assert sorted(r[0] for r in rows) == sorted(e[0] for e in expected)
+            assert [r[2] for r in rows] == [intervals[e[0]][1] for e in expected]
+            first = lookup.fetchone(chrom, pos)
+            assert (first is None) == (len(expected) == 0)
+    lookup.close()
+
+
+def testSweepRejectsUnsortedQueries(reference, intervals):
+    lookup = sweepLookup(reference, intervals)
+    lookup.fetchall("chr1", 5000)
+    with pytest.raises(ValueError):
+        lookup.fetchall("chr1", 4999)
+    lookup.fetchall("chr2", 1)
+    with pytest.raises(ValueError):
+        lookup.fetchall("chr1", 6000)
+    lookup.close()
+
+
+### EOF
@@ -0,0 +1,120 @@
+# test_layers.py
+#
+# Re-annotation from recorded layers (layers.py, driver.reannotate)
+# writes what annotating the job in full with the new reference versions
+# does, whichever stage's table changed
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import shutil
+
+import pytest
+
+import driver
+import layers as ly
+import utils as u
+
+VERSIONS = {"dbSNP": "1", "cytoBand": "1", "gadAll": "1"}
+
+# Changes of a table of the reference, made with its version raised, and
+# the stage reading it: dbSNP's change the records later stages read,
+# the others only their own annotations (gadAll's after the spaces it
+# adds to every column)
+CHANGES = {
+    "dbSNP": ("delete from dbSNP where id % 2 = 0", "dbSNP"),
+    "cytoBand": ("update cytoBand set name = name || 'b'", "Cytoband"),
+    "gadAll": ("delete from gadAll where id % 2 = 0", "gadAll"),
+}
+
+
+"""Annotated file and count log of the job in infile
+"""
+
+
+def results(infile):
+    contents = []
+    for filename in [driver.annotatedFileName(infile), infile + ".count.log"]:
+        fh = open(filename)
+        contents.append(fh.read())
+        fh.close()
+    return tuple(contents)
+
+
+"""Results of annotating a copy of infile in full, with the versions
+"""
+
+
+def fullRun(infile, versions):
+    directory = os.path.join(os.path.dirname(infile), "full")
+    os.makedirs(directory)
+    copy = os.path.join(directory, os.path.basename(infile))
+    shutil.copy(infile, copy)
+    driver.run(copy, "vcf", layers=True, reference_versions=versions)
+    return results(copy)
+
+
+@pytest.mark.parametrize("table", sorted(CHANGES))
+def testReannotateMatchesFullRun(syntheticJob, capsys, table):
+    infile, db = syntheticJob
+    driver.run(infile, "vcf", layers=True, reference_versions=VERSIONS)
+    before = results(infile)
+
+    change, label = CHANGES[table]
+    db.execute(change)
+    versions = dict(VERSIONS, **{table: "2"})
+    expected = fullRun(infile, versions)
+    assert expected != before
+    capsys.readouterr()
+
+    driver.reannotate(infile, "vcf", reference_versions=versions)
+    assert results(infile) == expected
+    # The changed stage ran again, and later stages that annotate from the
+    # variant alone had their layers applied
+    out = capsys.readouterr().out
+    assert label + " - done." in out
+    assert "genomicSuperDups - layer applied." in out
+
+    # And the layers now hold the new versions
+    capsys.readouterr()
+    driver.reannotate(infile, "vcf", reference_versions=versions)
+    assert results(infile) == expected
+    assert " - done." not in capsys.readouterr().out
+
+
+def testReannotateUnchangedWithoutDatabase(syntheticJob, monkeypatch):
+    infile, _ = syntheticJob
+    driver.run(infile, "vcf", layers=True, reference_versions=VERSIONS)
+    expected = results(infile)
+
+    def unreachable():
+        raise AssertionError("the database was used")
+
+    u.db_disconnect()
+    monkeypatch.setattr(u, "open_db_connection", unreachable)
+    driver.reannotate(infile, "vcf", reference_versions=VERSIONS)
+    assert results(infile) == expected
+
+
+def testRebaseEdits():
+    line = "1\t100\t.\tA\tG\t.\t.\tDP=3"
+    # Appended INFO text starts with ";" unless INFO ended with one
+    edits = ly.lineEdits(line, line + ";RSID=rs1")
+    assert ly.rebaseEdits(edits, 0, line) == edits
+    assert ly.rebaseEdits(edits, 0, line + ";") == [[7, "a", "RSID=rs1"]]
+    assert ly.rebaseEdits(edits, 0, line + ";", fixedSeparator=True) == edits
+    edits = ly.lineEdits(line + ";", line + ";RSID=rs1")
+    assert ly.rebaseEdits(edits, 1, line) == [[7, "a", ";RSID=rs1"]]
+
+    # Spaces carry over on any column; replacements never do
+    spaced = "\t ".join(line.split("\t"))
+    edits = ly.lineEdits(line, spaced + ";GENE=A")
+    assert ly.applyEdits(ly.rebaseEdits(edits, 0, line), line) == spaced + ";GENE=A"
+    assert ly.rebaseEdits(ly.lineEdits(line, line.replace("A", "C")), 0, line) is None
+    assert ly.rebaseEdits(ly.lineEdits(line, line + "\textra"), 0, line) is None
+
+
+### EOF
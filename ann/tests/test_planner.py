@@ -0,0 +1,66 @@
+# test_planner.py
+#
+# Table statistics of the engine planner (planner.py): read once, without
+# scanning big tables, and given up on without a database
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import sqlite3
+
+import pymysql
+
+import planner as pl
+import utils as u
+
+TABLES = ["dbSNP", "refGene", "cytoBand", "tfbsConsSites"]
+
+
+"""Rows of table in the reference database at path
+"""
+
+
+def rowCount(path, table):
+    conn = sqlite3.connect(path)
+    rows = conn.execute("select count(*) from " + table).fetchone()[0]
+    conn.close()
+    return rows
+
+
+def testUnreachableDatabase(monkeypatch):
+    attempts = []
+
+    def unreachable():
+        attempts.append(1)
+        raise pymysql.err.OperationalError(2003, "Can't connect to MySQL server")
+
+    u.db_disconnect()
+    monkeypatch.setattr(u, "open_db_connection", unreachable)
+    monkeypatch.setattr(pl, "_statistics", None)
+
+    assert pl.tableStatistics(TABLES) == {}
+    assert len(attempts) == 1
+    # Nothing is retried while the statistics are fresh
+    assert pl.tableStatistics(TABLES) == {}
+    assert len(attempts) == 1
+
+
+def testBigTablesLeftUnknown(syntheticJob, monkeypatch):
+    _, db = syntheticJob
+    dbSnpRows = rowCount(db.path, "dbSNP")
+    cytoBandRows = rowCount(db.path, "cytoBand")
+    assert cytoBandRows < dbSnpRows
+    monkeypatch.setattr(pl, "COUNT_ROWS_LIMIT", dbSnpRows)
+    monkeypatch.setattr(pl, "_statistics", None)
+
+    # SQLite has no information_schema: small tables are counted
+    statistics = pl.tableStatistics(TABLES)
+    assert statistics["cytoBand"] == cytoBandRows
+    assert statistics["refGene"] == rowCount(db.path, "refGene")
+    assert "dbSNP" not in statistics
+    assert pl.tableRows(statistics, "tfbsConsSites") is None
+
+
+### EOF
@@ -0,0 +1,97 @@
+# test_shards.py
+#
+# A job annotated in chromosome shards (shards.py) writes the annotated
+# file and count log of a single-process run: records back in input
+# order and counts, including dbSNP's total and ratio, merged
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import shutil
+
+import pytest
+
+import driver
+import shards
+
+
+"""Annotated file and count log of running a copy of infile, in
+   directory name next to it
+"""
+
+
+def annotate(infile, name, **kwargs):
+    directory = os.path.join(os.path.dirname(infile), name)
+    os.makedirs(directory)
+    copy = os.path.join(directory, os.path.basename(infile))
+    shutil.copy(infile, copy)
+    driver.run(copy, "vcf", **kwargs)
+    results = []
+    for filename in [driver.annotatedFileName(copy), copy + ".count.log"]:
+        fh = open(filename)
+        results.append(fh.read())
+        fh.close()
+    return tuple(results)
+
+
+"""Writes the count logs of lines to directory, returning their names
+"""
+
+
+def writeLogs(directory, logs):
+    names = []
+    for n, lines in enumerate(logs):
+        names.append(str(directory / ("%d.count.log" % n)))
+        fh = open(names[-1], "w")
+        fh.write("".join(line + "\n" for line in lines))
+        fh.close()
+    return names
+
+
+@pytest.mark.parametrize(
+    "engine, fused, workers", [("sql", True, 2), ("index", True, 3), ("index", False, 2)]
+)
+def testShardsMatchSingleProcess(syntheticJob, engine, fused, workers):
+    infile, _ = syntheticJob
+    single = annotate(infile, "single", engine=engine, fused=fused)
+    sharded = annotate(infile, "sharded", engine=engine, fused=fused, workers=workers)
+    assert sharded[1] == single[1]
+    assert sharded[0] == single[0]
+
+
+def testMergeCountLogs(tmp_path):
+    # Shards of 2 and 4 records, 1 and 2 of them in dbSNP: Total counts
+    # the records plus one
+    logs = writeLogs(
+        tmp_path,
+        [
+            ["Total: 3", "In dbSNP: 1 (33.33333333333333%)", "In CDS 1", "In '3 UTR 0"],
+            ["Total: 5", "In dbSNP: 2 (40.0%)", "In CDS 2", "In '3 UTR 4"],
+        ],
+    )
+    merged = str(tmp_path / "count.log")
+    shards.mergeCountLogs(logs, merged)
+    fh = open(merged)
+    lines = fh.read().splitlines()
+    fh.close()
+    assert lines == [
+        "Total: 7",
+        "In dbSNP: 3 (" + str(3 / 7.0 * 100) + "%)",
+        "In CDS 3",
+        "In '3 UTR 4",
+    ]
+
+
+def testMergeCountLogsOfOtherStages(tmp_path):
+    logs = writeLogs(tmp_path, [["Total: 3", "In CDS 1"], ["Total: 5", "In UTR 2"]])
+    with pytest.raises(ValueError):
+        shards.mergeCountLogs(logs, str(tmp_path / "count.log"))
+    logs = writeLogs(tmp_path, [["Total: 3", "In CDS 1"], ["Total: 5"]])
+    with pytest.raises(ValueError):
+        shards.mergeCountLogs(logs, str(tmp_path / "count.log"))
+
+
+### EOF
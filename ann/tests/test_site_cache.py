@@ -0,0 +1,82 @@
+# test_site_cache.py
+#
+# The host's site cache (site_cache.py) answers a stage's lookups only
+# while every table the stage reads is at the version it was cached at
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import io
+
+import annotate as ann
+import site_cache as sc
+
+REFGENE_COLUMNS = (
+    "bin name chrom strand txStart txEnd cdsStart cdsEnd exonCount exonStarts "
+    + "exonEnds score name2 cdsStartStat cdsEndStat exonFrames"
+).split()
+CPG_COLUMNS = ["bin", "chrom", "chromStart", "chromEnd", "name"]
+
+# Variants upstream of a "+" transcript starting at 10000, within its
+# promoter and a CpG island
+VCF = [
+    "chr1\t9700\t.\tA\tG\t.\t.\t.",
+    "chr1\t9800\t.\tC\tT\t.\t.\t.",
+]
+
+
+"""A reference of one transcript and one CpG island named island
+"""
+
+
+def fillReference(reference, island):
+    reference.create(
+        "refGene",
+        REFGENE_COLUMNS,
+        [
+            (0, "NM_1", "chr1", "+", 10000, 20000, 11000, 19000, 1)
+            + (b"10000,", b"20000,", 0, "GENE1", "cmpl", "cmpl", b"0,")
+        ],
+    )
+    reference.create("cpgIslandExt", CPG_COLUMNS, [(0, "chr1", 9000, 10000, island)])
+
+
+"""Annotated lines of the refGene stage over VCF with the site cache at
+   path, with the tables at versions
+"""
+
+
+def annotateGenes(path, versions):
+    sc.active = sc.SiteCache(path, versions)
+    try:
+        lines = [str(r) for r in ann.streamGenes(list(VCF), io.StringIO(), engine="sql")]
+    finally:
+        sc.active.close()
+        sc.active = None
+    return lines
+
+
+def testCachedPromoters(reference, tmp_path):
+    path = str(tmp_path / "sites.db")
+    fillReference(reference, "CpG: 50")
+    first = annotateGenes(path, {"refGene": "1", "cpgIslandExt": "1"})
+    assert all("putativePromoterRegion=CpG:50" in line for line in first)
+
+    # Answered from the cache while the versions stand
+    fillReference(reference, "CpG: 70")
+    assert annotateGenes(path, {"refGene": "1", "cpgIslandExt": "1"}) == first
+
+
+def testNewCpgIslandVersionDropsEntries(reference, tmp_path):
+    path = str(tmp_path / "sites.db")
+    fillReference(reference, "CpG: 50")
+    annotateGenes(path, {"refGene": "1", "cpgIslandExt": "1"})
+
+    fillReference(reference, "CpG: 70")
+    lines = annotateGenes(path, {"refGene": "1", "cpgIslandExt": "2"})
+    assert all("putativePromoterRegion=CpG:70" in line for line in lines)
+
+
+### EOF
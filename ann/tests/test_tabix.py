@@ -0,0 +1,146 @@
+# test_tabix.py
+#
+# Round trip of the tabix index (tabix.py) of a bgzip-compressed VCF
+# (bgzf.py): region queries answered through the index match a scan of
+# the uncompressed file
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import random
+
+import pytest
+
+import bgzf
+import tabix
+
+# Chromosomes of the test VCF, in file order: "chr" prefixed, lower case
+# and bare names are all distinct sequences to tabix
+CHROMOSOMES = ["chr1", "chr10", "chrX", "chrx", "1", "MT"]
+
+
+"""Writes a coordinate-sorted VCF of records per chromosome, SNVs and
+   deletions, a few of which span 16 KB windows, over positions spread
+   so the records cross many windows, bins and BGZF blocks; returns its
+   records as (chrom, pos, length of REF, line)
+"""
+
+
+def writeVcf(filename, records=1500, seed=7):
+    rng = random.Random(seed)
+    lines = ["##fileformat=VCFv4.1", "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO"]
+    written = []
+    for chrom in CHROMOSOMES:
+        positions = sorted(rng.randint(1, 3000000) for _ in range(records))
+        for pos in positions:
+            length = rng.choice([1, 1, 1, 5, 40])
+            if rng.random() < 0.005:
+                length = rng.randint(16384, 40000)
+            ref = "".join(rng.choice("ACGT") for _ in range(length))
+            alt = ref[0] if len(ref) > 1 else "T"
+            info = "DP=" + str(rng.randint(1, 99)) + ";name=x" * rng.randint(0, 3)
+            line = "\t".join([chrom, str(pos), ".", ref, alt, "50", "PASS", info])
+            lines.append(line)
+            written.append((chrom, pos, len(ref), line))
+    fh = open(filename, "w")
+    fh.write("\n".join(lines) + "\n")
+    fh.close()
+    return written
+
+
+"""Records of a region found by a scan: those of the chromosome whose
+   POS..POS + len(REF) - 1 overlaps the region (1-based, closed)
+"""
+
+
+def scanRegion(records, chrom, beg=None, end=None):
+    return [
+        line
+        for c, pos, length, line in records
+        if c == chrom
+        and (beg is None or pos + length - 1 >= beg)
+        and (end is None or pos <= end)
+    ]
+
+
+def regions(records, count=300, seed=11):
+    rng = random.Random(seed)
+    found = [(c, None, None) for c in CHROMOSOMES + ["chr2", "CHR1"]]
+    for _ in range(count):
+        chrom = rng.choice(CHROMOSOMES)
+        beg = rng.randint(1, 3100000)
+        found.append((chrom, beg, beg + rng.choice([0, 1, 100, 20000, 300000])))
+    # Points at and just after the records, so deletions are tested
+    # from their last base
+    for chrom, pos, length, _ in rng.sample(records, 100):
+        found.append((chrom, pos + length - 1, pos + length - 1))
+        found.append((chrom, pos + length, pos + length))
+    return found
+
+
+def regionText(chrom, beg, end):
+    if beg is None:
+        return chrom
+    return f"{chrom}:{beg}-{end}"
+
+
+@pytest.fixture(scope="module")
+def compressed(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("tabix")
+    vcf = str(directory / "job.annot.vcf")
+    records = writeVcf(vcf)
+    blocks = bgzf.compressFile(vcf, vcf + ".gz", 2)
+    index = tabix.buildIndex(vcf, blocks)
+    index.write(vcf + ".gz.tbi")
+    return vcf, records, index
+
+
+def testFetchRegionMatchesScan(compressed):
+    vcf, records, index = compressed
+    readRange = tabix.fileRange(vcf + ".gz")
+    for chrom, beg, end in regions(records):
+        got = tabix.fetchRegion(index, regionText(chrom, beg, end), readRange)
+        assert got == scanRegion(records, chrom, beg, end), (chrom, beg, end)
+
+
+def testIndexFileRoundTrip(compressed):
+    vcf, records, index = compressed
+    read = tabix.readIndex(vcf + ".gz.tbi")
+    assert read.names == CHROMOSOMES
+    assert read.encode() == index.encode()
+
+    readRange = tabix.fileRange(vcf + ".gz")
+    for chrom, beg, end in regions(records, count=50, seed=13):
+        region = regionText(chrom, beg, end)
+        assert tabix.fetchRegion(read, region, readRange) == scanRegion(
+            records, chrom, beg, end
+        )
+
+
+def testReadByTabix(compressed):
+    """The index as htslib reads it, when pysam is installed"""
+    pysam = pytest.importorskip("pysam")
+    vcf, records, _ = compressed
+    tbx = pysam.TabixFile(vcf + ".gz", index=vcf + ".gz.tbi")
+    for chrom, beg, end in regions(records, count=100, seed=17):
+        if chrom not in CHROMOSOMES:
+            continue
+        if beg is None:
+            got = list(tbx.fetch(chrom))
+        else:
+            got = list(tbx.fetch(chrom, beg - 1, end))
+        assert got == scanRegion(records, chrom, beg, end), (chrom, beg, end)
+
+
+def testUnsortedInputIsNotIndexed(tmp_path):
+    vcf = str(tmp_path / "job.annot.vcf")
+    fh = open(vcf, "w")
+    fh.write("chr1\t200\t.\tA\tT\nchr1\t100\t.\tA\tT\n")
+    fh.close()
+    blocks = bgzf.compressFile(vcf, vcf + ".gz", 1)
+    assert tabix.buildIndex(vcf, blocks) is None
+
+
+### EOF
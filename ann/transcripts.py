@@ -0,0 +1,90 @@
+# transcripts.py
+#
+# refGene transcripts parsed once per job into integer exon arrays, for
+# the gene structure stages (annotate.getGenes, annotate.getExonsEtAl)
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+from bisect import bisect_right
+
+# Parsed transcripts kept per stage before the cache starts over
+TRANSCRIPT_CACHE = 50000
+
+
+class TranscriptModel(object):
+    """
+    One refGene row with its coordinates as integers and its exons as
+    sorted arrays. exonsAt() bisects to the exons containing a position
+    instead of scanning all of them, which matters for genes with
+    hundreds of exons.
+    """
+
+    def __init__(self, row):
+        self.txStart = int(row[4])
+        self.txEnd = int(row[5])
+        self.cdsStart = int(row[6])
+        self.cdsEnd = int(row[7])
+        self.exonCount = int(row[8])
+        self.geneSymbol = str(row[12])
+        self.strand = str(row[3])
+
+        exonsSt = str(row[9].decode("utf-8")).split(",")
+        exonsEn = str(row[10].decode("utf-8")).split(",")
+        self.exonStarts = [int(exonsSt[e]) for e in range(0, self.exonCount)]
+        self.exonEnds = [int(exonsEn[e]) for e in range(0, self.exonCount)]
+
+        # Running maximum of the ends, so a search can stop early even if
+        # an exon were to contain the next one
+        self.maxEnds = []
+        maxEnd = None
+        for end in self.exonEnds:
+            maxEnd = end if maxEnd is None else max(maxEnd, end)
+            self.maxEnds.append(maxEnd)
+        self.inOrder = all(
+            self.exonStarts[e] <= self.exonStarts[e + 1]
+            for e in range(0, self.exonCount - 1)
+        )
+
+    def exonsAt(self, pos):
+        """Indices of the exons with start <= pos <= end, ascending"""
+        if not self.inOrder:
+            return [
+                e
+                for e in range(0, self.exonCount)
+                if self.exonStarts[e] <= pos and pos <= self.exonEnds[e]
+            ]
+
+        hits = []
+        e = bisect_right(self.exonStarts, pos) - 1
+        while e >= 0 and self.maxEnds[e] >= pos:
+            if self.exonEnds[e] >= pos:
+                hits.append(e)
+            e = e - 1
+        hits.reverse()
+        return hits
+
+
+class TranscriptCache(object):
+    """
+    TranscriptModels of the refGene rows seen by a stage, keyed by row
+    """
+
+    def __init__(self, size=TRANSCRIPT_CACHE):
+        self.size = size
+        self.models = {}
+
+    def model(self, row):
+        key = tuple(row)
+        model = self.models.get(key)
+        if model is None:
+            if len(self.models) >= self.size:
+                self.models.clear()
+            model = TranscriptModel(row)
+            self.models[key] = model
+        return model
+
+
+### EOF
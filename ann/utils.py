@@ -13,30 +13,71 @@ __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
 import os
 import json
+import time
 import pymysql
 import boto3
 from botocore.exceptions import ClientError
 
-"""Get connection to reference database
+# Seconds the RDS secret is reused before it is fetched again
+RDS_SECRET_TTL = (
+    int(os.environ["RDS_SECRET_TTL"]) if ("RDS_SECRET_TTL" in os.environ) else 300
+)
+
+# Process-wide cache of the RDS secret and of the shared connection
+_rds_secret = None
+_rds_secret_expires = 0
+_shared_conn = None
+_shared_pid = None
+_shared_thread = None
+
+# Sessions the shared connection has had in this process: temporary
+# tables (e.g. the join engine's job variants) live only as long as the
+# session they were created in
+db_session = 0
+
+
+"""Get the RDS credentials from AWS Secrets Manager, reusing them for
+   RDS_SECRET_TTL seconds
 """
 
 
-def db_connect():
-    AWS_REGION_NAME = (
-        os.environ["AWS_REGION_NAME"]
-        if ("AWS_REGION_NAME" in os.environ)
-        else "us-east-1"
-    )
+def get_rds_secret(refresh=False):
+    global _rds_secret, _rds_secret_expires
+
+    if refresh or _rds_secret is None or time.time() >= _rds_secret_expires:
+        AWS_REGION_NAME = (
+            os.environ["AWS_REGION_NAME"]
+            if ("AWS_REGION_NAME" in os.environ)
+            else "us-east-1"
+        )
+
+        # Get RDS secret from AWS Secrets Manager
+        asm = boto3.client("secretsmanager", region_name=AWS_REGION_NAME)
+        try:
+            asm_response = asm.get_secret_value(SecretId="rds/anntools_database")
+            _rds_secret = json.loads(asm_response["SecretString"])
+            _rds_secret_expires = time.time() + RDS_SECRET_TTL
+        except ClientError as e:
+            print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
+            raise e
+
+    return _rds_secret
+
 
-    # Get RDS secret from AWS Secrets Manager
-    asm = boto3.client("secretsmanager", region_name=AWS_REGION_NAME)
+"""Open a new connection to the reference database
+"""
+
+
+def open_db_connection():
+    rds_secret = get_rds_secret()
     try:
-        asm_response = asm.get_secret_value(SecretId="rds/anntools_database")
-        rds_secret = json.loads(asm_response["SecretString"])
-    except ClientError as e:
-        print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
-        raise e
+        return _connect(rds_secret)
+    except pymysql.err.OperationalError:
+        # The secret may have been rotated since it was cached
+        return _connect(get_rds_secret(refresh=True))
 
+
+def _connect(rds_secret):
     # Extract database connection parameters
     rds_host = rds_secret["host"]
     mysql_port = rds_secret["port"]
@@ -50,6 +91,86 @@ def db_connect():
     )
 
 
+class SharedConnection(object):
+    """
+    The process-wide connection as handed out by db_connect(). Behaves
+    like the connection itself, except that close() leaves it open for
+    the next caller; db_disconnect() closes it for real.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        pass
+
+
+"""Get connection to reference database
+
+   By default all callers in a process share one connection, checked
+   with a ping (and reopened if needed) each time it is handed out.
+   A ping that had to reconnect starts a new session, counted in
+   db_session, so that temporary tables of the old one can be made
+   again. shared=False opens a dedicated connection, e.g. for unbuffered
+   reads that must not interleave with other queries; the caller closes
+   it.
+"""
+
+
+def db_connect(shared=True):
+    global _shared_conn, _shared_pid, _shared_thread, db_session
+
+    if not shared:
+        return open_db_connection()
+
+    # A connection inherited from a parent process is never reused
+    if _shared_conn is not None and _shared_pid == os.getpid():
+        try:
+            _shared_conn.ping(reconnect=True)
+            if _shared_conn.thread_id() != _shared_thread:
+                print("Reference database connection was reopened")
+                _shared_thread = _shared_conn.thread_id()
+                db_session = db_session + 1
+            return SharedConnection(_shared_conn)
+        except pymysql.MySQLError as e:
+            print(f"Reference database connection lost, reconnecting: {e}")
+
+    _shared_conn = open_db_connection()
+    _shared_pid = os.getpid()
+    _shared_thread = _shared_conn.thread_id()
+    db_session = db_session + 1
+    return SharedConnection(_shared_conn)
+
+
+"""Close the shared reference database connection, if any
+"""
+
+
+def db_disconnect():
+    global _shared_conn, _shared_pid, _shared_thread
+
+    if _shared_conn is not None and _shared_pid == os.getpid():
+        try:
+            _shared_conn.close()
+        except pymysql.MySQLError:
+            pass
+    _shared_conn = None
+    _shared_pid = None
+    _shared_thread = None
+
+
+"""Unbuffered cursor on a reference database connection: rows are read
+   from the server as they are fetched instead of all at once
+"""
+
+
+def db_stream_cursor(conn):
+    return conn.cursor(pymysql.cursors.SSCursor)
+
+
 """Column inices for pileup and VCF
 """
 
@@ -0,0 +1,367 @@
+# bench.py
+#
+# Throughput benchmarks of driver.run: end-to-end and per-stage records
+# per second of each engine and pipeline, against a local SQLite (or a
+# MySQL-compatible) reference database, written as JSON results that
+# can be compared across commits
+#
+# Usage: python bench.py --vcf bench.vcf --sqlite reference.sqlite
+#                        --output results.json [--compare baseline.json]
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import pymysql
+
+ANN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ann")
+sys.path.insert(0, ANN_DIR)
+
+import driver
+import snapshot as sn
+import utils as u
+
+RESULTS_VERSION = 1
+
+# Stages shorter than this (seconds) are left out of comparisons: their
+# throughput is mostly timer noise
+MIN_COMPARED_SECONDS = 0.05
+
+
+class StandInCursor(sqlite3.Cursor):
+    """
+    Cursor running the annotator's MySQL statements on SQLite
+    """
+
+    def execute(self, sql, *args):
+        sql = sql.replace("drop temporary table", "drop table")
+        sql = sql.replace(" straight_join ", " cross join ")
+        try:
+            return sqlite3.Cursor.execute(self, sql, *args)
+        except sqlite3.OperationalError as e:
+            # As pymysql reports e.g. a missing table
+            raise pymysql.err.ProgrammingError(str(e))
+
+
+class StandInConnection(sqlite3.Connection):
+    """
+    SQLite connection with the parts of a pymysql connection the
+    annotator uses
+    """
+
+    def ping(self, reconnect=True):
+        pass
+
+    # A stand-in connection is never reopened by ping
+    def thread_id(self):
+        return id(self)
+
+    def cursor(self, factory=StandInCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+
+"""Makes the annotator use the reference database at sqlitePath, or the
+   MySQL-compatible server of mysql (pymysql.connect arguments), instead
+   of the RDS database named in Secrets Manager
+"""
+
+
+def installDatabase(sqlitePath=None, mysql=None):
+    if sqlitePath is not None:
+
+        def connect():
+            conn = sqlite3.connect(sqlitePath, factory=StandInConnection)
+            conn.create_function("concat", 2, lambda a, b: a + b)
+            # Use the indexes the loader made, as MySQL would
+            conn.execute("pragma automatic_index = off")
+            return conn
+
+        u.open_db_connection = connect
+        u.db_stream_cursor = lambda conn: conn.cursor()
+    else:
+        u.open_db_connection = lambda: pymysql.connect(**mysql)
+    u.db_disconnect()
+
+
+"""Exports the reference database into a snapshot at root, for the
+   snapshot engine (see build_snapshot.py)
+"""
+
+
+def buildSnapshot(root):
+    import build_snapshot as bs
+
+    os.makedirs(root)
+    conn = u.db_connect(shared=False)
+    manifest = {}
+    for table, chromCol, startCol, endCol in bs.SNAPSHOT_TABLES:
+        manifest[table] = bs.exportTable(conn, root, table, chromCol, startCol, endCol)
+    conn.close()
+    sn.writeManifest(root, manifest)
+
+
+def countRecords(filename):
+    records = 0
+    fh = open(filename)
+    for line in fh:
+        if not line.startswith("#"):
+            records = records + 1
+    fh.close()
+    return records
+
+
+def fileHash(filename):
+    digest = hashlib.sha256()
+    fh = open(filename, "rb")
+    for chunk in iter(lambda: fh.read(1 << 20), b""):
+        digest.update(chunk)
+    fh.close()
+    return digest.hexdigest()
+
+
+"""Commit of the benchmarked tree, and whether it has uncommitted changes
+"""
+
+
+def gitCommit():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ANN_DIR, stderr=subprocess.DEVNULL)
+        status = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ANN_DIR, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit.decode("utf-8").strip(), len(status.strip()) > 0
+
+
+def throughput(records, seconds):
+    if records == 0 or seconds <= 0:
+        return None
+    return round(records / seconds, 1)
+
+
+"""Annotates a copy of vcf once in directory with the given settings;
+   returns the wall time and the job's profile
+"""
+
+
+def annotateOnce(vcf, directory, engine, fused, workers, snapshotDir):
+    os.makedirs(directory)
+    job = os.path.join(directory, "bench.vcf")
+    shutil.copy(vcf, job)
+    started = time.perf_counter()
+    driver.run(
+        job,
+        "vcf",
+        engine=engine,
+        fused=fused,
+        snapshot_dir=snapshotDir,
+        workers=workers,
+        profile=True,
+    )
+    wall = time.perf_counter() - started
+    fh = open(job + ".profile.json")
+    profile = json.load(fh)
+    fh.close()
+    return wall, profile
+
+
+"""Benchmarks one configuration: repeat runs, of which the fastest is
+   reported (the least disturbed by the rest of the machine)
+"""
+
+
+def benchmark(vcf, records, work, engine, fused, workers, repeat, snapshotDir):
+    pipeline = "fused" if fused else "staged"
+    name = "%s/%s/%d" % (engine, pipeline, workers)
+    walls = []
+    best = None
+    for n in range(0, repeat):
+        directory = os.path.join(work, name.replace("/", "_") + "_" + str(n))
+        wall, profile = annotateOnce(vcf, directory, engine, fused, workers, snapshotDir)
+        shutil.rmtree(directory)
+        walls.append(round(wall, 6))
+        if best is None or wall < best[0]:
+            best = (wall, profile)
+
+    wall, profile = best
+    stages = []
+    for s in profile["stages"]:
+        stages.append(
+            {
+                "label": s["label"],
+                "wall_seconds": s["wall_seconds"],
+                "cpu_seconds": s["cpu_seconds"],
+                "records": s["records"],
+                "records_per_second": throughput(s["records"], s["wall_seconds"]),
+                "sql_queries": s["sql_queries"],
+                "sql_seconds": s["sql_seconds"],
+            }
+        )
+    print(f"{name}: {wall:.2f} seconds, {throughput(records, wall)} records/second")
+    return {
+        "name": name,
+        "engine": engine,
+        "pipeline": pipeline,
+        "workers": workers,
+        "wall_seconds": round(wall, 6),
+        "all_wall_seconds": walls,
+        "records_per_second": throughput(records, wall),
+        "peak_rss_kb": profile["peak_rss_kb"],
+        "stages": stages,
+    }
+
+
+"""Regressions of results against baseline: configurations, and stages
+   of them, whose throughput fell by more than tolerance (a fraction)
+"""
+
+
+def compareResults(results, baseline, tolerance):
+    if results["input"]["sha256"] != baseline["input"]["sha256"]:
+        print("Warning: the baseline was measured on another input")
+    old = dict((r["name"], r) for r in baseline["runs"])
+    regressions = []
+    for run in results["runs"]:
+        if run["name"] not in old:
+            continue
+        pairs = [(run["name"], run, old[run["name"]])]
+        oldStages = dict((s["label"], s) for s in old[run["name"]]["stages"])
+        for s in run["stages"]:
+            if s["label"] in oldStages:
+                pairs.append((run["name"] + " " + s["label"], s, oldStages[s["label"]]))
+
+        for what, new, was in pairs:
+            if new["records_per_second"] is None or was["records_per_second"] is None:
+                continue
+            if max(new["wall_seconds"], was["wall_seconds"]) < MIN_COMPARED_SECONDS:
+                continue
+            change = new["records_per_second"] / was["records_per_second"] - 1
+            flag = ""
+            if change < -tolerance:
+                flag = "  REGRESSION"
+                regressions.append(what)
+            print(f"{what}: {was['records_per_second']} -> {new['records_per_second']} records/second ({change:+.1%}){flag}")
+    return regressions
+
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Benchmark the annotation throughput of driver.run.")
+    parser.add_argument('--vcf', type=str, required=True, help='Input VCF (see generate_vcf.py).')
+    parser.add_argument('--sqlite', type=str, default=None, help='SQLite reference database (see load_reference.py).')
+    parser.add_argument('--mysql-host', type=str, default=None, help='MySQL-compatible reference server to use instead.')
+    parser.add_argument('--mysql-port', type=int, default=3306)
+    parser.add_argument('--mysql-user', type=str, default="root")
+    parser.add_argument('--mysql-password', type=str, default="")
+    parser.add_argument('--mysql-database', type=str, default="annotator")
+    parser.add_argument('--engines', type=str, default="sql,index,sweep", help='Comma-separated engines to benchmark.')
+    parser.add_argument('--pipelines', type=str, default="fused", help='Comma-separated pipelines: fused, staged.')
+    parser.add_argument('--workers', type=str, default="1", help='Comma-separated worker counts.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per configuration; the fastest is reported.')
+    parser.add_argument('--output', type=str, default=None, help='JSON results file to write.')
+    parser.add_argument('--compare', type=str, default=None, help='JSON results to compare against.')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Throughput drop (fraction) reported as a regression.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    if (args.sqlite is None) == (args.mysql_host is None):
+        print("Give either --sqlite or --mysql-host")
+        sys.exit(2)
+
+    if args.sqlite is not None:
+        installDatabase(sqlitePath=os.path.abspath(args.sqlite))
+        database = "sqlite"
+    else:
+        installDatabase(
+            mysql={
+                "host": args.mysql_host,
+                "port": args.mysql_port,
+                "user": args.mysql_user,
+                "passwd": args.mysql_password,
+                "db": args.mysql_database,
+            }
+        )
+        database = "mysql"
+
+    vcf = os.path.abspath(args.vcf)
+    records = countRecords(vcf)
+    engines = [e.strip() for e in args.engines.split(",")]
+    work = tempfile.mkdtemp(prefix="bench.")
+    snapshotDir = None
+    if "snapshot" in engines:
+        snapshotDir = os.path.join(work, "snapshot")
+        buildSnapshot(snapshotDir)
+
+    runs = []
+    for engine in engines:
+        for pipeline in args.pipelines.split(","):
+            for workers in args.workers.split(","):
+                runs.append(
+                    benchmark(
+                        vcf,
+                        records,
+                        work,
+                        engine,
+                        pipeline.strip() == "fused",
+                        int(workers),
+                        args.repeat,
+                        snapshotDir,
+                    )
+                )
+    shutil.rmtree(work)
+
+    commit, dirty = gitCommit()
+    results = {
+        "version": RESULTS_VERSION,
+        "commit": commit,
+        "dirty": dirty,
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "host": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+        },
+        "database": database,
+        "input": {
+            "file": os.path.basename(vcf),
+            "records": records,
+            "sha256": fileHash(vcf),
+        },
+        "runs": runs,
+    }
+    if args.output is not None:
+        fh = open(args.output, "w")
+        json.dump(results, fh, indent=1)
+        fh.write("\n")
+        fh.close()
+        print(f"Results written to {args.output}")
+
+    if args.compare is not None:
+        fh = open(args.compare)
+        baseline = json.load(fh)
+        fh.close()
+        regressions = compareResults(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            print(f"{len(regressions)} regressions against {args.compare} (commit {baseline['commit']})")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
+
+### EOF
@@ -0,0 +1,123 @@
+# generate_vcf.py
+#
+# Writes a synthetic VCF for the annotation benchmarks, with control over
+# its size, chromosome distribution, duplicate rate and indel fraction
+#
+# Usage: python generate_vcf.py --output bench.vcf --records 100000
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import argparse
+import random
+
+import synthetic as sy
+
+# Longest inserted or deleted sequence
+MAX_INDEL = 10
+
+
+"""One variant at a random position of chrom: a SNV, or with probability
+   indelFraction an insertion or deletion of 1..MAX_INDEL bases after an
+   anchor base, as VCF writes them
+"""
+
+
+def randomVariant(rng, chrom, length, indelFraction):
+    pos = rng.randint(1, length - MAX_INDEL - 1)
+    ref = rng.choice(sy.BASES)
+    if rng.random() >= indelFraction:
+        return (chrom, pos, ref, rng.choice(sy.BASES.replace(ref, "")))
+    size = min(MAX_INDEL, 1 + int(rng.expovariate(0.7)))
+    bases = "".join(rng.choice(sy.BASES) for _ in range(size))
+    if rng.random() < 0.5:
+        return (chrom, pos, ref + bases, ref)
+    return (chrom, pos, ref, ref + bases)
+
+
+"""The variants of the VCF; a share duplicateRate of them repeat an
+   earlier variant (same site and alleles)
+"""
+
+
+def generateVariants(rng, records, lengths, distribution, duplicateRate, indelFraction):
+    length = dict(lengths)
+    chroms = [c for c, _ in distribution]
+    weights = [w for _, w in distribution]
+    variants = []
+    for _ in range(0, records):
+        if len(variants) > 0 and rng.random() < duplicateRate:
+            variants.append(variants[rng.randrange(len(variants))])
+            continue
+        chrom = rng.choices(chroms, weights)[0]
+        variants.append(randomVariant(rng, chrom, length[chrom], indelFraction))
+    return variants
+
+
+"""Chromosome name as written: naming "chr" prefixes every name, "plain"
+   none, and "mixed" every other record
+"""
+
+
+def chromosomeName(chrom, naming, n):
+    if naming == "chr" or (naming == "mixed" and n % 2 == 0):
+        return "chr" + chrom
+    return chrom
+
+
+def writeVcf(filename, variants, lengths, naming, rng):
+    fh = open(filename, "w")
+    fh.write("##fileformat=VCFv4.1\n")
+    fh.write("##source=generate_vcf.py\n")
+    for chrom, length in lengths:
+        fh.write("##contig=<ID=%s,length=%d>\n" % (chromosomeName(chrom, naming, 0), length))
+    fh.write('##INFO=<ID=DP,Number=1,Type=Integer,Description="Read depth">\n')
+    fh.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+    for n, (chrom, pos, ref, alt) in enumerate(variants):
+        fh.write(
+            "%s\t%d\t.\t%s\t%s\t%d\tPASS\tDP=%d\n"
+            % (chromosomeName(chrom, naming, n), pos, ref, alt, rng.randint(20, 99), rng.randint(5, 200))
+        )
+    fh.close()
+
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Write a synthetic VCF for the annotation benchmarks.")
+    parser.add_argument('--output', type=str, required=True, help='VCF file to write.')
+    parser.add_argument('--records', type=int, default=100000, help='Number of variant records.')
+    parser.add_argument('--genome-scale', type=float, default=sy.GENOME_SCALE, help='Chromosome lengths as a fraction of hg19; must match the reference loader.')
+    parser.add_argument('--chromosomes', type=str, default=None, help='Share of records per chromosome, e.g. "1:0.5,2:0.3,X:0.2" (default: by length).')
+    parser.add_argument('--duplicate-rate', type=float, default=0.01, help='Fraction of records repeating an earlier record.')
+    parser.add_argument('--indel-fraction', type=float, default=0.1, help='Fraction of new records that are insertions or deletions.')
+    parser.add_argument('--naming', choices=["plain", "chr", "mixed"], default="plain", help='Chromosome names: 1, chr1 or both.')
+    parser.add_argument('--unsorted', action="store_true", help='Shuffle the records instead of sorting them by position.')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    rng = random.Random(args.seed)
+    lengths = sy.chromosomeLengths(args.genome_scale)
+    distribution = sy.chromosomeDistribution(lengths, args.chromosomes)
+
+    variants = generateVariants(
+        rng, args.records, lengths, distribution, args.duplicate_rate, args.indel_fraction
+    )
+    if args.unsorted:
+        rng.shuffle(variants)
+    else:
+        order = dict((c, i) for i, (c, _) in enumerate(lengths))
+        variants.sort(key=lambda v: (order[v[0]], v[1]))
+
+    writeVcf(args.output, variants, lengths, args.naming, rng)
+    print(f"{len(variants)} records written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
+
+### EOF
@@ -0,0 +1,552 @@
+# load_reference.py
+#
+# Fills a local SQLite database, or a MySQL-compatible server, with
+# synthetic reference tables in the schemas annotate.py reads, scaled to
+# the synthetic genome of the benchmarks
+#
+# Usage: python load_reference.py --sqlite reference.sqlite --vcf bench.vcf
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import argparse
+import gzip
+import os
+import random
+import sqlite3
+import time
+
+import synthetic as sy
+
+INT = "int"
+NAME = "varchar(64)"
+TEXT = "varchar(255)"
+BLOB = "blob"
+
+# Rows inserted per executemany
+INSERT_BATCH = 10000
+
+TFBS_CHROMS = [str(c) for c in range(1, 23)] + ["X", "Y"]
+
+CHROM_POS_COLUMNS = [
+    ("id", INT),
+    ("CHR", NAME),
+    ("start", INT),
+    ("end", INT),
+    ("haplotypeReference", TEXT),
+    ("haplotypeAlternate", TEXT),
+    ("name", NAME),
+    ("name2", NAME),
+    ("transcriptStrand", NAME),
+    ("positionType", NAME),
+    ("frame", NAME),
+] + [
+    (c, NAME)
+    for c in [
+        "mrnaCoord",
+        "codonCoord",
+        "spliceDist",
+        "referenceCodon",
+        "referenceAA",
+        "variantCodon",
+        "variantAA",
+        "changesAA",
+        "functionalClass",
+        "codingCoordStr",
+        "proteinCoordStr",
+        "inCodingRegion",
+        "spliceInfo",
+        "uorfChange",
+    ]
+]
+
+INTERVAL_COLUMNS = [
+    ("bin", INT),
+    ("chrom", NAME),
+    ("chromStart", INT),
+    ("chromEnd", INT),
+    ("name", NAME),
+]
+
+# (table, columns, indexed columns)
+TABLES = (
+    [
+        (
+            "dbSNP",
+            [
+                ("id", INT),
+                ("CHR", NAME),
+                ("POS", INT),
+                ("RSID", NAME),
+                ("REF", TEXT),
+                ("ALT", TEXT),
+                ("INFO", NAME),
+                ("GMAF", NAME),
+            ],
+            ["CHR", "POS"],
+        ),
+        ("chrom_pos_equal_base", CHROM_POS_COLUMNS, ["CHR", "start"]),
+        ("chrom_pos_equal_nobase", CHROM_POS_COLUMNS, ["CHR", "start"]),
+        ("chrom_pos_unequal", CHROM_POS_COLUMNS, ["CHR", "start", "end"]),
+        (
+            "refGene",
+            [
+                ("bin", INT),
+                ("name", NAME),
+                ("chrom", NAME),
+                ("strand", NAME),
+                ("txStart", INT),
+                ("txEnd", INT),
+                ("cdsStart", INT),
+                ("cdsEnd", INT),
+                ("exonCount", INT),
+                ("exonStarts", BLOB),
+                ("exonEnds", BLOB),
+                ("score", INT),
+                ("name2", NAME),
+                ("cdsStartStat", NAME),
+                ("cdsEndStat", NAME),
+                ("exonFrames", BLOB),
+            ],
+            ["chrom", "txStart", "txEnd"],
+        ),
+        ("cpgIslandExt", INTERVAL_COLUMNS, ["chrom", "chromStart", "chromEnd"]),
+        (
+            "cytoBand",
+            [
+                ("chrom", NAME),
+                ("chromStart", INT),
+                ("chromEnd", INT),
+                ("name", NAME),
+                ("gieStain", NAME),
+            ],
+            ["chrom", "chromStart", "chromEnd"],
+        ),
+        (
+            "gadAll",
+            [
+                ("id", INT),
+                ("chromosome", NAME),
+                ("chromStart", INT),
+                ("chromEnd", INT),
+                ("geneSymbol", NAME),
+            ],
+            ["chromosome", "chromStart", "chromEnd"],
+        ),
+        (
+            "gwasCatalog",
+            INTERVAL_COLUMNS
+            + [
+                ("pubMedID", NAME),
+                ("author", NAME),
+                ("pubDate", NAME),
+                ("journal", NAME),
+                ("title", TEXT),
+                ("trait", TEXT),
+            ],
+            ["chrom", "chromEnd"],
+        ),
+        (
+            "targetScanS",
+            INTERVAL_COLUMNS + [("score", INT), ("strand", NAME)],
+            ["chrom", "chromStart", "chromEnd"],
+        ),
+        (
+            "hugo",
+            INTERVAL_COLUMNS + [("symbol", NAME), ("description", TEXT)],
+            ["chrom", "chromStart", "chromEnd"],
+        ),
+        (
+            "genomicSuperDups",
+            INTERVAL_COLUMNS
+            + [
+                ("score", INT),
+                ("strand", NAME),
+                ("otherChrom", NAME),
+                ("otherStart", INT),
+                ("otherEnd", INT),
+            ],
+            ["chrom", "chromStart", "chromEnd"],
+        ),
+    ]
+    + [
+        (t, INTERVAL_COLUMNS, ["chrom", "chromStart", "chromEnd"])
+        for t in ["dgv_Cnv", "abParts_IG_T_CelReceptors", "mcCarroll_Cnv", "conrad_Cnv"]
+    ]
+    + [("tfbsConsSites" + c, INTERVAL_COLUMNS, ["chromStart", "chromEnd"]) for c in TFBS_CHROMS]
+)
+
+# Tables naming chromosomes without the "chr" prefix
+PLAIN_CHROM_TABLES = [
+    "dbSNP",
+    "chrom_pos_equal_base",
+    "chrom_pos_equal_nobase",
+    "chrom_pos_unequal",
+    "gadAll",
+]
+
+# Rows per Mb of genome at density 1 (about those of the hg19 tables)
+# and longest feature, of the tables filled at random positions
+DENSITY = [
+    ("dbSNP", 20000, 1),
+    ("chrom_pos_equal_base", 3000, 1),
+    ("chrom_pos_equal_nobase", 3000, 1),
+    ("chrom_pos_unequal", 200, 3000),
+    ("refGene", 20, 100000),
+    ("cpgIslandExt", 9, 3000),
+    ("gadAll", 55, 50000),
+    ("gwasCatalog", 6, 1),
+    ("targetScanS", 16, 8),
+    ("hugo", 10, 60000),
+    ("genomicSuperDups", 16, 20000),
+    ("dgv_Cnv", 35, 20000),
+    ("abParts_IG_T_CelReceptors", 0.05, 500000),
+    ("mcCarroll_Cnv", 0.5, 20000),
+    ("conrad_Cnv", 3, 20000),
+    ("tfbsConsSites", 1200, 20),
+]
+
+# Cytogenetic bands per chromosome, as in hg19 on average
+CYTOBANDS = 36
+
+
+def chromName(table, chrom):
+    if table in PLAIN_CHROM_TABLES:
+        return chrom
+    return "chr" + chrom
+
+
+"""Sorted random intervals (start, end) of chrom, 1..maxLength long
+"""
+
+
+def intervals(rng, count, length, maxLength):
+    maxLength = min(maxLength, length // 4)
+    found = []
+    for _ in range(0, count):
+        size = rng.randint(1, maxLength)
+        start = rng.randint(0, length - size)
+        found.append((start, start + size))
+    found.sort()
+    return found
+
+
+class RowMaker(object):
+    """
+    Rows of each table for a feature at start..end (0-based, half-open)
+    of chrom; ref and alt, when given, are the alleles of a variant the
+    row must match
+    """
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.id = 0
+
+    def nextId(self):
+        self.id = self.id + 1
+        return self.id
+
+    def alleles(self):
+        ref = self.rng.choice(sy.BASES)
+        return ref, self.rng.choice(sy.BASES.replace(ref, ""))
+
+    def dbSNP(self, chrom, start, end, ref=None, alt=None):
+        if ref is None:
+            ref, alt = self.alleles()
+        n = self.nextId()
+        varclass = "SNV" if len(ref) == 1 and len(alt) == 1 else "DIV"
+        gmaf = self.rng.choice([".", ".", "0.01", "0.12", "0.35"])
+        return (n, chrom, end, "rs%d" % n, ref, alt, varclass, gmaf)
+
+    def chromPos(self, chrom, start, end, ref=None, alt=None, base=True):
+        if ref is None:
+            ref, alt = self.alleles()
+        rng = self.rng
+        return (
+            self.nextId(),
+            chrom,
+            start + 1 if end - start == 1 else start,
+            end,
+            ref if base else "",
+            alt if base else "",
+            "NM_%06d" % rng.randint(1, 40000),
+            "GENE%d" % rng.randint(1, 20000),
+            rng.choice("+-"),
+            rng.choice(["CDS", "intron", "utr3", "utr5"]),
+            str(rng.randint(0, 2)),
+        ) + tuple(rng.choice(["", "0", "1", "p.X%d" % rng.randint(1, 999)]) for _ in range(14))
+
+    def chrom_pos_equal_base(self, chrom, start, end, ref=None, alt=None):
+        return self.chromPos(chrom, start, end, ref, alt)
+
+    def chrom_pos_equal_nobase(self, chrom, start, end, ref=None, alt=None):
+        return self.chromPos(chrom, start, end, ref, alt, base=False)
+
+    def chrom_pos_unequal(self, chrom, start, end):
+        return self.chromPos(chrom, start, end, "", "", base=False)
+
+    def refGene(self, chrom, start, end):
+        rng = self.rng
+        exons = min(rng.randint(1, 20), max(1, (end - start) // 2))
+        cuts = sorted(rng.sample(range(start, end + 1), 2 * exons))
+        if rng.random() < 0.3:
+            cdsStart = cdsEnd = end
+        else:
+            cdsStart, cdsEnd = sorted(rng.sample(range(start, end + 1), 2))
+        return (
+            sy.binFromRange(start, end),
+            "NM_%06d" % rng.randint(1, 40000),
+            chrom,
+            rng.choice("+-"),
+            start,
+            end,
+            cdsStart,
+            cdsEnd,
+            exons,
+            (",".join(str(c) for c in cuts[0::2]) + ",").encode("utf-8"),
+            (",".join(str(c) for c in cuts[1::2]) + ",").encode("utf-8"),
+            0,
+            "GENE%d" % rng.randint(1, 20000),
+            "cmpl",
+            "cmpl",
+            (",".join(str(rng.randint(-1, 2)) for _ in range(exons)) + ",").encode("utf-8"),
+        )
+
+    def interval(self, chrom, start, end, name):
+        return (sy.binFromRange(start, end), chrom, start, end, name)
+
+    def cpgIslandExt(self, chrom, start, end):
+        return self.interval(chrom, start, end, "CpG: %d" % self.rng.randint(20, 300))
+
+    def gadAll(self, chrom, start, end):
+        return (self.nextId(), chrom, start, end, "GENE%d" % self.rng.randint(1, 5000))
+
+    def gwasCatalog(self, chrom, start, end, ref=None, alt=None):
+        rng = self.rng
+        return self.interval(chrom, end - 1, end, "rs%d" % rng.randint(1, 10**8)) + (
+            str(rng.randint(10**7, 3 * 10**7)),
+            "Author %d" % rng.randint(1, 999),
+            "2015-%02d-01" % rng.randint(1, 12),
+            "Journal %d" % rng.randint(1, 99),
+            "Genome-wide association study %d" % rng.randint(1, 9999),
+            rng.choice(["Height", "Body mass index", "Type 2 diabetes", "Crohn's disease"]),
+        )
+
+    def targetScanS(self, chrom, start, end):
+        return self.interval(chrom, start, end, "GENE%d:miR-%d" % (self.rng.randint(1, 20000), self.rng.randint(1, 999))) + (self.rng.randint(50, 100), self.rng.choice("+-"))
+
+    def hugo(self, chrom, start, end):
+        n = self.rng.randint(1, 20000)
+        return self.interval(chrom, start, end, "HGNC:%d" % n) + ("SYM%d" % n, self.rng.choice(["protein coding gene", "RNA, long non-coding", "pseudogene; unprocessed"]))
+
+    def genomicSuperDups(self, chrom, start, end):
+        other = self.rng.randint(0, 10**6)
+        return self.interval(chrom, start, end, "%s:%d" % (chrom, start)) + (0, self.rng.choice("+-"), "chr" + self.rng.choice(TFBS_CHROMS), other, other + end - start)
+
+    def cnv(self, chrom, start, end):
+        return self.interval(chrom, start, end, "cnv%d" % self.nextId())
+
+    def tfbsConsSites(self, chrom, start, end):
+        return self.interval(chrom, start, end, "V$TF%d_01" % self.rng.randint(1, 400))
+
+    def row(self, table, chrom, start, end, ref=None, alt=None):
+        if table in ["dgv_Cnv", "abParts_IG_T_CelReceptors", "mcCarroll_Cnv", "conrad_Cnv"]:
+            return self.cnv(chrom, start, end)
+        if ref is None:
+            return getattr(self, table)(chrom, start, end)
+        return getattr(self, table)(chrom, start, end, ref, alt)
+
+
+"""Distinct variant sites (chromosome without "chr", position, REF,
+   ALT) of a VCF, plain or gzip-compressed
+"""
+
+
+def vcfSites(filename):
+    fh = open(filename, "rb")
+    magic = fh.read(2)
+    fh.close()
+    fh = gzip.open(filename, "rt") if magic == b"\x1f\x8b" else open(filename)
+    sites = set()
+    for line in fh:
+        if line.startswith("#"):
+            continue
+        fields = line.split("\t", 5)
+        if len(fields) < 5:
+            continue
+        chrom = fields[0][3:] if fields[0].startswith("chr") else fields[0]
+        sites.add((chrom, int(fields[1]), fields[3], fields[4]))
+    fh.close()
+    return sorted(sites)
+
+
+class Loader(object):
+    """
+    Creates the tables on a DB-API connection and inserts rows in
+    batches; placeholder is the connector's parameter marker
+    """
+
+    def __init__(self, conn, placeholder):
+        self.conn = conn
+        self.placeholder = placeholder
+        self.rows = {}
+
+    def create(self):
+        cursor = self.conn.cursor()
+        for table, columns, indexed in TABLES:
+            cursor.execute("drop table if exists " + table)
+            cursor.execute(
+                "create table "
+                + table
+                + " ("
+                + ", ".join("`" + c + "` " + t for c, t in columns)
+                + ")"
+            )
+        cursor.close()
+        self.conn.commit()
+
+    def insert(self, table, rows):
+        if len(rows) == 0:
+            return
+        columns = [t[1] for t in TABLES if t[0] == table][0]
+        cursor = self.conn.cursor()
+        sql = (
+            "insert into "
+            + table
+            + " values ("
+            + ",".join([self.placeholder] * len(columns))
+            + ")"
+        )
+        for i in range(0, len(rows), INSERT_BATCH):
+            cursor.executemany(sql, rows[i : i + INSERT_BATCH])
+        cursor.close()
+        self.conn.commit()
+        self.rows[table] = self.rows.get(table, 0) + len(rows)
+
+    def index(self):
+        cursor = self.conn.cursor()
+        for table, _, indexed in TABLES:
+            cursor.execute(
+                "create index "
+                + table
+                + "_"
+                + "_".join(indexed)
+                + " on "
+                + table
+                + " ("
+                + ", ".join("`" + c + "`" for c in indexed)
+                + ")"
+            )
+        cursor.close()
+        self.conn.commit()
+
+
+"""Fills the tables: rows at random positions at density times the
+   hg19 densities, plus rows of the position-keyed tables at a share
+   known of the sites of a VCF, so the benchmark variants find matches
+"""
+
+
+def loadTables(loader, rng, lengths, density, sites, known):
+    maker = RowMaker(rng)
+    for chrom, length in lengths:
+        started = time.time()
+        mb = length / 1000000.0
+        rows = {}
+        for table, perMb, maxLength in DENSITY:
+            target = table + chrom if table == "tfbsConsSites" else table
+            name = chromName(table, chrom)
+            count = int(round(perMb * mb * density))
+            rows[target] = [
+                maker.row(table, name, start, end)
+                for start, end in intervals(rng, count, length, maxLength)
+            ]
+
+        # Bands tile the whole chromosome
+        bands = []
+        step = length // CYTOBANDS
+        for b in range(0, CYTOBANDS):
+            end = length if b == CYTOBANDS - 1 else (b + 1) * step
+            arm = "p" if b < CYTOBANDS // 3 else "q"
+            bands.append(
+                ("chr" + chrom, b * step, end, "%s%d.%d" % (arm, 11 + b // 3, 1 + b % 3), rng.choice(["gneg", "gpos25", "gpos50", "acen"]))
+            )
+        rows["cytoBand"] = bands
+
+        for _, pos, ref, alt in [s for s in sites if s[0] == chrom]:
+            for table, share in [
+                ("dbSNP", known),
+                ("chrom_pos_equal_base", known / 2),
+                ("chrom_pos_equal_nobase", known / 2),
+                ("gwasCatalog", known / 20),
+            ]:
+                if rng.random() < share:
+                    rows[table].append(maker.row(table, chromName(table, chrom), pos - 1, pos, ref, alt))
+
+        for table in rows:
+            loader.insert(table, rows[table])
+        print(f"chr{chrom}: {sum(len(r) for r in rows.values())} rows in {time.time() - started:.1f} seconds")
+
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Load synthetic reference tables for the annotation benchmarks.")
+    parser.add_argument('--sqlite', type=str, default=None, help='SQLite database file to create.')
+    parser.add_argument('--mysql-host', type=str, default=None, help='MySQL-compatible server to load instead.')
+    parser.add_argument('--mysql-port', type=int, default=3306)
+    parser.add_argument('--mysql-user', type=str, default="root")
+    parser.add_argument('--mysql-password', type=str, default="")
+    parser.add_argument('--mysql-database', type=str, default="annotator")
+    parser.add_argument('--genome-scale', type=float, default=sy.GENOME_SCALE, help='Chromosome lengths as a fraction of hg19; must match the VCF generator.')
+    parser.add_argument('--density', type=float, default=1.0, help='Rows per Mb as a multiple of the hg19 tables.')
+    parser.add_argument('--vcf', type=str, default=None, help='Benchmark VCF whose sites seed the position-keyed tables.')
+    parser.add_argument('--known-fraction', type=float, default=0.4, help='Share of the VCF sites found in dbSNP.')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    if (args.sqlite is None) == (args.mysql_host is None):
+        print("Give either --sqlite or --mysql-host")
+        return
+
+    if args.sqlite is not None:
+        if os.path.exists(args.sqlite):
+            os.remove(args.sqlite)
+        conn = sqlite3.connect(args.sqlite)
+        loader = Loader(conn, "?")
+    else:
+        import pymysql
+
+        conn = pymysql.connect(
+            host=args.mysql_host,
+            port=args.mysql_port,
+            user=args.mysql_user,
+            passwd=args.mysql_password,
+            db=args.mysql_database,
+        )
+        loader = Loader(conn, "%s")
+
+    started = time.time()
+    sites = vcfSites(args.vcf) if args.vcf is not None else []
+    loader.create()
+    loadTables(
+        loader,
+        random.Random(args.seed),
+        sy.chromosomeLengths(args.genome_scale),
+        args.density,
+        sites,
+        args.known_fraction,
+    )
+    loader.index()
+    conn.close()
+    print(f"{sum(loader.rows.values())} rows in {len(TABLES)} tables loaded in {time.time() - started:.1f} seconds")
+
+
+if __name__ == "__main__":
+    main()
+
+### EOF
@@ -0,0 +1,96 @@
+# synthetic.py
+#
+# Synthetic genome shared by the VCF generator and the reference loader:
+# chromosome lengths (hg19, scaled), chromosome naming per table and the
+# UCSC bin of a feature
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+# hg19 chromosome lengths
+HG19_LENGTHS = [
+    ("1", 249250621),
+    ("2", 243199373),
+    ("3", 198022430),
+    ("4", 191154276),
+    ("5", 180915260),
+    ("6", 171115067),
+    ("7", 159138663),
+    ("8", 146364022),
+    ("9", 141213431),
+    ("10", 135534747),
+    ("11", 135006516),
+    ("12", 133851895),
+    ("13", 115169878),
+    ("14", 107349540),
+    ("15", 102531392),
+    ("16", 90354753),
+    ("17", 81195210),
+    ("18", 78077248),
+    ("19", 59128983),
+    ("20", 63025520),
+    ("21", 48129895),
+    ("22", 51304566),
+    ("X", 155270560),
+    ("Y", 59373566),
+]
+
+# Scale of the synthetic genome: 1% of hg19 (31 Mb) unless given
+GENOME_SCALE = 0.01
+
+BASES = "ACGT"
+
+
+"""Chromosome lengths of the synthetic genome, in hg19 order: the hg19
+   lengths times scale, at least 10 kb
+"""
+
+
+def chromosomeLengths(scale=GENOME_SCALE):
+    return [(c, max(10000, int(length * scale))) for c, length in HG19_LENGTHS]
+
+
+"""Share of the records on each chromosome: spec such as "1:0.5,X:0.2"
+   gives those shares (normalized to 1), the default is proportional to
+   length
+"""
+
+
+def chromosomeDistribution(lengths, spec=None):
+    if spec is None:
+        weights = [(c, float(length)) for c, length in lengths]
+    else:
+        known = dict(lengths)
+        weights = []
+        for part in spec.split(","):
+            chrom, weight = part.split(":")
+            chrom = chrom.strip()
+            if chrom.startswith("chr"):
+                chrom = chrom[3:]
+            if chrom not in known:
+                raise ValueError("Unknown chromosome: " + chrom)
+            weights.append((chrom, float(weight)))
+    total = sum(w for _, w in weights)
+    return [(c, w / total) for c, w in weights if w > 0]
+
+
+"""UCSC bin of the 0-based, half-open range start..end, as in the bin
+   column of the UCSC tables
+"""
+
+
+def binFromRange(start, end):
+    offsets = [512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0]
+    start = start >> 17
+    end = (end - 1) >> 17
+    for offset in offsets:
+        if start == end:
+            return offset + start
+        start = start >> 3
+        end = end >> 3
+    return 0
+
+
+### EOF